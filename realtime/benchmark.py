@@ -0,0 +1,153 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import __builtin__
+import argparse
+import gc
+import os
+import resource
+
+from panda3d.core import loadPrcFile
+
+if os.path.exists('config/general.prc'):
+    loadPrcFile('config/general.prc')
+
+from pandac.PandaModules import *
+from direct.task.TaskManagerGlobal import taskMgr as task_mgr
+
+__builtin__.config = get_config_showbase()
+__builtin__.task_mgr = task_mgr
+
+from realtime import io, codec, clientagent, messagedirector, stateserver
+from realtime.notifier import notify
+from tests.helpers import generate_args
+
+notify = notify.new_category('Benchmark')
+
+class BenchmarkNetwork(object):
+    """
+    Stands in for the StateServer, so that state objects can be
+    created without connecting to a message director...
+    """
+
+    def __init__(self, dc_loader):
+        self.dc_loader = dc_loader
+        self.shard_manager = stateserver.ShardManager()
+        self.object_manager = stateserver.StateObjectManager()
+        self.visibility_service = stateserver.VisibilityService()
+
+    def register_for_channel(self, channel):
+        pass
+
+    def handle_send_connection_datagram(self, datagram):
+        pass
+
+def get_memory_usage():
+    """
+    Returns the resident size of this process in bytes
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(name, count, create):
+    """
+    Creates count live objects and reports the memory used for each of them
+    """
+
+    gc.collect()
+    start_usage = get_memory_usage()
+    objects = [create(index) for index in xrange(count)]
+
+    gc.collect()
+    used = get_memory_usage() - start_usage
+    notify.info('%s: %d objects, %.1f bytes per object.' % (name, count, used / float(count)))
+
+    del objects
+    gc.collect()
+    return used / float(count)
+
+def create_generate_iterator(dc_metadata):
+    required_args = [generate_args(field.codec) if field.codec.compiled else
+        field.codec.unpack_args(field.default_value)[0] for field in dc_metadata.required_fields]
+
+    datagram = io.NetworkDatagram()
+    datagram.append_data(codec.pack_fields(dc_metadata.required_fields, required_args))
+    return datagram
+
+def run_district(dc_loader, dc_name, count, zones):
+    """
+    Generates a synthetic district, count objects spread over zones under a
+    single district object, every tenth of them owned by a client...
+    """
+
+    network = BenchmarkNetwork(dc_loader)
+    dc_metadata = dc_loader.get_class_metadata(dc_name)
+    if dc_metadata is None:
+        notify.error('Cannot run the district benchmark, unknown dclass: %s!' % dc_name)
+        return None
+
+    datagram = create_generate_iterator(dc_metadata)
+
+    def create_object(do_id, parent_id, zone_id):
+        state_object = stateserver.StateObject(network, network.object_manager, do_id,
+            parent_id, zone_id, dc_metadata, False, io.NetworkDatagramIterator(datagram))
+
+        network.object_manager.add_object(state_object)
+        return state_object
+
+    district = create_object(1, 0, 0)
+
+    def create_child(index):
+        do_id = 1000 + index
+        state_object = create_object(do_id, district.do_id, 2000 + index % zones)
+        if not index % 10:
+            state_object.owner_id = 1000000000 + index
+
+        district.handle_changing_location(do_id, district.do_id, state_object.zone_id)
+        return state_object
+
+    bytes_per_object = measure('StateObject', count, create_child)
+    network.object_manager.flush_location_changes()
+    return bytes_per_object
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports the memory used per live object.')
+    parser.add_argument('--objects', type=int, default=100000,
+        help='the number of objects in the synthetic district')
+    parser.add_argument('--zones', type=int, default=100,
+        help='the number of zones the objects are spread over')
+    parser.add_argument('--dclass', default='DistributedNode',
+        help='the dclass of the objects in the synthetic district')
+    parser.add_argument('dc_files', nargs='*', default=['../ToontownOnline/etc/otp.dc',
+        '../ToontownOnline/etc/toon.dc'])
+
+    args = parser.parse_args()
+
+    dc_loader = io.NetworkDCLoader()
+    dc_loader.read_dc_files(args.dc_files)
+
+    run_district(dc_loader, args.dclass, args.objects, args.zones)
+
+    measure('Shard', args.objects, lambda index: stateserver.Shard(
+        index, index, 'District %d' % index, 0))
+
+    measure('MessageHandle', args.objects, lambda index: messagedirector.MessageHandle(
+        index, index, 0, None, 0.0))
+
+    measure('PostMessageHandle', args.objects, lambda index: messagedirector.PostMessageHandle(
+        index, None))
+
+    measure('Interest', args.objects, lambda index: clientagent.Interest())
+    measure('VisibleObject', args.objects, lambda index: clientagent.VisibleObject())
+    measure('ClientAvatarData', args.objects, lambda index: clientagent.ClientAvatarData(
+        index, ['', '', '', ''], '', 0, 0))
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,7 @@ from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.MsgTypes import *
 from direct.fsm.FSM import FSM
 
+from realtime import codec
 from realtime import io
 from realtime import types
 from realtime.notifier import notify
@@ -29,8 +30,6 @@ from realtime import util
 from game.OtpDoGlobals import *
 from game import ZoneUtil
 from game.NameGenerator import NameGenerator
-from game import genDNAFileName, extractGroupName
-from game.dna.DNAParser import loadDNAFileAI, DNAStorage
 
 ESSENTIAL_COMPLETE_ZONES = [OTP_ZONE_ID_OLD_QUIET_ZONE, 
     OTP_ZONE_ID_MANAGEMENT, 
@@ -160,7 +159,7 @@ class LoadAccountFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._account_id,
             self.__account_loaded,
-            self.manager.network.dc_loader.dclasses_by_name['Account'])
+            self.manager.network.dc_loader.class_metadata_by_name['Account'])
 
     def __account_loaded(self, dclass, fields):
         if not dclass and not fields:
@@ -191,7 +190,7 @@ class LoadAccountFSM(ClientOperation):
 
         self.manager.network.database_interface.create_object(self.client.channel,
             types.DATABASE_CHANNEL,
-            self.manager.network.dc_loader.dclasses_by_name['Account'],
+            self.manager.network.dc_loader.class_metadata_by_name['Account'],
             fields=fields,
             callback=self.__account_created)
 
@@ -232,6 +231,7 @@ class LoadAccountFSM(ClientOperation):
         pass
 
 class ClientAvatarData(object):
+    __slots__ = ('_do_id', '_name_list', '_dna', '_position', '_name_index')
 
     def __init__(self, do_id, name_list, dna, position, name_index):
         self._do_id = do_id
@@ -295,7 +295,7 @@ class RetrieveAvatarsFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._account_id,
             self.__account_loaded,
-            self.manager.network.dc_loader.dclasses_by_name['Account'])
+            self.manager.network.dc_loader.class_metadata_by_name['Account'])
 
     def exitStart(self):
         pass
@@ -318,7 +318,7 @@ class RetrieveAvatarsFSM(ClientOperation):
                 types.DATABASE_CHANNEL,
                 avatar_id,
                 response,
-                self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+                self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
         if not self._pending_avatars:
             self.request('SetAvatars')
@@ -359,7 +359,7 @@ class CreateAvatarFSM(ClientOperation):
 
         self.manager.network.database_interface.create_object(self.client.channel,
             types.DATABASE_CHANNEL,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             fields=fields,
             callback=lambda avatar_id: self.__avatar_created(avatar_id, self._index))
 
@@ -368,7 +368,7 @@ class CreateAvatarFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._account_id,
             lambda dclass, fields: self.__account_loaded(dclass, fields, avatar_id, index),
-            self.manager.network.dc_loader.dclasses_by_name['Account'])
+            self.manager.network.dc_loader.class_metadata_by_name['Account'])
 
     def __account_loaded(self, dclass, fields, avatar_id, index):
         avatar_list = fields['ACCOUNT_AV_SET'][0]
@@ -381,7 +381,7 @@ class CreateAvatarFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._account_id,
-            self.manager.network.dc_loader.dclasses_by_name['Account'],
+            self.manager.network.dc_loader.class_metadata_by_name['Account'],
             new_fields)
 
         # We're all done
@@ -405,7 +405,7 @@ class LoadAvatarFSM(ClientOperation):
     def enterStart(self):
 
         def response(dclass, fields):
-            self._dc_class = dclass
+            self._dc_class = self.manager.network.dc_loader.get_class_metadata(dclass)
             self._fields = fields
             self.request('Activate')
 
@@ -413,7 +413,7 @@ class LoadAvatarFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         pass
@@ -434,7 +434,7 @@ class LoadAvatarFSM(ClientOperation):
         datagram.add_uint32(self._avatar_id)
         datagram.add_uint32(0)
         datagram.add_uint32(0)
-        datagram.add_uint16(self._dc_class.get_number())
+        datagram.add_uint16(self._dc_class.number)
 
         sorted_fields = {}
         for field_name, field_args in self._fields.items():
@@ -446,45 +446,40 @@ class LoadAvatarFSM(ClientOperation):
 
                 return
 
-            sorted_fields[field.get_number()] = field_args
+            sorted_fields[field.number] = field_args
 
         sorted_fields = collections.OrderedDict(sorted(
             sorted_fields.items()))
 
-        field_packer = DCPacker()
-        for field_index, field_args in sorted_fields.items():
+        fields = []
+        for field_index in sorted_fields.keys():
             field = self._dc_class.get_field_by_index(field_index)
 
             if not field:
                 self.notify.error('Failed to pack required field: %d for object %d, unknown field!' % (
                     field_index, self._avatar_id))
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
 
-        datagram.append_data(field_packer.get_string())
+        datagram.append_data(codec.pack_fields(fields, sorted_fields.values()))
 
         other_fields = {
             'setCommonChatFlags': (self._fields.get('setCommonChatFlags', 0),),
             'setTrophyScore': (self._fields.get('setTrophyScore', 0),),
         }
 
-        field_packer = DCPacker()
-        for field_name, field_args in other_fields.items():
+        fields = []
+        for field_name in other_fields.keys():
             field = self._dc_class.get_field_by_name(field_name)
 
             if not field:
                 self.notify.error('Failed to pack other field: %s for object %d, unknown field!' % (
                     field_name, self._avatar_id))
 
-            field_packer.raw_pack_uint16(field.get_number())
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
 
         datagram.add_uint16(len(other_fields))
-        datagram.append_data(field_packer.get_string())
+        datagram.append_data(codec.pack_numbered_fields(fields, other_fields.values()))
         self.manager.network.handle_send_connection_datagram(datagram)
 
         # grant ownership over the distributed object...
@@ -542,7 +537,7 @@ class LoadFriendsListFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         pass
@@ -567,7 +562,7 @@ class LoadFriendsListFSM(ClientOperation):
                 types.DATABASE_CHANNEL,
                 friend_id,
                 queryFriendCallback,
-                self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+                self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitQueryFriends(self):
         pass
@@ -661,7 +656,7 @@ class SetNameFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         self.notify.debug("SetNameFSM.exitQuery()")
@@ -679,7 +674,7 @@ class SetNameFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._avatar_id,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             new_fields)
 
         # We're all done
@@ -702,7 +697,7 @@ class GetAvatarDetailsFSM(ClientOperation):
     def enterStart(self):
 
         def response(dclass, fields):
-            self._dc_class = dclass
+            self._dc_class = self.manager.network.dc_loader.get_class_metadata(dclass)
             self._fields = fields
             self.request('SendDetails')
 
@@ -710,7 +705,7 @@ class GetAvatarDetailsFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         pass
@@ -732,13 +727,13 @@ class GetAvatarDetailsFSM(ClientOperation):
                 self.cleanup(False)
                 return
 
-            sorted_fields[field.get_number()] = field_args
+            sorted_fields[field.number] = field_args
 
         sorted_fields = collections.OrderedDict(sorted(
             sorted_fields.items()))
 
-        field_packer = DCPacker()
-        for field_index, field_args in sorted_fields.items():
+        fields = []
+        for field_index in sorted_fields.keys():
             field = self._dc_class.get_field_by_index(field_index)
             if not field:
                 self.notify.warning('Failed to pack required field: %d for object %d, unknown field!' % (
@@ -747,11 +742,9 @@ class GetAvatarDetailsFSM(ClientOperation):
                 self.cleanup(False)
                 return
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
 
-        datagram.append_data(field_packer.get_string())
+        datagram.append_data(codec.pack_fields(fields, sorted_fields.values()))
         di = PyDatagramIterator(datagram)
 
         # We're all done
@@ -776,7 +769,7 @@ class DeleteAvatarFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._account_id,
             self.__account_loaded,
-            self.manager.network.dc_loader.dclasses_by_name['Account'])
+            self.manager.network.dc_loader.class_metadata_by_name['Account'])
 
     def exitStart(self):
         pass
@@ -799,7 +792,7 @@ class DeleteAvatarFSM(ClientOperation):
                 types.DATABASE_CHANNEL,
                 avatar_id,
                 response,
-                self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+                self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
         if not self._pending_avatars:
             self.request('ApplyAvatars')
@@ -825,7 +818,7 @@ class DeleteAvatarFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._account_id,
-            self.manager.network.dc_loader.dclasses_by_name['Account'],
+            self.manager.network.dc_loader.class_metadata_by_name['Account'],
             new_fields,
             callback=update_callback)
 
@@ -876,7 +869,7 @@ class SetAvatarZonesFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         self.notify.debug("SetAvatarZonesFSM.exitQuery()")
@@ -897,7 +890,7 @@ class SetAvatarZonesFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._avatar_id,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             new_fields)
             
         new_fields = {
@@ -907,7 +900,7 @@ class SetAvatarZonesFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._avatar_id,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             new_fields)
             
         new_fields = {
@@ -917,7 +910,7 @@ class SetAvatarZonesFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._avatar_id,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             new_fields)
 
         # We're all done
@@ -955,7 +948,7 @@ class SetNamePatternFSM(ClientOperation):
             types.DATABASE_CHANNEL,
             self._avatar_id,
             response,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'])
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'])
 
     def exitStart(self):
         self.notify.debug("SetNamePatternFSM.exitQuery()")
@@ -993,7 +986,7 @@ class SetNamePatternFSM(ClientOperation):
         self.manager.network.database_interface.update_object(self.client.channel,
             types.DATABASE_CHANNEL,
             self._avatar_id,
-            self.manager.network.dc_loader.dclasses_by_name['DistributedToon'],
+            self.manager.network.dc_loader.class_metadata_by_name['DistributedToon'],
             new_fields)
 
         # We're all done
@@ -1111,8 +1104,9 @@ class InterestOperation:
         self.zones = zones
         self.caller = caller
         
-class ZoneList:
-    
+class ZoneList(object):
+    __slots__ = ('zones',)
+
     def __init__(self):
         self.zones = []
     
@@ -1128,8 +1122,9 @@ class ZoneList:
     def hasZone(self, zoneId):
         return zoneId in self.zones
         
-class Interest:
-    
+class Interest(object):
+    __slots__ = ('zones', 'vis_zones', 'id', 'context', 'parent')
+
     def __init__(self):
         self.zones = ZoneList()
         self.vis_zones = set()
@@ -1176,7 +1171,9 @@ class Interest:
     def hasView(self, zone):
         return zone in self.vis_zones
         
-class VisibleObject:
+class VisibleObject(object):
+    __slots__ = ('parent', 'zone', 'id')
+
     def __init__(self):
         self.parent = -1
         self.zone = -1
@@ -1195,7 +1192,7 @@ class VisibleObject:
         return self.zone
         
     def setId(self, _id):
-        self.id = id
+        self.id = _id
         
     def getId(self):
         return self.id
@@ -1228,11 +1225,17 @@ class Client(io.NetworkHandler):
         self._street_zones = (2100, 2200, 2300, 1100, 1200, 1300, 3100, 3200, 3300, 4100, 4200, 4300, 5100, 5200, 5300, 9100, 9200)
         self._forced_zones = {}
         
-        self._dna_stores = {}
         self._deleted_object_history = []
         
         self.idtest = random.random()
 
+        # outbound accounting, used to hold back or evict
+        # clients that are not reading their updates...
+        self._sent_bytes = 0
+        self._sent_datagrams = 0
+        self._deferred_updates = collections.OrderedDict()
+        self._evicting = False
+
     @property
     def authenticated(self):
         return self._authenticated
@@ -1240,6 +1243,18 @@ class Client(io.NetworkHandler):
     @authenticated.setter
     def authenticated(self, authenticated):
         self._authenticated = authenticated
+
+    @property
+    def sent_bytes(self):
+        return self._sent_bytes
+
+    @property
+    def sent_datagrams(self):
+        return self._sent_datagrams
+
+    @property
+    def deferred_updates(self):
+        return self._deferred_updates
         
     def get_next_context(self):
         self._context_id += 1
@@ -1269,6 +1284,43 @@ class Client(io.NetworkHandler):
         self.handle_send_datagram(datagram)
         self.handle_disconnect()
 
+    def handle_send_datagram(self, datagram):
+        self._sent_bytes += datagram.get_length()
+        self._sent_datagrams += 1
+        io.NetworkHandler.handle_send_datagram(self, datagram)
+
+    def handle_slow_connection(self, size):
+        if self._evicting:
+            return
+
+        # the client would never get to read the disconnect reason behind
+        # everything it is already behind on, so throw that away first...
+        self._evicting = True
+        self.network.discard_connection_buffer(self.connection)
+        self.handle_send_disconnect(types.CLIENT_DISCONNECT_SLOW_CONNECTION,
+            'Client is not keeping up, %d bytes are waiting to be sent!' % size)
+
+    def is_throttled(self):
+        return self.get_backlog_size() > self.network.output_soft_limit
+
+    def flush_deferred_updates(self):
+        """
+        Sends the latest of each held back field update once our output has
+        drained below the soft limit, returns False while we are still throttled
+        """
+
+        if self.is_throttled():
+            return False
+
+        deferred_updates, self._deferred_updates = self._deferred_updates, collections.OrderedDict()
+        for (do_id, field_id), field_data in deferred_updates.items():
+            if not self.can_send_update(do_id):
+                continue
+
+            self.send_object_update_field(do_id, field_id, field_data)
+
+        return True
+
     def handle_datagram(self, di):
         try:
             message_type = di.get_uint16()
@@ -1336,7 +1388,7 @@ class Client(io.NetworkHandler):
             return
 
     def handle_internal_datagram(self, message_type, sender, di):
-        if message_type == types.CLIENTAGENT_DISCONNECT:
+        if message_type == types.CLIENT_AGENT_DISCONNECT:
             self.handle_send_disconnect(di.get_uint16(), di.get_string())
         elif message_type == types.CLIENTAGENT_FRIEND_ONLINE:
             self.handle_friend_online(di)
@@ -1362,6 +1414,8 @@ class Client(io.NetworkHandler):
             self.handle_object_changing_location(di)
         elif message_type == types.STATESERVER_OBJECT_DELETE_RAM:
             self.handle_object_delete_ram(di)
+        elif message_type == types.STATESERVER_OBJECT_DELETE_RAM_MULTIPLE:
+            self.handle_object_delete_ram_multiple(di)
         elif message_type == types.STATESERVER_OBJECT_UPDATE_FIELD:
             self.handle_object_update_field_resp(sender, di)
         else:
@@ -1426,12 +1480,10 @@ class Client(io.NetworkHandler):
                     old_zone_id = zone
                     old_zone_in_street_branch = self.get_in_street_branch(old_zone_id)
                     if old_zone_in_street_branch:
-                        old_branch_zone_id = ZoneUtil.getBranchZone(old_zone_id)
                         if old_zone_id % 100 != 0:
                             old_vis_zones.update(self.get_vis_branch_zones(old_zone_id))
                             for zone_id in old_vis_zones:
                                 kill_zones.append(zone_id)
-                        del self._dna_stores[old_branch_zone_id]
             
             self.close_zones(kill_zones, interest.getParent())
             self.handle_interest_done(interest.getId(), interest.getContext())
@@ -1447,28 +1499,7 @@ class Client(io.NetworkHandler):
         return False
         
     def get_vis_branch_zones(self, zone_id):
-        branch_zone_id = ZoneUtil.getBranchZone(zone_id)
-        dnaStore = self._dna_stores.get(branch_zone_id)
-        if not dnaStore:
-            dnaStore = DNAStorage()
-            dnaFileName = genDNAFileName(branch_zone_id)
-            loadDNAFileAI(dnaStore, dnaFileName, None)
-            self._dna_stores[branch_zone_id] = dnaStore
-
-        zoneVisDict = {}
-        for i in xrange(dnaStore.getNumDNAVisGroupsAI()):
-            groupFullName = dnaStore.getDNAVisGroupName(i)
-            visGroup = dnaStore.getDNAVisGroupAI(i)
-            visZoneId = int(extractGroupName(groupFullName))
-            visZoneId = ZoneUtil.getTrueZoneId(visZoneId, zone_id)
-            visibles = []
-            for i in xrange(visGroup.getNumVisibles()):
-                visibles.append(int(visGroup.visibles[i]))
-
-            visibles.append(ZoneUtil.getBranchZone(visZoneId))
-            zoneVisDict[visZoneId] = visibles
-
-        return zoneVisDict[zone_id]
+        return self.network.vis_graph.get_visible_zones(zone_id)
             
     def handle_add_interest(self, di): 
         try:
@@ -2184,7 +2215,13 @@ class Client(io.NetworkHandler):
         self.handle_send_datagram(datagram)
 
     def handle_object_delete_ram(self, di):
-        doId = di.get_uint32()   
+        self.handle_object_deleted(di.get_uint32())
+
+    def handle_object_delete_ram_multiple(self, di):
+        for _ in xrange(di.get_uint16()):
+            self.handle_object_deleted(di.get_uint32())
+
+    def handle_object_deleted(self, doId):
         self.send_client_object_delete_resp(doId)
         for zoneId in self._seen_objects.keys():
             for objId in self._seen_objects[zoneId]:
@@ -2212,24 +2249,45 @@ class Client(io.NetworkHandler):
         datagram.append_data(di.get_remaining_bytes())
         self.network.handle_send_connection_datagram(datagram)
 
-    def handle_object_update_field_resp(self, sender, di):
-        do_id = di.get_uint32()
-        field_id = di.get_uint16()
-
+    def can_send_update(self, do_id):
         # check to see if we either have seen this object's generate already,
         # or that the object is one of our owned objects...
-        can_send_update = self.has_seen_object(do_id) or do_id in self._pending_objects or do_id in self._owned_objects
-        if not can_send_update:
-            return
+        return self.has_seen_object(do_id) or do_id in self._pending_objects or do_id in self._owned_objects
 
+    def send_object_update_field(self, do_id, field_id, field_data):
         datagram = io.NetworkDatagram()
         datagram.add_uint16(types.CLIENT_OBJECT_UPDATE_FIELD_RESP)
         datagram.add_uint32(do_id)
         datagram.add_uint16(field_id)
-        datagram.append_data(di.get_remaining_bytes())
+        datagram.append_data(field_data)
         self.handle_send_datagram(datagram)
 
+    def handle_object_update_field_resp(self, sender, di):
+        do_id = di.get_uint32()
+        field_id = di.get_uint16()
+
+        if not self.can_send_update(do_id):
+            return
+
+        # while the client is not keeping up, broadcast only updates are held back
+        # and merged so that only the latest value of each field is sent later on,
+        # once we have started holding them back they are held until flushed...
+        if self.network.is_droppable_field(field_id) and (self._deferred_updates or self.is_throttled()):
+            key = (do_id, field_id)
+            if key in self._deferred_updates:
+                del self._deferred_updates[key]
+                self.network.client_counters.increment('merged-updates')
+
+            self._deferred_updates[key] = di.get_remaining_bytes()
+            self.network.handle_throttled_client(self)
+            return
+
+        self.send_object_update_field(do_id, field_id, di.get_remaining_bytes())
+
     def shutdown(self):
+        self.network.remove_throttled_client(self)
+        self._deferred_updates.clear()
+
         if self.network.account_manager.has_fsm(self.channel):
             self.network.account_manager.stop_operation(self)
 
@@ -2253,12 +2311,39 @@ class ClientAgent(io.NetworkListener, io.NetworkConnector):
         self._server_hash_val = int(config.GetString('clientagent-hash-val', '0'))
 
         self._database_interface = util.DatabaseInterface(self)
+        self._vis_graph = util.VisibilityGraph()
         self._account_manager = ClientAccountManager(self)
 
+        self._output_soft_limit = config.GetInt('clientagent-output-soft-limit', 262144)
+        self._output_hard_limit = config.GetInt('clientagent-output-hard-limit', 2097152)
+
+        # the listener reports a client as slow once it's connection has more than the
+        # hard limit written to it but not received, checked every time it is flushed...
+        self.output_high_water = self._output_hard_limit
+        self._client_counters = io.NetworkCounters(self.get_unique_name('clients'))
+        self._throttled_clients = set()
+        self.__throttle_task = None
+
     @property
     def channel_allocator(self):
         return self._channel_allocator
 
+    @property
+    def output_soft_limit(self):
+        return self._output_soft_limit
+
+    @property
+    def output_hard_limit(self):
+        return self._output_hard_limit
+
+    @property
+    def client_counters(self):
+        return self._client_counters
+
+    @property
+    def throttled_clients(self):
+        return self._throttled_clients
+
     @property
     def server_version(self):
         return self._server_version
@@ -2271,6 +2356,10 @@ class ClientAgent(io.NetworkListener, io.NetworkConnector):
     def database_interface(self):
         return self._database_interface
 
+    @property
+    def vis_graph(self):
+        return self._vis_graph
+
     @property
     def account_manager(self):
         return self._account_manager
@@ -2279,6 +2368,41 @@ class ClientAgent(io.NetworkListener, io.NetworkConnector):
         io.NetworkListener.setup(self)
         io.NetworkConnector.setup(self)
 
+        if not self.can_measure_connection_backlog():
+            self.notify.warning('Cannot measure how far behind clients are on this platform, '
+                'the output limits only hold against a single frame\'s output!')
+
+        self._client_counters.setup()
+        self.__throttle_task = task_mgr.add(self.__flush_throttled_clients,
+            self.get_unique_name('flush-throttled-clients'))
+
+    def is_droppable_field(self, field_id):
+        """
+        Returns True if updates of the field can be held back from a slow client,
+        these are broadcast fields that are not stored, such as smooth positions
+        """
+
+        field = self._dc_loader.get_field_metadata(field_id)
+        return field is not None and field.is_broadcast() and not (
+            field.is_required() or field.is_ram() or field.is_db())
+
+    def handle_throttled_client(self, client):
+        if client not in self._throttled_clients:
+            self._throttled_clients.add(client)
+            self._client_counters.increment('throttled')
+
+        self._client_counters.increment('deferred-updates')
+
+    def remove_throttled_client(self, client):
+        self._throttled_clients.discard(client)
+
+    def __flush_throttled_clients(self, task):
+        for client in list(self._throttled_clients):
+            if client.flush_deferred_updates():
+                self._throttled_clients.discard(client)
+
+        return task.cont
+
     def handle_datagram(self, channel, sender, message_type, di):
         handler = self.get_handler_from_channel(channel)
         if not handler:
@@ -2290,5 +2414,12 @@ class ClientAgent(io.NetworkListener, io.NetworkConnector):
         handler.handle_internal_datagram(message_type, sender, di)
 
     def shutdown(self):
+        if self.__throttle_task:
+            task_mgr.remove(self.__throttle_task)
+            self.__throttle_task = None
+
+        self._throttled_clients.clear()
+        self._client_counters.shutdown()
+
         io.NetworkListener.shutdown(self)
         io.NetworkConnector.shutdown(self)
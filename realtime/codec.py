@@ -0,0 +1,449 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import struct
+
+from math import floor
+
+from panda3d.core import *
+from panda3d.direct import *
+
+from realtime.notifier import notify
+
+notify = notify.new_category('DCCodec')
+
+# the subatomic types, as they are numbered in panda's dcSubatomicType.h
+ST_int8 = 0
+ST_int16 = 1
+ST_int32 = 2
+ST_int64 = 3
+ST_uint8 = 4
+ST_uint16 = 5
+ST_uint32 = 6
+ST_uint64 = 7
+ST_float64 = 8
+ST_string = 9
+ST_blob = 10
+ST_blob32 = 11
+ST_int16array = 12
+ST_int32array = 13
+ST_uint16array = 14
+ST_uint32array = 15
+ST_int8array = 16
+ST_uint8array = 17
+ST_uint32uint8array = 18
+ST_char = 19
+
+NUMERIC_FORMATS = {
+    ST_int8: 'b',
+    ST_int16: 'h',
+    ST_int32: 'i',
+    ST_int64: 'q',
+    ST_uint8: 'B',
+    ST_uint16: 'H',
+    ST_uint32: 'I',
+    ST_uint64: 'Q',
+    ST_float64: 'd',
+    ST_char: 'c',
+}
+
+STRING_FORMATS = {
+    ST_string: '<H',
+    ST_blob: '<H',
+    ST_blob32: '<I',
+}
+
+ARRAY_FORMATS = {
+    ST_int8array: 'b',
+    ST_int16array: 'h',
+    ST_int32array: 'i',
+    ST_uint8array: 'B',
+    ST_uint16array: 'H',
+    ST_uint32array: 'I',
+}
+
+# the byte sized array elements, these arrays may also be packed from a string
+BYTE_FORMATS = ('b', 'B')
+
+ELEMENT_NUMERIC = 0
+ELEMENT_STRING = 1
+ELEMENT_ARRAY = 2
+
+UINT16 = struct.Struct('<H')
+
+class DCCodecError(RuntimeError):
+    """
+    Raised when the arguments of a field cannot be packed or unpacked
+    """
+
+class DCFieldCodec(object):
+    """
+    A precompiled plan for packing and unpacking the arguments of a single
+    DC field, the plan is generated into a pair of functions built around
+    the struct module when the field is loaded:
+
+        pack_args(args) returns the packed arguments
+        unpack_args(data, offset=0) returns the arguments and the offset past them
+
+    Fields whose parameters cannot be expressed as a plan are packed
+    with a DCPacker instead...
+    """
+
+    __slots__ = ('_name', '_elements', 'pack_args', 'unpack_args')
+
+    def __init__(self, name, elements, get_field):
+        self._name = name
+        self._elements = elements
+
+        # the fallback only looks up the field when it is first used, so a codec
+        # restored from the dc cache does not need the dc files to be parsed...
+        if elements is None:
+            self.pack_args, self.unpack_args = generate_fallback(get_field)
+        else:
+            self.pack_args, self.unpack_args = generate_plan(name, elements)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def elements(self):
+        return self._elements
+
+    @property
+    def compiled(self):
+        return self._elements is not None
+
+def generate_fallback(get_field):
+    """
+    Returns the pack and unpack functions of a field packed by a DCPacker
+    """
+
+    def pack_args(args):
+        field = get_field()
+        field_packer = DCPacker()
+        field_packer.begin_pack(field)
+        field.pack_args(field_packer, args)
+        if not field_packer.end_pack():
+            raise DCCodecError('Failed to pack field: %s!' % field.get_name())
+
+        return field_packer.get_string()
+
+    def unpack_args(data, offset=0):
+        field = get_field()
+        field_packer = DCPacker()
+        field_packer.set_unpack_data(data[offset:])
+        field_packer.begin_unpack(field)
+        args = field.unpack_args(field_packer)
+        if not field_packer.end_unpack():
+            raise DCCodecError('Failed to unpack field: %s!' % field.get_name())
+
+        return args, offset + field_packer.get_num_unpacked_bytes()
+
+    return pack_args, unpack_args
+
+def generate_plan(name, elements):
+    """
+    Generates the source of the pack and unpack functions for a field, runs
+    of numbers are packed with a single struct and the arguments are converted
+    in line, the same way a DCPacker would convert them...
+    """
+
+    namespace = {
+        'floor': floor,
+        'struct': struct,
+        'DCCodecError': DCCodecError,
+        'name': name,
+    }
+
+    # group the consecutive numbers, so that each group is a single struct
+    groups = []
+    for index, (kind, fmt, divisor) in enumerate(elements):
+        if kind == ELEMENT_NUMERIC and groups and groups[-1][0] == ELEMENT_NUMERIC:
+            groups[-1][1].append((index, fmt, divisor))
+        else:
+            groups.append((kind, [(index, fmt, divisor)]))
+
+    names = ['a%d' % index for index in range(len(elements))]
+    pack_lines = ['    [%s] = args' % ', '.join(names)]
+    unpack_lines = []
+    parts = []
+    results = list(names)
+
+    for group_index, (kind, members) in enumerate(groups):
+        if kind == ELEMENT_NUMERIC:
+            group_struct = struct.Struct('<' + ''.join(fmt for _, fmt, _ in members))
+            namespace['S%d' % group_index] = group_struct
+
+            parts.append('S%d.pack(%s)' % (group_index, ', '.join(
+                pack_expression(names[index], fmt, divisor) for index, fmt, divisor in members)))
+
+            unpack_lines.append('    [%s] = S%d.unpack_from(data, offset)' % (
+                ', '.join(names[index] for index, _, _ in members), group_index))
+
+            unpack_lines.append('    offset += %d' % group_struct.size)
+            for index, fmt, divisor in members:
+                if divisor != 1:
+                    results[index] = '%s / %r' % (names[index], float(divisor))
+
+            continue
+
+        index, fmt, _ = members[0]
+        name = names[index]
+        length_struct = struct.Struct(fmt if kind == ELEMENT_STRING else '<H')
+        namespace['S%d' % group_index] = length_struct
+
+        if kind == ELEMENT_STRING:
+            pack_lines.append('    if type(%s) is unicode: %s = str(%s)' % (name, name, name))
+        elif fmt in BYTE_FORMATS:
+            # byte sized arrays may also be packed from a string
+            pack_lines.append("    if type(%s) is not str: %s = struct.pack('<%%d%s' %% len(%s), *%s)" % (
+                name, name, fmt, name, name))
+        else:
+            pack_lines.append("    %s = struct.pack('<%%d%s' %% len(%s), *%s)" % (name, fmt, name, name))
+
+        parts.append('S%d.pack(len(%s))' % (group_index, name))
+        parts.append(name)
+
+        unpack_lines.append('    [length] = S%d.unpack_from(data, offset)' % group_index)
+        unpack_lines.append('    offset += %d' % length_struct.size)
+        if kind == ELEMENT_STRING:
+            unpack_lines.append('    if offset + length > len(data): '
+                'raise DCCodecError("Failed to unpack field: %s, truncated data!" % name)')
+
+            unpack_lines.append('    %s = data[offset:offset + length]' % name)
+        else:
+            unpack_lines.append('    [count, remainder] = divmod(length, %d)' % struct.calcsize(fmt))
+            unpack_lines.append('    if remainder: '
+                'raise DCCodecError("Failed to unpack field: %s, invalid array length!" % name)')
+
+            unpack_lines.append("    %s = list(struct.unpack_from('<%%d%s' %% count, data, offset))" % (
+                name, fmt))
+
+        unpack_lines.append('    offset += length')
+
+    if len(parts) == 1:
+        pack_lines.append('    return %s' % parts[0])
+    else:
+        pack_lines.append("    return ''.join((%s))" % ', '.join(parts))
+
+    if len(groups) == 1 and groups[0][0] == ELEMENT_NUMERIC and results == names:
+        # a plain run of numbers is returned as unpacked by the struct
+        unpack_lines = ['    return S0.unpack_from(data, offset), offset + %d' % (
+            namespace['S0'].size)]
+    else:
+        unpack_lines.append('    return (%s), offset' % ''.join(
+            '%s, ' % result for result in results))
+
+    source = '\n'.join(['def pack_args(args):', '  try:'] + ['  ' + line for line in pack_lines] + [
+        '  except (struct.error, TypeError, ValueError, UnicodeError) as e:',
+        '    raise DCCodecError("Failed to pack field: %s, %s!" % (name, e))',
+        '',
+        'def unpack_args(data, offset=0):',
+        '  try:'] + ['  ' + line for line in unpack_lines] + [
+        '  except struct.error as e:',
+        '    raise DCCodecError("Failed to unpack field: %s, %s!" % (name, e))',
+        ''])
+
+    exec compile(source, '<codec %s>' % name, 'exec') in namespace
+    return namespace['pack_args'], namespace['unpack_args']
+
+def pack_expression(name, fmt, divisor):
+    """
+    Returns the expression converting a number the same
+    way a DCPacker does before it is packed
+    """
+
+    if fmt == 'c':
+        return name
+
+    if fmt == 'd':
+        return '%s * %r' % (name, float(divisor)) if divisor != 1 else name
+
+    if divisor != 1:
+        return 'int(floor(%s * %r + 0.5))' % (name, float(divisor))
+
+    return '(int(floor(%s + 0.5)) if type(%s) is float else %s)' % (name, name, name)
+
+def has_range(parameter):
+    """
+    Returns True if the parameter, or the typedef it was declared with,
+    has a range or a modulus; these are validated by the DCPacker only
+    """
+
+    description = str(parameter)
+    typedef = parameter.get_typedef()
+    if typedef is not None:
+        description += typedef.get_description()
+
+    # without a readable description we cannot tell,
+    # so assume the worst...
+    if description.startswith('<'):
+        return True
+
+    return '(' in description or '%' in description
+
+def compile_parameter(parameter):
+    """
+    Returns the plan for a single parameter of a field, or None if
+    the parameter has to be packed by a DCPacker
+    """
+
+    if has_range(parameter):
+        return None
+
+    simple_parameter = parameter.as_simple_parameter()
+    if simple_parameter is not None:
+        if simple_parameter.has_modulus():
+            return None
+
+        subatomic_type = simple_parameter.get_type()
+        divisor = simple_parameter.get_divisor()
+        if subatomic_type in NUMERIC_FORMATS:
+            if divisor != 1 and subatomic_type == ST_char:
+                return None
+
+            return (ELEMENT_NUMERIC, NUMERIC_FORMATS[subatomic_type], divisor)
+
+        if divisor != 1:
+            return None
+
+        if subatomic_type in STRING_FORMATS:
+            return (ELEMENT_STRING, STRING_FORMATS[subatomic_type], 1)
+
+        if subatomic_type in ARRAY_FORMATS:
+            return (ELEMENT_ARRAY, ARRAY_FORMATS[subatomic_type], 1)
+
+        return None
+
+    array_parameter = parameter.as_array_parameter()
+    if array_parameter is None or array_parameter.get_array_size() >= 0:
+        return None
+
+    if '[]' not in str(parameter):
+        return None
+
+    element_parameter = array_parameter.get_element_type().as_simple_parameter()
+    if element_parameter is None or element_parameter.has_modulus():
+        return None
+
+    if element_parameter.get_divisor() != 1:
+        return None
+
+    subatomic_type = element_parameter.get_type()
+    if subatomic_type == ST_char:
+        # panda packs and unpacks char arrays as a string
+        return (ELEMENT_STRING, '<H', 1)
+
+    if subatomic_type in NUMERIC_FORMATS:
+        return (ELEMENT_ARRAY, NUMERIC_FORMATS[subatomic_type], 1)
+
+    return None
+
+def compile_elements(field):
+    """
+    Returns the plan for every parameter of a DC field, or None for
+    molecular fields and exotic parameter types
+    """
+
+    elements = []
+    try:
+        atomic_field = field.as_atomic_field()
+        if atomic_field is None:
+            return None
+
+        for index in range(atomic_field.get_num_elements()):
+            element = compile_parameter(atomic_field.get_element(index))
+            if element is None:
+                return None
+
+            elements.append(element)
+    except (AttributeError, TypeError):
+        return None
+
+    return tuple(elements)
+
+def is_valid_plan(elements):
+    """
+    Returns True if the plan could have been built by compile_elements, a plan
+    read back from the dc cache is checked before it's source is generated
+    """
+
+    if elements is None:
+        return True
+
+    if not isinstance(elements, tuple):
+        return False
+
+    for element in elements:
+        if not isinstance(element, tuple) or len(element) != 3:
+            return False
+
+        kind, fmt, divisor = element
+        if kind == ELEMENT_NUMERIC:
+            if fmt not in NUMERIC_FORMATS.values():
+                return False
+        elif kind == ELEMENT_STRING:
+            if fmt not in STRING_FORMATS.values() or divisor != 1:
+                return False
+        elif kind == ELEMENT_ARRAY:
+            if fmt not in NUMERIC_FORMATS.values() or divisor != 1:
+                return False
+        else:
+            return False
+
+        if type(divisor) not in (int, long) or divisor < 1:
+            return False
+
+    return True
+
+def compile_field(field):
+    """
+    Builds the codec for a DC field, the codec falls back to a
+    DCPacker for molecular fields and exotic parameter types
+    """
+
+    return DCFieldCodec(field.get_name(), compile_elements(field), lambda: field)
+
+def pack_fields(fields, values):
+    """
+    Packs the arguments of several fields back to back, as in the
+    required fields of a generate
+    """
+
+    return ''.join(field.codec.pack_args(args) for field, args in zip(fields, values))
+
+def unpack_fields(fields, data, offset=0):
+    """
+    Unpacks the arguments of several fields packed back to back,
+    returns the list of arguments and the offset past them
+    """
+
+    values = []
+    for field in fields:
+        args, offset = field.codec.unpack_args(data, offset)
+        values.append(args)
+
+    return values, offset
+
+def pack_numbered_fields(fields, values):
+    """
+    Packs several fields, each prefixed by it's field number
+    """
+
+    return ''.join(UINT16.pack(field.number) + field.codec.pack_args(args)
+        for field, args in zip(fields, values))
+
+def unpack_uint16(data, offset=0):
+    """
+    Unpacks a field number or field count, returns the
+    value and the offset past it
+    """
+
+    try:
+        return UINT16.unpack_from(data, offset)[0], offset + UINT16.size
+    except struct.error as e:
+        raise DCCodecError('Failed to unpack uint16, %s!' % e)
@@ -17,6 +17,7 @@ from panda3d.direct import *
 
 from direct.fsm.FSM import FSM
 
+from realtime import codec
 from realtime import io
 from realtime import types
 from realtime.notifier import notify
@@ -419,7 +420,7 @@ class DatabaseCreateFSM(DatabaseOperationFSM):
         DatabaseOperationFSM.__init__(self, *args, **kwargs)
 
     def enterStart(self):
-        dc_class = self.network.dc_loader.dclasses_by_number.get(self._dc_id)
+        dc_class = self.network.dc_loader.class_metadata_by_number.get(self._dc_id)
         if not dc_class:
             self.notify.error('Failed to create object: %d context: %d, unknown dclass!' % (
                 self._dc_id, self._context))
@@ -428,48 +429,35 @@ class DatabaseCreateFSM(DatabaseOperationFSM):
         file_object = self.network.backend.add_file('%d' % self._do_id)
         file_object.save()
 
-        file_object.set_value('dclass', dc_class.get_name())
+        file_object.set_value('dclass', dc_class.name)
         file_object.set_value('do_id', self._do_id)
 
         fields = {}
-        field_packer = DCPacker()
-        field_packer.set_unpack_data(self._field_data)
-
+        offset = 0
         for _ in range(self._field_count):
-            field_id = field_packer.raw_unpack_uint16()
+            field_id, offset = codec.unpack_uint16(self._field_data, offset)
             field = dc_class.get_field_by_index(field_id)
             if not field:
                 self.notify.error('Failed to unpack field: %d dclass: %s, invalid field!' % (
-                    field_id, dc_class.get_name()))
+                    field_id, dc_class.name))
 
-            field_packer.begin_unpack(field)
-            field_args = field.unpack_args(field_packer)
-            field_packer.end_unpack()
+            field_args, offset = field.codec.unpack_args(self._field_data, offset)
             if not field_args:
                 self.notify.error('Failed to unpack field args for field: %d dclass: %s, invalid result!' % (
-                    field.get_name(), dc_class.get_name()))
-
-            fields[field.get_name()] = field_args
+                    field.name, dc_class.name))
 
-        for field_index in range(dc_class.get_num_inherited_fields()):
-            field_packer = DCPacker()
-            field = dc_class.get_inherited_field(field_index)
-
-            if not field or field.get_name() in fields:
-                continue
+            fields[field.name] = field_args
 
-            if not field.is_db() or not field.has_default_value():
+        for field in dc_class.db_default_fields:
+            if field.name in fields:
                 continue
 
-            field_packer.set_unpack_data(field.get_default_value())
-            field_packer.begin_unpack(field)
-            field_args = field.unpack_args(field_packer)
-            field_packer.end_unpack()
+            field_args, _ = field.codec.unpack_args(field.default_value)
             if not field_args:
                 self.notify.error('Failed to unpack field args for field: %d dclass: %s, invalid result!' % (
-                    field.get_name(), dc_class.get_name()))
+                    field.name, dc_class.name))
 
-            fields[field.get_name()] = field_args
+            fields[field.name] = field_args
 
         file_object.set_value('fields', fields)
 
@@ -516,7 +504,7 @@ class DatabaseRetrieveFSM(DatabaseOperationFSM):
             return
 
         dc_name = file_object.get_value('dclass')
-        self._dc_class = self.network.dc_loader.dclasses_by_name.get(dc_name)
+        self._dc_class = self.network.dc_loader.class_metadata_by_name.get(dc_name)
         if not self._dc_class:
             self.notify.warning('Failed to query object: %d context: %d, unknown dclass: %s!' % (
                 self._do_id, self._context, dc_name))
@@ -537,8 +525,8 @@ class DatabaseRetrieveFSM(DatabaseOperationFSM):
         pass
 
     def enterStop(self):
-        field_packer = DCPacker()
-        for field_name, field_args in self._fields.items():
+        fields = []
+        for field_name in self._fields.keys():
             field = self._dc_class.get_field_by_name(field_name)
             if not field:
                 self.notify.warning('Failed to query object %d context: %d, unknown field: %s' % (
@@ -546,10 +534,7 @@ class DatabaseRetrieveFSM(DatabaseOperationFSM):
 
                 return
 
-            field_packer.raw_pack_uint16(field.get_number())
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
 
         datagram = io.NetworkDatagram()
         datagram.add_header(self.sender, self.network.channel,
@@ -557,10 +542,10 @@ class DatabaseRetrieveFSM(DatabaseOperationFSM):
 
         datagram.add_uint32(self._context)
         datagram.add_uint8(1)
-        datagram.add_uint16(self._dc_class.get_number())
+        datagram.add_uint16(self._dc_class.number)
         datagram.add_uint16(len(self._fields))
 
-        datagram.append_data(field_packer.get_string())
+        datagram.append_data(codec.pack_numbered_fields(fields, self._fields.values()))
         self.network.handle_send_connection_datagram(datagram)
         DatabaseOperationFSM.enterStop(self)
 
@@ -588,7 +573,7 @@ class DatabaseSetFieldFSM(DatabaseOperationFSM):
             return
 
         dc_name = file_object.get_value('dclass')
-        dc_class = self.network.dc_loader.dclasses_by_name.get(dc_name)
+        dc_class = self.network.dc_loader.class_metadata_by_name.get(dc_name)
         if not dc_class:
             self.notify.warning('Failed to set fields for object: %d, unknown dclass: %s!' % (
                 self._do_id, dc_name))
@@ -602,22 +587,18 @@ class DatabaseSetFieldFSM(DatabaseOperationFSM):
 
             return
 
-        field_packer = DCPacker()
-        field_packer.set_unpack_data(self._field_data)
-        field_id = field_packer.raw_unpack_uint16()
+        field_id, offset = codec.unpack_uint16(self._field_data)
         field = dc_class.get_field_by_index(field_id)
         if not field:
             self.notify.error('Failed to unpack field: %d dclass: %s, invalid field!' % (
-                field_id, dc_class.get_name()))
+                field_id, dc_class.name))
 
-        field_packer.begin_unpack(field)
-        field_args = field.unpack_args(field_packer)
-        field_packer.end_unpack()
+        field_args, _ = field.codec.unpack_args(self._field_data, offset)
         if not field_args:
             self.notify.error('Failed to unpack field args for field: %d dclass: %s, invalid result!' % (
-                field.get_name(), dc_class.get_name()))
+                field.name, dc_class.name))
 
-        fields[field.get_name()] = field_args
+        fields[field.name] = field_args
         file_object.set_value('fields', fields)
 
         self.network.backend.remove_file(file_object)
@@ -5,16 +5,53 @@
 """
 
 import collections
+import errno
+import hashlib
+import marshal
+import os
+import select
+import socket
+import struct
 import threading
+import time
 
 from panda3d.core import *
 from panda3d.direct import *
 
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
 
+from realtime import codec
 from realtime import types
 from realtime.notifier import notify
 
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = termios = None
+
+def can_measure_socket_backlog():
+    """
+    Returns True if this platform can tell how much data sits
+    in a socket's send queue, see get_socket_backlog
+    """
+
+    return fcntl is not None and hasattr(termios, 'TIOCOUTQ')
+
+def get_socket_backlog(fileno):
+    """
+    Returns the amount of bytes written to the socket that the other end
+    has not acknowledged yet, or 0 when the platform cannot tell...
+    """
+
+    if not can_measure_socket_backlog():
+        return 0
+
+    try:
+        return struct.unpack('i', fcntl.ioctl(fileno, termios.TIOCOUTQ, '\0' * 4))[0]
+    except (IOError, ValueError):
+        return 0
+
 class NetworkError(RuntimeError):
     """
     A network specific runtime error
@@ -33,100 +70,1583 @@ class NetworkDatagram(NetDatagram):
         self.add_uint64(sender)
         self.add_uint16(message_type)
 
-    def add_control_header(self, channel, message_type):
-        self.add_uint8(1)
-        self.add_uint64(types.CONTROL_MESSAGE)
-        self.add_uint16(message_type)
-        self.add_uint64(channel)
+    def add_multi_header(self, channels, sender, message_type):
+        if not channels or len(channels) > 0xFF:
+            raise NetworkError('Cannot add header for %d channels!' % len(channels))
+
+        self.add_uint8(len(channels))
+        for channel in channels:
+            self.add_uint64(channel)
+
+        self.add_uint64(sender)
+        self.add_uint16(message_type)
+
+    def add_control_header(self, channel, message_type):
+        self.add_uint8(1)
+        self.add_uint64(types.CONTROL_MESSAGE)
+        self.add_uint16(message_type)
+        self.add_uint64(channel)
+
+class NetworkDatagramIterator(PyDatagramIterator):
+    """
+    A class that inherits from panda's C++ DatagramIterator buffer.
+    This class adds useful methods and functions for talking
+    to the OTP's internal cluster participants...
+    """
+
+    def __init__(self, datagram=None, offset=0):
+        if datagram is None:
+            PyDatagramIterator.__init__(self)
+        else:
+            PyDatagramIterator.__init__(self, datagram, offset)
+
+        # keep a reference to the datagram we are iterating, so that it
+        # can be forwarded as-is without copying it's contents...
+        self._source_datagram = datagram
+
+    def get_source_datagram(self):
+        return self._source_datagram
+
+class NetworkCounters(object):
+    """
+    A collection of named counters used to keep track of queue depths
+    and throughput figures within the network layer...
+    """
+
+    notify = notify.new_category('NetworkCounters')
+
+    def __init__(self, name):
+        self._name = name
+        self._counters = collections.OrderedDict()
+        self._report_interval = config.GetFloat('net-counters-report-interval', 0.0)
+        self.__report_task = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def counters(self):
+        return self._counters
+
+    def get(self, key):
+        return self._counters.get(key, 0)
+
+    def set(self, key, value):
+        self._counters[key] = value
+
+    def increment(self, key, amount=1):
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def update_max(self, key, value):
+        if value > self._counters.get(key, 0):
+            self._counters[key] = value
+
+    def reset(self):
+        for key in self._counters:
+            self._counters[key] = 0
+
+    def get_summary(self):
+        return ', '.join('%s: %d' % (key, value) for key, value in self._counters.items())
+
+    def setup(self):
+        if self._report_interval <= 0:
+            return
+
+        self.__report_task = task_mgr.doMethodLater(self._report_interval, self.__report,
+            '%s-report-counters' % self._name)
+
+    def __report(self, task):
+        """
+        Periodically logs the current counter values
+        """
+
+        self.notify.info('%s: %s' % (self._name, self.get_summary()))
+        return task.again
+
+    def shutdown(self):
+        if self.__report_task:
+            task_mgr.remove(self.__report_task)
+
+        self.__report_task = None
+
+class NetworkReadBudget(object):
+    """
+    Limits the amount of queued datagrams that are handled within a single frame.
+    When batch draining is disabled only one datagram is handled per frame,
+    otherwise datagrams are handled until either the count or the time budget runs out...
+    """
+
+    def __init__(self):
+        self._batch_drain = config.GetBool('net-batch-drain', False)
+        self._max_datagrams = config.GetInt('net-batch-max-datagrams', 0)
+        self._max_usec = config.GetInt('net-batch-max-usec', 0)
+
+        self._start_time = 0
+        self._count = 0
+
+    @property
+    def batch_drain(self):
+        return self._batch_drain
+
+    def begin(self):
+        self._start_time = time.time()
+        self._count = 0
+
+    def consume(self, count=1):
+        self._count += count
+
+    def is_exhausted(self):
+        if not self._batch_drain:
+            return self._count >= 1
+
+        if self._max_datagrams and self._count >= self._max_datagrams:
+            return True
+
+        if self._max_usec and (time.time() - self._start_time) * 1000000 >= self._max_usec:
+            return True
+
+        return False
+
+class DCFieldMetadata(object):
+    """
+    An immutable snapshot of a single DC field, the keywords are stored
+    as a bitmask so checking them does not cross into the C++ bindings...
+    """
+
+    __slots__ = ('_loader', '_field', '_number', '_name', '_flags', '_default_value', '_codec')
+
+    REQUIRED = 1 << 0
+    BROADCAST = 1 << 1
+    RAM = 1 << 2
+    DB = 1 << 3
+    CLSEND = 1 << 4
+    CLRECV = 1 << 5
+    OWNSEND = 1 << 6
+    OWNRECV = 1 << 7
+    AIRECV = 1 << 8
+
+    def __init__(self, loader, number, name, flags, default_value, elements, field=None):
+        self._loader = loader
+        self._field = field
+        self._number = number
+        self._name = name
+        self._flags = flags
+        self._default_value = default_value
+        self._codec = codec.DCFieldCodec(name, elements, self.get_field)
+
+    @classmethod
+    def from_field(cls, loader, field):
+        flags = 0
+        if field.is_required():
+            flags |= cls.REQUIRED
+
+        if field.is_broadcast():
+            flags |= cls.BROADCAST
+
+        if field.is_ram():
+            flags |= cls.RAM
+
+        if field.is_db():
+            flags |= cls.DB
+
+        if field.is_clsend():
+            flags |= cls.CLSEND
+
+        if field.is_clrecv():
+            flags |= cls.CLRECV
+
+        if field.is_ownsend():
+            flags |= cls.OWNSEND
+
+        if field.is_ownrecv():
+            flags |= cls.OWNRECV
+
+        if field.is_airecv():
+            flags |= cls.AIRECV
+
+        default_value = field.get_default_value() if field.has_default_value() else None
+        return cls(loader, field.get_number(), field.get_name(), flags, default_value,
+            codec.compile_elements(field), field)
+
+    @property
+    def field(self):
+        return self.get_field()
+
+    @property
+    def number(self):
+        return self._number
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def flags(self):
+        return self._flags
+
+    @property
+    def default_value(self):
+        return self._default_value
+
+    @property
+    def codec(self):
+        return self._codec
+
+    def get_field(self):
+        """
+        Returns the DC field, the field is looked up when it is first
+        needed if the metadata was restored from the dc cache...
+        """
+
+        if self._field is None:
+            self._field = self._loader.dc_file.get_field_by_index(self._number)
+
+        return self._field
+
+    def get_cache_data(self):
+        return (self._number, self._name, self._flags, self._default_value,
+            self._codec.elements)
+
+    def has_default_value(self):
+        return self._default_value is not None
+
+    def is_required(self):
+        return self._flags & self.REQUIRED != 0
+
+    def is_broadcast(self):
+        return self._flags & self.BROADCAST != 0
+
+    def is_ram(self):
+        return self._flags & self.RAM != 0
+
+    def is_db(self):
+        return self._flags & self.DB != 0
+
+    def is_clsend(self):
+        return self._flags & self.CLSEND != 0
+
+    def is_clrecv(self):
+        return self._flags & self.CLRECV != 0
+
+    def is_ownsend(self):
+        return self._flags & self.OWNSEND != 0
+
+    def is_ownrecv(self):
+        return self._flags & self.OWNRECV != 0
+
+    def is_airecv(self):
+        return self._flags & self.AIRECV != 0
+
+class DCClassMetadata(object):
+    """
+    An immutable snapshot of a DC class and all of it's inherited fields
+    """
+
+    __slots__ = ('_loader', '_dclass', '_number', '_name', '_fields', '_fields_by_index',
+        '_fields_by_name', '_required_fields', '_db_default_fields')
+
+    def __init__(self, loader, number, name, fields, dclass=None):
+        self._loader = loader
+        self._dclass = dclass
+        self._number = number
+        self._name = name
+
+        self._fields = tuple(fields)
+        self._fields_by_index = dict((field.number, field) for field in fields)
+        self._fields_by_name = dict((field.name, field) for field in fields)
+
+        # the required fields in the order they are packed in a generate
+        self._required_fields = tuple(field for field in fields if field.is_required())
+        self._db_default_fields = tuple(field for field in fields if field.is_db() and
+            field.has_default_value())
+
+    @classmethod
+    def from_dclass(cls, loader, dclass, field_metadata):
+        fields = []
+        for field_index in range(dclass.get_num_inherited_fields()):
+            field = dclass.get_inherited_field(field_index)
+            if not field:
+                continue
+
+            # share the metadata between every class inheriting the field
+            metadata = field_metadata.get(field.get_number())
+            if metadata is None:
+                metadata = field_metadata[field.get_number()] = DCFieldMetadata.from_field(
+                    loader, field)
+
+            fields.append(metadata)
+
+        return cls(loader, dclass.get_number(), dclass.get_name(), fields, dclass)
+
+    @property
+    def dclass(self):
+        if self._dclass is None:
+            self._dclass = self._loader.dc_file.get_class_by_name(self._name)
+
+        return self._dclass
+
+    @property
+    def number(self):
+        return self._number
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @property
+    def required_fields(self):
+        return self._required_fields
+
+    @property
+    def db_default_fields(self):
+        return self._db_default_fields
+
+    def get_field_by_index(self, field_index):
+        return self._fields_by_index.get(field_index)
+
+    def get_field_by_name(self, field_name):
+        return self._fields_by_name.get(field_name)
+
+    def get_cache_data(self):
+        return (self._number, self._name, tuple(field.number for field in self._fields))
+
+class NetworkDCLoader(object):
+    """
+    Reads the dc files and builds the metadata tables used by the components,
+    the tables can be stored in a cache file so that later startups do not
+    have to parse the dc files unless a dc class object is needed...
+    """
+
+    notify = notify.new_category('NetworkDCLoader')
+
+    DC_CACHE_VERSION = 2
+
+    def __init__(self):
+        self._dc_file = None
+        self._dc_file_names = None
+        self._dc_suffix = ''
+
+        self._dclasses_by_name = {}
+        self._dclasses_by_number = {}
+
+        self._class_metadata_by_name = {}
+        self._class_metadata_by_number = {}
+        self._field_metadata = {}
+
+        self._hash_value = 0
+        self._cache_filename = config.GetString('dc-cache-file', '')
+        self._cache_loaded = False
+
+    @property
+    def dc_file(self):
+        if self._dc_file is None:
+            self.__parse_dc_files()
+
+        return self._dc_file
+
+    @property
+    def dc_suffix(self):
+        return self._dc_suffix
+
+    @property
+    def dclasses_by_name(self):
+        if self._dc_file is None:
+            self.__parse_dc_files()
+
+        return self._dclasses_by_name
+
+    @property
+    def dclasses_by_number(self):
+        if self._dc_file is None:
+            self.__parse_dc_files()
+
+        return self._dclasses_by_number
+
+    @property
+    def class_metadata_by_name(self):
+        return self._class_metadata_by_name
+
+    @property
+    def class_metadata_by_number(self):
+        return self._class_metadata_by_number
+
+    @property
+    def hash_value(self):
+        return self._hash_value
+
+    @property
+    def cache_loaded(self):
+        return self._cache_loaded
+
+    def get_class_metadata(self, dclass):
+        """
+        Returns the metadata for a dclass object, dclass number or dclass name
+        """
+
+        if dclass is None:
+            return None
+
+        if isinstance(dclass, DCClassMetadata):
+            return dclass
+
+        if isinstance(dclass, basestring):
+            return self._class_metadata_by_name.get(dclass)
+
+        if not isinstance(dclass, (int, long)):
+            dclass = dclass.get_number()
+
+        return self._class_metadata_by_number.get(dclass)
+
+    def get_field_metadata(self, field_index):
+        return self._field_metadata.get(field_index)
+
+    def read_dc_files(self, dc_file_names=None):
+        self._dc_file_names = dc_file_names
+
+        # the cache is keyed by the dc files it was built from, so it
+        # cannot be used when the files are looked up through the config...
+        use_cache = bool(self._cache_filename) and dc_file_names is not None
+        if use_cache and self.__load_cache():
+            return
+
+        self.__parse_dc_files()
+        if use_cache:
+            self.__save_cache(self.__get_file_keys())
+
+    def __parse_dc_files(self):
+        self._dc_file = DCFile()
+
+        dc_imports = {}
+        if self._dc_file_names == None:
+            read_result = self._dc_file.read_all()
+            if not read_result:
+                self.notify.error('Could not read dc file.')
+        else:
+            for dc_fileName in self._dc_file_names:
+                pathname = Filename(dc_fileName)
+                read_result = self._dc_file.read(pathname)
+                if not read_result:
+                    self.notify.error('Could not read dc file: %s' % pathname)
+
+        hash_value = self._dc_file.get_hash()
+        if self._cache_loaded and hash_value != self._hash_value:
+            self.notify.warning('DC files changed since the dc cache was loaded, '
+                'hash: %d != %d!' % (hash_value, self._hash_value))
+
+        self._hash_value = hash_value
+
+        # Now get the class definition for the classes named in the DC
+        # file.
+        for i in range(self._dc_file.get_num_classes()):
+            dclass = self._dc_file.get_class(i)
+            number = dclass.get_number()
+            class_name = dclass.get_name() + self._dc_suffix 
+
+            # Does the class have a definition defined in the newly
+            # imported namespace?
+            class_def = dc_imports.get(class_name)
+
+            # Also try it without the dc_suffix.
+            if class_def == None:
+                class_name = dclass.get_name()
+                class_def = dc_imports.get(class_name)
+
+            if class_def == None:
+                self.notify.debug('No class definition for %s.' % class_name)
+            else:
+                if inspect.ismodule(class_def):
+                    if not hasattr(class_def, class_name):
+                        self.notify.error('Module %s does not define class %s.' % (
+                            class_name, class_name))
+
+                    class_def = getattr(class_def, class_name)
+
+                if not inspect.isclass(class_def):
+                    self.notify.error('Symbol %s is not a class name.' % class_name)
+                else:
+                    dclass.set_class_def(class_def)
+
+            self._dclasses_by_name[class_name] = dclass
+            if number >= 0:
+                self._dclasses_by_number[number] = dclass
+
+            # the metadata restored from the dc cache is kept as-is, the
+            # metadata objects are already referenced by the components...
+            if class_name in self._class_metadata_by_name:
+                continue
+
+            # build the metadata table up front, so the hot paths never
+            # have to query the dclass through the C++ bindings...
+            metadata = DCClassMetadata.from_dclass(self, dclass, self._field_metadata)
+
+            self._class_metadata_by_name[class_name] = metadata
+            if number >= 0:
+                self._class_metadata_by_number[number] = metadata
+
+    def __get_file_keys(self):
+        """
+        Returns the path and sha1 digest of each dc file, the cache is
+        only used if it was built from exactly the same file contents...
+        """
+
+        file_keys = []
+        for path in self._dc_file_names:
+            with open(path, 'rb') as dc_file:
+                file_keys.append((path, hashlib.sha1(dc_file.read()).hexdigest()))
+
+        return file_keys
+
+    def __load_cache(self):
+        # the cache is plain marshalled data, so reading it cannot run any
+        # code, everything in it is still checked before it is used...
+        try:
+            with open(self._cache_filename, 'rb') as cache_file:
+                cache = marshal.load(cache_file)
+        except IOError:
+            self.notify.info('No dc cache found: %s.' % self._cache_filename)
+            return False
+        except (EOFError, ValueError, TypeError) as e:
+            self.notify.warning('Failed to read dc cache: %s, %s!' % (self._cache_filename, e))
+            return False
+
+        if not isinstance(cache, dict) or cache.get('version') != self.DC_CACHE_VERSION or \
+                cache.get('suffix') != self._dc_suffix:
+            self.notify.info('Ignoring outdated dc cache: %s.' % self._cache_filename)
+            return False
+
+        try:
+            file_keys = self.__get_file_keys()
+        except (IOError, OSError) as e:
+            self.notify.warning('Failed to check dc files: %s!' % e)
+            return False
+
+        if cache.get('files') != file_keys:
+            self.notify.info('DC files changed, ignoring dc cache: %s.' % self._cache_filename)
+            return False
+
+        tables = self.__read_cache_tables(cache)
+        if tables is None:
+            self.notify.warning('Ignoring invalid dc cache: %s!' % self._cache_filename)
+            return False
+
+        field_metadata, class_metadata = tables
+        self._field_metadata.update(field_metadata)
+        for class_name, metadata in class_metadata:
+            self._class_metadata_by_name[class_name] = metadata
+            if metadata.number >= 0:
+                self._class_metadata_by_number[metadata.number] = metadata
+
+        self._hash_value = cache['hash_value']
+        self._cache_loaded = True
+
+        self.notify.info('Loaded dc cache: %s.' % self._cache_filename)
+        return True
+
+    def __read_cache_tables(self, cache):
+        """
+        Builds the field and class metadata stored in the cache, returns
+        None if any of it is not what __save_cache would have written
+        """
+
+        try:
+            if type(cache['hash_value']) not in (int, long):
+                return None
+
+            field_metadata = {}
+            for number, name, flags, default_value, elements in cache['fields']:
+                if type(number) not in (int, long) or type(flags) not in (int, long) or \
+                        not isinstance(name, str) or not isinstance(default_value, (str, type(None))):
+                    return None
+
+                if not codec.is_valid_plan(elements):
+                    return None
+
+                field_metadata[number] = DCFieldMetadata(self, number, name, flags,
+                    default_value, elements)
+
+            class_metadata = []
+            for class_name, number, name, field_numbers in cache['classes']:
+                if type(number) not in (int, long) or not isinstance(class_name, str) or \
+                        not isinstance(name, str):
+                    return None
+
+                class_metadata.append((class_name, DCClassMetadata(self, number, name,
+                    [field_metadata[field_number] for field_number in field_numbers])))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        return field_metadata, class_metadata
+
+    def __save_cache(self, file_keys):
+        cache = {
+            'version': self.DC_CACHE_VERSION,
+            'suffix': self._dc_suffix,
+            'files': file_keys,
+            'hash_value': self._hash_value,
+            'fields': [metadata.get_cache_data() for metadata in self._field_metadata.values()],
+            'classes': [(class_name, ) + metadata.get_cache_data() for class_name, metadata in
+                self._class_metadata_by_name.items()],
+        }
+
+        # write to a temporary file first, so a process starting at the
+        # same time never reads a partially written cache...
+        temp_filename = '%s.%d.tmp' % (self._cache_filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as cache_file:
+                marshal.dump(cache, cache_file, 2)
+
+            os.rename(temp_filename, self._cache_filename)
+        except (IOError, OSError, ValueError) as e:
+            self.notify.warning('Failed to write dc cache: %s, %s!' % (self._cache_filename, e))
+
+class NetworkStartupTimer(object):
+    """
+    Records how long each step of starting a component took,
+    the timings are logged once everything has been setup...
+    """
+
+    notify = notify.new_category('NetworkStartupTimer')
+
+    def __init__(self):
+        self._timings = collections.OrderedDict()
+
+    @property
+    def timings(self):
+        return self._timings
+
+    def record(self, name, start_time):
+        self._timings[name] = self._timings.get(name, 0.0) + (time.time() - start_time)
+
+    def get_summary(self):
+        return ', '.join('%s: %.3fs' % (name, duration) for name, duration in self._timings.items())
+
+    def report(self):
+        if not self._timings:
+            return
+
+        self.notify.info('Startup took %.3fs, %s' % (sum(self._timings.values()),
+            self.get_summary()))
+
+class NetworkEventLoop(object):
+    """
+    A readiness based event loop, instead of polling every socket each frame
+    the loop sleeps until one of the registered sockets becomes readable or writable,
+    then steps the task manager so any queued work can be handled...
+    """
+
+    notify = notify.new_category('NetworkEventLoop')
+
+    EVENT_READ = 0x001
+    EVENT_WRITE = 0x004
+
+    def __init__(self):
+        self._objects = {}
+        self._writers = set()
+        self._poller = None
+        self._running = False
+
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+
+    @property
+    def objects(self):
+        return self._objects
+
+    def register(self, socket_object):
+        """
+        Starts watching the socket object for readability
+        """
+
+        fd = socket_object.fileno()
+        self._objects[fd] = socket_object
+        if self._poller:
+            self._poller.register(fd, self.EVENT_READ)
+
+    def unregister(self, socket_object):
+        """
+        Stops watching the socket object
+        """
+
+        fd = socket_object.fileno()
+        if fd not in self._objects:
+            return
+
+        del self._objects[fd]
+        self._writers.discard(fd)
+        if self._poller:
+            self._poller.unregister(fd)
+
+    def set_writable(self, socket_object, writable):
+        """
+        Starts or stops watching the socket object for writability
+        """
+
+        fd = socket_object.fileno()
+        if fd not in self._objects or (fd in self._writers) == writable:
+            return
+
+        if writable:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
+
+        if self._poller:
+            event_mask = self.EVENT_READ
+            if writable:
+                event_mask |= self.EVENT_WRITE
+
+            self._poller.modify(fd, event_mask)
+
+    def poll(self, timeout):
+        """
+        Waits until any of the registered sockets are ready,
+        or until the timeout has been reached
+        """
+
+        if not self._objects:
+            time.sleep(timeout)
+            return
+
+        try:
+            if self._poller:
+                events = self._poller.poll(timeout)
+            else:
+                readable, writable, _ = select.select(list(self._objects),
+                    list(self._writers), [], timeout)
+
+                events = [(fd, self.EVENT_READ) for fd in readable]
+                events.extend((fd, self.EVENT_WRITE) for fd in writable)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+
+            raise
+
+        for fd, event_mask in events:
+            # any event other than writability (including errors and hangups)
+            # is handled as a read, which will detect the closed socket...
+            socket_object = self._objects.get(fd)
+            if socket_object and event_mask & ~self.EVENT_WRITE:
+                socket_object.handle_read()
+
+            # the object may have been unregistered while reading...
+            socket_object = self._objects.get(fd)
+            if socket_object and event_mask & self.EVENT_WRITE:
+                socket_object.handle_write()
+
+    def run(self):
+        """
+        Runs the event loop, stepping the task manager each time
+        the loop wakes up
+        """
+
+        timeout = config.GetFloat('net-select-timeout', 0.01)
+
+        self._running = True
+        while self._running:
+            try:
+                self.poll(timeout)
+                task_mgr.step()
+            except (KeyboardInterrupt, SystemExit):
+                self.stop()
+
+    def stop(self):
+        self._running = False
+
+event_loop = NetworkEventLoop()
+startup_timer = NetworkStartupTimer()
+
+class NetworkSocketConnection(object):
+    """
+    A non-blocking TCP stream connection that frames datagrams
+    with the same 16-bit length prefix that panda's connection reader uses...
+    """
+
+    notify = notify.new_category('NetworkSocketConnection')
+
+    def __init__(self, transport, sock, address):
+        self._transport = transport
+        self._socket = sock
+        self._address = address
+        self._fileno = sock.fileno()
+
+        self._read_buffer = bytearray()
+        self._write_buffer = collections.deque()
+        self._write_size = 0
+        self._write_partial = False
+        self._connected = True
+
+        self._socket.setblocking(False)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def connected(self):
+        return self._connected
+
+    def fileno(self):
+        return self._fileno
+
+    def handle_read(self):
+        try:
+            data = self._socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+
+            self.close()
+            return
+
+        if not data:
+            self.close()
+            return
+
+        buf = self._read_buffer
+        buf.extend(data)
+
+        offset = 0
+        while len(buf) - offset >= 2:
+            length = struct.unpack_from('<H', buf, offset)[0]
+            if len(buf) - offset - 2 < length:
+                break
+
+            start = offset + 2
+            offset = start + length
+            self._transport.handle_socket_data(str(buf[start:offset]), self)
+
+        if offset:
+            del buf[:offset]
+
+    def handle_write(self):
+        while self._write_buffer:
+            data = self._write_buffer[0]
+            try:
+                sent = self._socket.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+
+                self.close()
+                return
+
+            self._write_size -= sent
+            if sent < len(data):
+                self._write_buffer[0] = data[sent:]
+                self._write_partial = True
+                return
+
+            self._write_buffer.popleft()
+            self._write_partial = False
+
+        event_loop.set_writable(self, False)
+
+    def get_pending_size(self):
+        """
+        Returns the amount of bytes waiting for the socket to become writable
+        """
+
+        return self._write_size
+
+    def discard_unsent(self):
+        """
+        Throws away everything that has not started being written yet,
+        a partially written chunk is kept so the stream stays framed
+        """
+
+        while len(self._write_buffer) > int(self._write_partial):
+            self._write_size -= len(self._write_buffer.pop())
+
+    def send(self, data):
+        if len(data) > 0xFFFF:
+            self.notify.warning('Cannot send datagram of size: %d to %r, '
+                'datagram is too large!' % (len(data), self._address))
+
+            return False
+
+        return self.write(struct.pack('<H', len(data)) + data)
+
+    def write(self, data):
+        """
+        Writes already framed data to the socket, whatever the socket
+        does not accept right away is written once it becomes writable
+        """
+
+        if not self._connected:
+            return False
+
+        self._write_buffer.append(data)
+        self._write_size += len(data)
+        if len(self._write_buffer) == 1:
+            self.handle_write()
+
+        if self._write_buffer:
+            event_loop.set_writable(self, True)
+
+        return True
+
+    def close(self):
+        if not self._connected:
+            return
+
+        # give whatever is still buffered one last chance to make it
+        # out, the socket may have room for it by now...
+        if self._write_buffer:
+            self.handle_write()
+            if not self._connected:
+                return
+
+        self._connected = False
+        event_loop.unregister(self)
+
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+        self._read_buffer = None
+        self._write_buffer.clear()
+        self._write_size = 0
+
+        # let the transport know this connection was reset, either because
+        # the stream has ended, an error occured or it was closed by us...
+        self._transport.handle_connection_reset(self)
+
+class NetworkSocketRendezvous(object):
+    """
+    A non-blocking TCP listening socket that accepts new stream connections
+    """
+
+    def __init__(self, transport, sock):
+        self._transport = transport
+        self._socket = sock
+        self._fileno = sock.fileno()
+
+        self._socket.setblocking(False)
+
+    def fileno(self):
+        return self._fileno
+
+    def handle_read(self):
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._transport.notify.warning('Failed to accept connection: %r!' % e)
+
+                return
+
+            self._transport.handle_socket_connection(self, sock, address)
+
+    def handle_write(self):
+        pass
+
+    def close(self):
+        event_loop.unregister(self)
+        self._socket.close()
+
+class NetworkOutputBuffer(object):
+    """
+    The framed datagrams written to a connection within a single frame
+    """
+
+    def __init__(self):
+        self._frames = []
+        self._size = 0
+
+    @property
+    def frames(self):
+        return self._frames
+
+    @property
+    def size(self):
+        return self._size
+
+    def append(self, frame):
+        self._frames.append(frame)
+        self._size += len(frame)
+
+    def get_data(self):
+        return ''.join(self._frames)
+
+    def clear(self):
+        self._frames = []
+        self._size = 0
+
+class NetworkTransport(object):
+    """
+    The socket layer used by the network connector and listener objects,
+    it opens connections, sends datagrams and hands any incoming datagrams
+    and connections back to it's owner through the callbacks given...
+    """
+
+    notify = notify.new_category('NetworkTransport')
+
+    def __init__(self, name, datagram_callback, disconnect_callback, connection_callback=None,
+        slow_callback=None, counters=None):
+
+        self._name = name
+        self._datagram_callback = datagram_callback
+        self._disconnect_callback = disconnect_callback
+        self._connection_callback = connection_callback
+        self._slow_callback = slow_callback
+        self._counters = counters or NetworkCounters(self.get_unique_name('transport'))
+
+        self._reset_connections = collections.deque()
+        self.__reset_task = None
+
+        self._coalesce_writes = config.GetBool('net-coalesce-writes', True)
+        self._high_water = config.GetInt('net-output-high-water', 8388608)
+        self._output_buffers = {}
+        self._dirty_buffers = []
+        self._slow_connections = set()
+        self.__flush_task = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def counters(self):
+        return self._counters
+
+    @property
+    def coalesce_writes(self):
+        return self._coalesce_writes
+
+    @property
+    def high_water(self):
+        return self._high_water
+
+    @high_water.setter
+    def high_water(self, high_water):
+        self._high_water = high_water
+
+    def get_unique_name(self, name):
+        return '%s-%s' % (self._name, name)
+
+    def send(self, datagram, connection):
+        """
+        Sends a datagram to the connection, when write coalescing is enabled the
+        datagram is framed into the connection's output buffer, which is written
+        in one go at the end of the frame
+        """
+
+        if not self._coalesce_writes:
+            self.write_datagram(datagram, connection)
+            self.check_high_water(connection, datagram.get_length())
+            return
+
+        data = datagram.get_message()
+        if len(data) > 0xFFFF:
+            self.notify.warning('Cannot send datagram of size: %d, '
+                'datagram is too large!' % len(data))
+
+            return
+
+        output_buffer = self._output_buffers.get(connection)
+        if output_buffer is None:
+            output_buffer = self._output_buffers[connection] = NetworkOutputBuffer()
+
+        if not output_buffer.frames:
+            self._dirty_buffers.append(connection)
+
+        output_buffer.append(struct.pack('<H', len(data)) + data)
+
+    def get_buffered_size(self, connection):
+        """
+        Returns the amount of bytes queued up for the connection,
+        that the other end has not received yet
+        """
+
+        output_buffer = self._output_buffers.get(connection)
+        size = output_buffer.size if output_buffer is not None else 0
+        return size + self.get_pending_size(connection)
+
+    def get_backlog_size(self, connection):
+        """
+        Returns the amount of bytes written to the connection that the other
+        end has not received yet, when that cannot be measured the output
+        waiting to be written is counted instead...
+        """
+
+        if self.can_measure_pending():
+            return self.get_pending_size(connection)
+
+        return self.get_buffered_size(connection)
+
+    def check_high_water(self, connection, written_size):
+        """
+        Reports the connection as a slow consumer once the output it has
+        not received yet goes over the high water mark, the output of the
+        current frame is not counted as it is yet to be written, unless
+        nothing else can be measured...
+        """
+
+        if self._high_water <= 0:
+            return
+
+        if self.can_measure_pending():
+            size = self.get_pending_size(connection)
+        else:
+            size = written_size
+
+        self._counters.update_max('peak-output-backlog', size)
+        if size <= self._high_water:
+            self._slow_connections.discard(connection)
+            return
+
+        if connection in self._slow_connections:
+            return
+
+        self._slow_connections.add(connection)
+        self._counters.increment('slow-consumers')
+        if self._slow_callback:
+            self._slow_callback(connection, size)
+
+    def flush(self):
+        """
+        Writes every connection's output buffer in a single write
+        """
+
+        dirty_buffers, self._dirty_buffers = self._dirty_buffers, []
+        for connection in dirty_buffers:
+            self.flush_connection(connection)
+
+    def flush_connection(self, connection):
+        """
+        Writes the connection's output buffer in a single write
+        """
+
+        output_buffer = self._output_buffers.get(connection)
+        if output_buffer is None or not output_buffer.frames:
+            return
+
+        self._counters.increment('flushes')
+        self._counters.increment('flushed-datagrams', len(output_buffer.frames))
+
+        data = output_buffer.get_data()
+        output_buffer.clear()
+        self.write(data, connection)
+
+        # whatever the connection has not received
+        # yet counts against the connection...
+        self.check_high_water(connection, len(data))
+
+    def __flush(self, task):
+        self.flush()
+        return task.cont
+
+    def discard_output(self, connection):
+        self._output_buffers.pop(connection, None)
+        self._slow_connections.discard(connection)
+
+    def discard_unsent(self, connection):
+        """
+        Throws away any output the connection has not started receiving yet
+        """
+
+        output_buffer = self._output_buffers.get(connection)
+        if output_buffer is not None:
+            output_buffer.clear()
+
+        self.discard_pending(connection)
+
+    def setup_output(self):
+        if not self._coalesce_writes:
+            return
+
+        self.__flush_task = task_mgr.add(self.__flush, self.get_unique_name('flush-output'),
+            sort=config.GetInt('net-flush-sort', 50))
+
+    def shutdown_output(self):
+        if self.__flush_task:
+            task_mgr.remove(self.__flush_task)
+
+        self.__flush_task = None
+        self._output_buffers = {}
+        self._dirty_buffers = []
+        self._slow_connections = set()
+
+    def handle_connection_reset(self, connection):
+        """
+        Queues a disconnect event for the connection, the event is handed to
+        the owner from a task so it is never handled from within a send or close call
+        """
+
+        self.discard_output(connection)
+        self._reset_connections.append(connection)
+        if not self.__reset_task:
+            self.__reset_task = task_mgr.add(self.__process_resets,
+                self.get_unique_name('process-resets'))
+
+    def __process_resets(self, task):
+        """
+        Hands all of the queued disconnect events to the owner
+        """
+
+        while self._reset_connections:
+            self._disconnect_callback(self._reset_connections.popleft())
+
+        self.__reset_task = None
+        return task.done
+
+    def shutdown_resets(self):
+        if self.__reset_task:
+            task_mgr.remove(self.__reset_task)
+
+        self.__reset_task = None
+        self._reset_connections.clear()
+
+    def connect(self, address, port, timeout):
+        """
+        Opens a client connection, returns None if the connection failed
+        """
+
+    def listen(self, address, port, backlog):
+        """
+        Opens a listening rendezvous socket, returns None if binding failed
+        """
+
+    def add_connection(self, connection):
+        """
+        Starts reading datagrams from the connection
+        """
+
+    def remove_connection(self, connection):
+        """
+        Stops reading datagrams from the connection
+        """
+
+    def is_connection_ok(self, connection):
+        """
+        Returns True if the connection is still open else False
+        """
+
+    def write_datagram(self, datagram, connection):
+        """
+        Sends a single datagram to the connection right away
+        """
+
+    def write(self, data, connection):
+        """
+        Writes already framed datagrams to the connection
+        """
+
+    def can_measure_pending(self):
+        """
+        Returns True if get_pending_size can tell how far
+        behind the connections are on this platform
+        """
+
+        return False
+
+    def get_pending_size(self, connection):
+        """
+        Returns the amount of bytes written to the connection
+        that the other end has not received yet
+        """
+
+        return 0
+
+    def discard_pending(self, connection):
+        """
+        Throws away the bytes the connection has accepted but not written yet
+        """
+
+    def close_connection(self, connection):
+        """
+        Closes the connection
+        """
+
+    def setup(self):
+        """
+        Starts handling incoming connections and datagrams
+        """
+
+    def shutdown(self):
+        """
+        Stops handling incoming connections and datagrams
+        """
+
+class NetworkPandaTransport(NetworkTransport):
+    """
+    A transport using panda's queued connection manager, which is polled every frame
+    """
+
+    def __init__(self, *args, **kwargs):
+        NetworkTransport.__init__(self, *args, **kwargs)
+
+        num_threads = 0
+        if config.GetBool('net-want-threads', False):
+            num_threads = 1
+
+        self._batch_drain = config.GetBool('net-batch-drain', False)
+
+        self.__manager = QueuedConnectionManager()
+        self.__listener = QueuedConnectionListener(self.__manager, num_threads)
+        self.__reader = QueuedConnectionReader(self.__manager, num_threads)
+        self.__writer = ConnectionWriter(self.__manager, num_threads)
+
+        # coalesced writes are framed by us, so the writer
+        # must not add it's own datagram headers...
+        self.__writer.set_raw_mode(self._coalesce_writes)
+
+        self.__rendezvous = None
+
+        self.__listen_task = None
+        self.__read_task = None
+
+    def connect(self, address, port, timeout):
+        connection = self.__manager.open_TCP_client_connection(address, port, timeout)
+        if connection:
+            self.__reader.add_connection(connection)
+
+        return connection
+
+    def listen(self, address, port, backlog):
+        self.__rendezvous = self.__manager.open_TCP_server_rendezvous(address, port, backlog)
+        if self.__rendezvous:
+            self.__listener.add_connection(self.__rendezvous)
+
+        return self.__rendezvous
+
+    def add_connection(self, connection):
+        self.__reader.add_connection(connection)
+
+    def remove_connection(self, connection):
+        self.__reader.remove_connection(connection)
+        self.discard_output(connection)
+
+    def is_connection_ok(self, connection):
+        return self.__reader.is_connection_ok(connection)
+
+    def write_datagram(self, datagram, connection):
+        self.__writer.send(datagram, connection)
+
+    def write(self, data, connection):
+        self.__writer.send(Datagram(data), connection)
+
+    def can_measure_pending(self):
+        return can_measure_socket_backlog()
+
+    def get_pending_size(self, connection):
+        # the writer hands everything to the socket right away, so
+        # the backlog is whatever sits in the socket's send queue...
+        return get_socket_backlog(connection.get_socket().GetSocket())
+
+    def close_connection(self, connection):
+        # anything sent right before closing, such as a disconnect
+        # reason, still has to make it out to the connection...
+        self.flush_connection(connection)
+        self.__manager.close_connection(connection)
+        self.handle_connection_reset(connection)
+
+    def setup(self):
+        if self._high_water > 0 and not self.can_measure_pending():
+            self.notify.warning('The socket send queue cannot be measured on this platform, '
+                'only a single frame\'s output is held against net-output-high-water, '
+                'use net-transport select to detect slow connections!')
+
+        if self.__rendezvous:
+            self.__listen_task = task_mgr.add(self.__listen_incoming,
+                self.get_unique_name('listen-incoming'))
+
+        self.__read_task = task_mgr.add(self.__read_incoming,
+            self.get_unique_name('read-incoming'))
+
+        self.setup_output()
+
+    def __listen_incoming(self, task):
+        """
+        Polls for incoming connections
+        """
+
+        if self.__listener.new_connection_available():
+            rendezvous = PointerToConnection()
+            address = NetAddress()
+            connection = PointerToConnection()
+
+            if self.__listener.get_new_connection(rendezvous, address, connection):
+                self._connection_callback(rendezvous, address, connection.p())
+
+        return task.cont
+
+    def __read_incoming(self, task):
+        """
+        Polls for incoming data, when batch draining is enabled
+        the reader is emptied every frame. Also picks up any connections
+        the manager has seen being reset by the reader or writer
+        """
+
+        while self.__reader.data_available():
+            datagram = NetworkDatagram()
+
+            if self.__reader.get_data(datagram):
+                self._datagram_callback(datagram, datagram.get_connection())
+
+            if not self._batch_drain:
+                break
+
+        while self.__manager.reset_connection_available():
+            connection = PointerToConnection()
+            if self.__manager.get_reset_connection(connection):
+                self.handle_connection_reset(connection.p())
+
+        return task.cont
+
+    def shutdown(self):
+        if self.__listen_task:
+            task_mgr.remove(self.__listen_task)
+
+        if self.__read_task:
+            task_mgr.remove(self.__read_task)
+
+        self.__listen_task = None
+        self.__read_task = None
+
+        if self.__rendezvous:
+            self.__listener.remove_connection(self.__rendezvous)
 
-class NetworkDatagramIterator(PyDatagramIterator):
+        self.__rendezvous = None
+        self.shutdown_resets()
+        self.shutdown_output()
+
+class NetworkSelectTransport(NetworkTransport):
     """
-    A class that inherits from panda's C++ DatagramIterator buffer.
-    This class adds useful methods and functions for talking
-    to the OTP's internal cluster participants...
+    A transport using non-blocking sockets watched by the network event loop,
+    datagrams are only read when a socket becomes readable instead of every frame
     """
 
-class NetworkDCLoader(object):
-    notify = notify.new_category('NetworkDCLoader')
+    def __init__(self, *args, **kwargs):
+        NetworkTransport.__init__(self, *args, **kwargs)
 
-    def __init__(self):
-        self._dc_file = DCFile()
-        self._dc_suffix = ''
+        self.__rendezvous = None
+        self.__connections = set()
 
-        self._dclasses_by_name = {}
-        self._dclasses_by_number = {}
+    def connect(self, address, port, timeout):
+        try:
+            sock = socket.create_connection((address, port), timeout / 1000.0)
+        except socket.error as e:
+            self.notify.warning('Failed to connect to <%s:%d>: %r!' % (address, port, e))
+            return None
 
-        self._hash_value = 0
+        connection = NetworkSocketConnection(self, sock, (address, port))
+        self.add_connection(connection)
+        return connection
 
-    @property
-    def dc_file(self):
-        return self._dc_file
+    def listen(self, address, port, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    @property
-    def dc_suffix(self):
-        return self._dc_suffix
+        try:
+            sock.bind((address, port))
+            sock.listen(min(backlog, socket.SOMAXCONN))
+        except socket.error as e:
+            self.notify.warning('Failed to bind <%s:%d>: %r!' % (address, port, e))
+            sock.close()
+            return None
+
+        self.__rendezvous = NetworkSocketRendezvous(self, sock)
+        return self.__rendezvous
+
+    def add_connection(self, connection):
+        if connection in self.__connections:
+            return
 
-    @property
-    def dclasses_by_name(self):
-        return self._dclasses_by_name
+        self.__connections.add(connection)
+        event_loop.register(connection)
 
-    @property
-    def dclasses_by_number(self):
-        return self._dclasses_by_number
+    def remove_connection(self, connection):
+        self.discard_output(connection)
+        if connection not in self.__connections:
+            return
 
-    @property
-    def hash_value(self):
-        return self._hash_value
+        self.__connections.remove(connection)
+        connection.close()
 
-    def read_dc_files(self, dc_file_names=None):
-        dc_imports = {}
-        if dc_file_names == None:
-            read_result = self._dc_file.read_all()
-            if not read_result:
-                self.notify.error('Could not read dc file.')
-        else:
-            for dc_fileName in dc_file_names:
-                pathname = Filename(dc_fileName)
-                read_result = self._dc_file.read(pathname)
-                if not read_result:
-                    self.notify.error('Could not read dc file: %s' % pathname)
+    def is_connection_ok(self, connection):
+        return connection.connected
 
-        self._hash_value = self._dc_file.get_hash()
+    def write_datagram(self, datagram, connection):
+        connection.send(datagram.get_message())
 
-        # Now get the class definition for the classes named in the DC
-        # file.
-        for i in range(self._dc_file.get_num_classes()):
-            dclass = self._dc_file.get_class(i)
-            number = dclass.get_number()
-            class_name = dclass.get_name() + self._dc_suffix 
+    def write(self, data, connection):
+        connection.write(data)
 
-            # Does the class have a definition defined in the newly
-            # imported namespace?
-            class_def = dc_imports.get(class_name)
+    def can_measure_pending(self):
+        # whatever the socket does not accept is kept in our own buffer,
+        # so a connection falling behind shows even without the send queue
+        return True
 
-            # Also try it without the dc_suffix.
-            if class_def == None:
-                class_name = dclass.get_name()
-                class_def = dc_imports.get(class_name)
+    def get_pending_size(self, connection):
+        return connection.get_pending_size() + get_socket_backlog(connection.fileno())
 
-            if class_def == None:
-                self.notify.debug('No class definition for %s.' % class_name)
-            else:
-                if inspect.ismodule(class_def):
-                    if not hasattr(class_def, class_name):
-                        self.notify.error('Module %s does not define class %s.' % (
-                            class_name, class_name))
+    def discard_pending(self, connection):
+        connection.discard_unsent()
 
-                    class_def = getattr(class_def, class_name)
+    def close_connection(self, connection):
+        self.flush_connection(connection)
+        connection.close()
 
-                if not inspect.isclass(class_def):
-                    self.notify.error('Symbol %s is not a class name.' % class_name)
-                else:
-                    dclass.set_class_def(class_def)
+    def handle_socket_connection(self, rendezvous, sock, address):
+        net_address = NetAddress()
+        net_address.set_host(address[0], address[1])
 
-            self._dclasses_by_name[class_name] = dclass
-            if number >= 0:
-                self._dclasses_by_number[number] = dclass
+        connection = NetworkSocketConnection(self, sock, address)
+        self._connection_callback(rendezvous, net_address, connection)
+
+    def handle_socket_data(self, data, connection):
+        self._datagram_callback(NetworkDatagram(Datagram(data)), connection)
+
+    def setup(self):
+        if self.__rendezvous:
+            event_loop.register(self.__rendezvous)
+
+        self.setup_output()
+
+    def shutdown(self):
+        if self.__rendezvous:
+            self.__rendezvous.close()
+
+        self.__rendezvous = None
+        self.shutdown_resets()
+        self.shutdown_output()
+
+def create_transport(name, datagram_callback, disconnect_callback, connection_callback=None,
+    slow_callback=None, counters=None):
+    """
+    Creates the transport selected by the net-transport config variable
+    """
+
+    transport_type = config.GetString('net-transport', 'panda')
+    if transport_type == 'select':
+        return NetworkSelectTransport(name, datagram_callback, disconnect_callback,
+            connection_callback, slow_callback, counters)
+    elif transport_type != 'panda':
+        raise NetworkError('Unknown network transport: %s!' % transport_type)
+
+    return NetworkPandaTransport(name, datagram_callback, disconnect_callback,
+        connection_callback, slow_callback, counters)
+
+def run():
+    """
+    Runs either the network event loop or the task manager,
+    depending on which transport has been selected
+    """
+
+    if config.GetString('net-transport', 'panda') == 'select':
+        event_loop.run()
+    else:
+        task_mgr.run()
 
 class NetworkManager(object):
     notify = notify.new_category('NetworkManager')
@@ -149,6 +1669,10 @@ class NetworkManager(object):
 class NetworkConnector(NetworkManager):
     notify = notify.new_category('NetworkConnector')
 
+    # the most channels registered by a single control message, so the
+    # datagram stays well within the 64k limit of a framed datagram...
+    MAX_CONTROL_CHANNELS = 4096
+
     def __init__(self, dc_loader, address, port, channel, timeout=5000):
         NetworkManager.__init__(self)
 
@@ -158,26 +1682,29 @@ class NetworkConnector(NetworkManager):
         self._channel = channel
         self.__timeout = timeout
 
-        num_threads = 0
-        if config.GetBool('net-want-threads', False):
-            num_threads = 1
-
-        self.__manager = QueuedConnectionManager()
-        self.__reader = QueuedConnectionReader(self.__manager, num_threads)
-        self.__writer = ConnectionWriter(self.__manager, num_threads)
+        self.__counters = NetworkCounters(self.get_unique_name('connector'))
+        self.__transport = create_transport(self.get_unique_name('connector'),
+            self.__handle_incoming_data, self.__handle_connection_reset,
+            slow_callback=self.__handle_slow_connection, counters=self.__counters)
 
         self.__socket = None
+        self.__disconnected = False
         self._readable = collections.deque()
         self._read_mutex = threading.RLock()
 
-        self.__read_task = None
+        self.__read_budget = NetworkReadBudget()
+
         self.__update_task = None
-        self.__disconnect_task = None
+        self.__sweep_task = None
 
     @property
     def dc_loader(self):
         return self._dc_loader
 
+    @property
+    def connector_counters(self):
+        return self.__counters
+
     @property
     def channel(self):
         return self._channel
@@ -187,24 +1714,30 @@ class NetworkConnector(NetworkManager):
         self._channel = channel
 
     def setup(self):
-        self.__socket = self.__manager.open_TCP_client_connection(self.__address,
+        start_time = time.time()
+        self.__socket = self.__transport.connect(self.__address,
             self.__port, self.__timeout)
 
+        startup_timer.record('%s connect' % self.__class__.__name__, start_time)
+
         if not self.__socket:
             raise NetworkError('Failed to connect TCP socket on address: <%s:%d>!' % (
                 self.__address, self.__port))
 
-        self.__reader.add_connection(self.__socket)
-        self.register_for_channel(self._channel)
+        if self._channel:
+            self.register_for_channel(self._channel)
 
-        self.__read_task = task_mgr.add(self.__read_incoming,
-            self.get_unique_name('read-incoming'))
+        self.__transport.setup()
 
         self.__update_task = task_mgr.add(self.__update,
             self.get_unique_name('update-handler'))
 
-        self.__disconnect_task = task_mgr.add(self.__listen_disconnect,
-            self.get_unique_name('listen-disconnect'))
+        sweep_interval = config.GetFloat('net-disconnect-sweep-interval', 0.0)
+        if sweep_interval > 0:
+            self.__sweep_task = task_mgr.doMethodLater(sweep_interval,
+                self.__sweep_disconnect, self.get_unique_name('sweep-disconnect'))
+
+        self.__counters.setup()
 
     def register_for_channel(self, channel):
         """
@@ -215,6 +1748,24 @@ class NetworkConnector(NetworkManager):
         datagram.add_control_header(channel, types.CONTROL_SET_CHANNEL)
         self.handle_send_connection_datagram(datagram)
 
+    def register_for_channels(self, channels):
+        """
+        Registers many channels with the MessageDirector, sending a single
+        control message for every few thousand channels rather than one each...
+        """
+
+        channels = list(channels)
+        for index in xrange(0, len(channels), self.MAX_CONTROL_CHANNELS):
+            chunk = channels[index:index + self.MAX_CONTROL_CHANNELS]
+
+            datagram = NetworkDatagram()
+            datagram.add_control_header(self._channel, types.CONTROL_SET_CHANNELS)
+            datagram.add_uint16(len(chunk))
+            for channel in chunk:
+                datagram.add_uint64(channel)
+
+            self.handle_send_connection_datagram(datagram)
+
     def unregister_for_channel(self, channel):
         """
         Unregisters our connections channel from the MessageDirector
@@ -224,60 +1775,101 @@ class NetworkConnector(NetworkManager):
         datagram.add_control_header(channel, types.CONTROL_REMOVE_CHANNEL)
         self.handle_send_connection_datagram(datagram)
 
-    def __read_incoming(self, task):
+    def register_for_range(self, lo_channel, hi_channel):
         """
-        Polls for incoming data
+        Registers a range of channels with the MessageDirector
         """
 
-        if self.__reader.data_available():
-            datagram = NetworkDatagram()
+        datagram = NetworkDatagram()
+        datagram.add_control_header(lo_channel, types.CONTROL_ADD_RANGE)
+        datagram.add_uint64(hi_channel)
+        self.handle_send_connection_datagram(datagram)
 
-            if self.__reader.get_data(datagram):
-                self.__handle_incoming_data(datagram)
+    def unregister_for_range(self, lo_channel, hi_channel):
+        """
+        Unregisters a range of channels from the MessageDirector
+        """
 
-        return task.cont
+        datagram = NetworkDatagram()
+        datagram.add_control_header(lo_channel, types.CONTROL_REMOVE_RANGE)
+        datagram.add_uint64(hi_channel)
+        self.handle_send_connection_datagram(datagram)
 
     def __update(self, task):
         """
-        Gets a datagram from the queue and handles it
+        Gets datagrams from the queue and handles them,
+        until the read budget for this frame has been exhausted
         """
 
-        if not len(self._readable):
-            return task.cont
+        self.__counters.update_max('peak-backlog', len(self._readable))
+        self.__read_budget.begin()
 
-        datagram = self._readable.popleft()
-        di = NetworkDatagramIterator(datagram)
-        if not di.get_remaining_size():
-            return task.cont
+        while len(self._readable):
+            if self.__read_budget.is_exhausted():
+                self.__counters.increment('budget-exhausted')
+                break
 
-        with self._read_mutex:
-            self.handle_internal_datagram(di)
+            datagram = self._readable.popleft()
+            self.__read_budget.consume()
 
+            di = NetworkDatagramIterator(datagram)
+            if not di.get_remaining_size():
+                continue
+
+            with self._read_mutex:
+                self.handle_internal_datagram(di)
+
+            self.__counters.increment('dispatched')
+
+        self.__counters.set('backlog', len(self._readable))
         return task.cont
 
-    def __listen_disconnect(self, task):
+    def __sweep_disconnect(self, task):
         """
-        Watches our connected socket object and determines if the stream has ended..
+        Periodically checks our connected socket object in case the transport
+        never reported the stream as ended...
         """
 
-        if not self.__reader.is_connection_ok(self.__socket):
-            self.handle_disconnected()
+        if not self.__transport.is_connection_ok(self.__socket):
+            self.__handle_connection_reset(self.__socket)
             return task.done
 
-        return task.cont
+        return task.again
+
+    def __handle_connection_reset(self, connection):
+        """
+        Handles the transport reporting that our connection has been reset
+        """
+
+        if self.__disconnected:
+            return
+
+        self.__disconnected = True
+        self.__counters.increment('disconnects')
+        self.handle_disconnected()
+
+    def __handle_slow_connection(self, connection, size):
+        """
+        Handles the transport reporting that our output is not being
+        read fast enough by the other end
+        """
+
+        self.notify.warning('Connection to <%s:%d> is not keeping up, '
+            '%d bytes are waiting to be sent!' % (self.__address, self.__port, size))
 
-    def __handle_incoming_data(self, datagram):
+    def __handle_incoming_data(self, datagram, connection):
         """
         Handles incoming data from the connector
         """
 
         self._readable.append(datagram)
+        self.__counters.increment('read')
 
     def handle_send_connection_datagram(self, datagram):
         """
         Sends a datagram to our connection
         """
-        self.__writer.send(datagram, self.__socket)
+        self.__transport.send(datagram, self.__socket)
 
     def handle_internal_datagram(self, di):
         """
@@ -285,7 +1877,21 @@ class NetworkConnector(NetworkManager):
         """
 
         code = di.get_uint8()
-        self.handle_datagram(di.get_uint64(), di.get_uint64(), di.get_uint16(), di)
+        if code == 1:
+            self.handle_datagram(di.get_uint64(), di.get_uint64(), di.get_uint16(), di)
+            return
+
+        # the message was addressed to several of our channels at once,
+        # every channel gets it's own iterator over the same message...
+        channels = [di.get_uint64() for _ in xrange(code)]
+        sender = di.get_uint64()
+        message_type = di.get_uint16()
+
+        datagram = di.get_source_datagram()
+        offset = di.get_current_index()
+        for channel in channels:
+            self.handle_datagram(channel, sender, message_type,
+                NetworkDatagramIterator(datagram, offset))
 
     def handle_datagram(self, channel, sender, message_type, di):
         """
@@ -297,29 +1903,31 @@ class NetworkConnector(NetworkManager):
         Disconnects our client socket instance
         """
 
-        self.__manager.close_connection(self.__socket)
+        self.__transport.close_connection(self.__socket)
 
     def handle_disconnected(self):
         """
         Handles disconnection when the socket connection closes
         """
 
-        self.unregister_for_channel(self._channel)
-        self.__reader.remove_connection(self.__socket)
+        if self._channel:
+            self.unregister_for_channel(self._channel)
+
+        self.__transport.remove_connection(self.__socket)
 
     def shutdown(self):
-        if self.__read_task:
-            task_mgr.remove(self.__read_task)
+        self.__transport.shutdown()
 
         if self.__update_task:
             task_mgr.remove(self.__update_task)
 
-        if self.__disconnect_task:
-            task_mgr.remove(self.__disconnect_task)
+        if self.__sweep_task:
+            task_mgr.remove(self.__sweep_task)
 
-        self.__read_task = None
         self.__update_task = None
-        self.__disconnect_task = None
+        self.__sweep_task = None
+
+        self.__counters.shutdown()
 
 class NetworkHandler(NetworkManager):
     notify = notify.new_category('NetworkHandler')
@@ -334,8 +1942,7 @@ class NetworkHandler(NetworkManager):
 
         self._readable = collections.deque()
         self._read_mutex = threading.RLock()
-
-        self.__update_task = None
+        self._ready = False
 
     @property
     def network(self):
@@ -372,10 +1979,11 @@ class NetworkHandler(NetworkManager):
     def allocated_channel(self, allocated_channel):
         self._allocated_channel = allocated_channel
 
-    def setup(self):
-        self.__update_task = task_mgr.add(self.__update,
-            self.get_unique_name('update-handler'))
+    @property
+    def ready(self):
+        return self._ready
 
+    def setup(self):
         if self._channel:
             self.register_for_channel(self._channel)
 
@@ -410,23 +2018,26 @@ class NetworkHandler(NetworkManager):
         self._channel = channel
         self.register_for_channel(channel)
 
-    def __update(self, task):
+    def handle_ready_datagrams(self, quantum):
         """
-        Gets a datagram from the queue and handles it
+        Gets up to quantum datagrams from the queue and handles them,
+        returns the amount of datagrams that were pulled from the queue
         """
 
-        if not len(self._readable):
-            return task.cont
+        handled = 0
+        while handled < quantum and len(self._readable):
+            datagram = self._readable.popleft()
+            handled += 1
 
-        datagram = self._readable.popleft()
-        di = NetworkDatagramIterator(datagram)
-        if not di.get_remaining_size():
-            return task.cont
+            di = NetworkDatagramIterator(datagram)
+            if not di.get_remaining_size():
+                continue
 
-        with self._read_mutex:
-            self.handle_datagram(di)
+            with self._read_mutex:
+                self.handle_datagram(di)
 
-        return task.cont
+        self._ready = len(self._readable) > 0
+        return handled
 
     def handle_send_datagram(self, datagram):
         """
@@ -435,12 +2046,42 @@ class NetworkHandler(NetworkManager):
 
         self._network.handle_send_datagram(datagram, self._connection)
 
+    def get_buffer_size(self):
+        """
+        Returns the amount of bytes waiting to be sent to our connection
+        """
+
+        return self._network.get_connection_buffer_size(self._connection)
+
+    def get_backlog_size(self):
+        """
+        Returns the amount of bytes written to our connection that it has
+        not received yet, excluding this frame's output unless the transport
+        cannot measure anything else
+        """
+
+        return self._network.get_connection_backlog_size(self._connection)
+
+    def handle_slow_connection(self, size):
+        """
+        Handles our connection not reading it's output fast enough, the
+        slow consumer is only reported, handlers that would rather drop
+        the connection override this...
+        """
+
+        self.notify.warning('Slow connection: %r, %d bytes are '
+            'waiting to be sent!' % (self._address, size))
+
     def handle_incoming_data(self, datagram):
         """
-        Puts an incoming datagram in the data queue
+        Puts an incoming datagram in the data queue, and lets the network
+        know we have datagrams waiting to be handled
         """
 
         self._readable.append(datagram)
+        if not self._ready:
+            self._ready = True
+            self._network.handle_ready_handler(self)
 
     def handle_datagram(self, di):
         """
@@ -468,10 +2109,8 @@ class NetworkHandler(NetworkManager):
         if self._channel:
             self.unregister_for_channel(self._channel)
 
-        if self.__update_task:
-            task_mgr.remove(self.__update_task)
-
-        self.__update_task = None
+        self._readable.clear()
+        self._ready = False
 
 class NetworkListener(NetworkManager):
     notify = notify.new_category('NetworkListener')
@@ -484,84 +2123,146 @@ class NetworkListener(NetworkManager):
         self.__handler = handler
         self.__backlog = backlog
 
-        num_threads = 0
-        if config.GetBool('net-want-threads', False):
-            num_threads = 1
-
-        self.__manager = QueuedConnectionManager()
-        self.__listener = QueuedConnectionListener(self.__manager, num_threads)
-        self.__reader = QueuedConnectionReader(self.__manager, num_threads)
-        self.__writer = ConnectionWriter(self.__manager, num_threads)
+        self.__counters = NetworkCounters(self.get_unique_name('listener'))
+        self.__transport = create_transport(self.get_unique_name('listener'),
+            self.__handle_incoming_data, self.__handle_connection_reset,
+            self.handle_incoming_connection, self.__handle_slow_connection,
+            self.__counters)
 
         self.__socket = None
         self._handlers = {}
         self._channel2handlers = {}
 
-        self.__listen_task = None
-        self.__read_task = None
-        self.__disconnect_task = None
+        self._ready_handlers = collections.deque()
+        self.__dispatch_budget = NetworkReadBudget()
+        self.__dispatch_quantum = config.GetInt('net-handler-quantum', 16)
+
+        self.__dispatch_task = None
+        self.__sweep_task = None
+
+    @property
+    def listener_counters(self):
+        return self.__counters
+
+    @property
+    def output_high_water(self):
+        return self.__transport.high_water
+
+    @output_high_water.setter
+    def output_high_water(self, output_high_water):
+        self.__transport.high_water = output_high_water
 
     def setup(self):
-        self.__socket = self.__manager.open_TCP_server_rendezvous(self.__address,
+        start_time = time.time()
+        self.__socket = self.__transport.listen(self.__address,
             self.__port, self.__backlog)
 
+        startup_timer.record('%s bind' % self.__class__.__name__, start_time)
+
         if not self.__socket:
             raise NetworkError('Failed to bind TCP socket on address: <%s:%d>!' % (
                 self.__address, self.__port))
 
-        self.__listener.add_connection(self.__socket)
+        self.__transport.setup()
 
-        self.__listen_task = task_mgr.add(self.__listen_incoming,
-            self.get_unique_name('listen-incoming'))
+        self.__dispatch_task = task_mgr.add(self.__dispatch,
+            self.get_unique_name('dispatch-handlers'))
 
-        self.__read_task = task_mgr.add(self.__read_incoming,
-            self.get_unique_name('read-incoming'))
+        sweep_interval = config.GetFloat('net-disconnect-sweep-interval', 0.0)
+        if sweep_interval > 0:
+            self.__sweep_task = task_mgr.doMethodLater(sweep_interval,
+                self.__sweep_disconnect, self.get_unique_name('sweep-disconnect'))
 
-        self.__disconnect_task = task_mgr.add(self.__listen_disconnect,
-            self.get_unique_name('listen-disconnect'))
+        self.__counters.setup()
 
-    def __listen_incoming(self, task):
+    def handle_ready_handler(self, handler):
         """
-        Polls for incoming connections
+        Queues a handler that has datagrams waiting to be handled
         """
 
-        if self.__listener.new_connection_available():
-            rendezvous = PointerToConnection()
-            address = NetAddress()
-            connection = PointerToConnection()
+        self._ready_handlers.append(handler)
 
-            if self.__listener.get_new_connection(rendezvous, address, connection):
-                self.handle_incoming_connection(rendezvous, address, connection.p())
+    def __dispatch(self, task):
+        """
+        Handles the datagrams of every ready handler in round-robin order,
+        each handler gets to handle up to a quantum of datagrams before
+        being queued again behind the other ready handlers. Idle handlers
+        are never queued, so they cost nothing per frame...
+        """
+
+        if not self._ready_handlers:
+            return task.cont
+
+        # when batch draining is disabled, every handler may only
+        # handle a single datagram per frame...
+        batch_drain = self.__dispatch_budget.batch_drain
+        quantum = self.__dispatch_quantum if batch_drain else 1
+
+        self.__counters.update_max('peak-ready-handlers', len(self._ready_handlers))
+        self.__dispatch_budget.begin()
+
+        num_handlers = len(self._ready_handlers)
+        while self._ready_handlers:
+            if batch_drain:
+                if self.__dispatch_budget.is_exhausted():
+                    self.__counters.increment('budget-exhausted')
+                    break
+            elif not num_handlers:
+                break
+
+            handler = self._ready_handlers.popleft()
+            num_handlers -= 1
+
+            # the handler may have been removed while it was waiting...
+            if not handler.ready:
+                continue
 
+            handled = handler.handle_ready_datagrams(quantum)
+            if handler.ready:
+                self._ready_handlers.append(handler)
+
+            self.__dispatch_budget.consume(handled)
+            self.__counters.increment('dispatched', handled)
+
+        self.__counters.set('ready-handlers', len(self._ready_handlers))
         return task.cont
 
-    def __read_incoming(self, task):
+    def __sweep_disconnect(self, task):
         """
-        Polls for incoming data
+        Periodically checks all connected socket objects in case the transport
+        never reported one of their streams as ended...
         """
 
-        if self.__reader.data_available():
-            datagram = NetworkDatagram()
+        for handler in list(self._handlers.values()):
+            if not self.__transport.is_connection_ok(handler.connection):
+                self.__handle_connection_reset(handler.connection)
 
-            if self.__reader.get_data(datagram):
-                self.__handle_incoming_data(datagram, datagram.get_connection())
+        return task.again
 
-        return task.cont
+    def __handle_connection_reset(self, connection):
+        """
+        Handles the transport reporting that a connection has been reset,
+        only the handler owning that connection is notified
+        """
 
-    def __listen_disconnect(self, task):
+        handler = self._handlers.get(connection)
+        if not handler:
+            return
+
+        self.__counters.increment('disconnects')
+        handler.handle_disconnected()
+
+    def __handle_slow_connection(self, connection, size):
         """
-        Watches all connected socket objects and determines if the stream has ended...
+        Handles the transport reporting that a connection is not reading
+        it's output fast enough, the handler decides what to do about it
         """
-        
-        #?
-        try:
-            for handler in self._handlers.values():
-                if not self.__reader.is_connection_ok(handler.connection):
-                    handler.handle_disconnected()
-        except:
-            pass
 
-        return task.cont
+        handler = self._handlers.get(connection)
+        if not handler:
+            return
+
+        handler.handle_slow_connection(size)
 
     def has_handler(self, connection):
         """
@@ -578,7 +2279,7 @@ class NetworkListener(NetworkManager):
         if self.has_handler(handler.connection):
             return
 
-        self.__reader.add_connection(handler.connection)
+        self.__transport.add_connection(handler.connection)
         self._handlers[handler.connection] = handler
         handler.setup()
 
@@ -591,7 +2292,7 @@ class NetworkListener(NetworkManager):
             return
 
         handler.shutdown()
-        self.__reader.remove_connection(handler.connection)
+        self.__transport.remove_connection(handler.connection)
         del self._handlers[handler.connection]
 
     def handle_incoming_connection(self, rendezvous, address, connection):
@@ -611,6 +2312,7 @@ class NetworkListener(NetworkManager):
             return
 
         self._handlers[connection].handle_incoming_data(datagram)
+        self.__counters.increment('read')
 
     def has_channel_to_handler(self, channel):
         """
@@ -654,14 +2356,44 @@ class NetworkListener(NetworkManager):
         if not self.has_handler(connection):
             return
 
-        self.__writer.send(datagram, connection)
+        self.__transport.send(datagram, connection)
+
+    def get_connection_buffer_size(self, connection):
+        """
+        Returns the amount of bytes waiting to be sent to a specific connection
+        """
+
+        return self.__transport.get_buffered_size(connection)
+
+    def can_measure_connection_backlog(self):
+        """
+        Returns False if the backlog of a connection is only
+        the output that is waiting to be written
+        """
+
+        return self.__transport.can_measure_pending()
+
+    def get_connection_backlog_size(self, connection):
+        """
+        Returns the amount of bytes written to a specific connection
+        that it has not received yet
+        """
+
+        return self.__transport.get_backlog_size(connection)
+
+    def discard_connection_buffer(self, connection):
+        """
+        Throws away the bytes waiting to be sent to a specific connection
+        """
+
+        self.__transport.discard_unsent(connection)
 
     def handle_disconnect(self, handler):
         """
         Disconnects the handlers client socket instance
         """
 
-        self.__manager.close_connection(handler.connection)
+        self.__transport.close_connection(handler.connection)
 
     def handle_disconnected(self, handler):
         """
@@ -671,17 +2403,16 @@ class NetworkListener(NetworkManager):
         self.remove_handler(handler)
 
     def shutdown(self):
-        if self.__listen_task:
-            task_mgr.remove(self.__listen_task)
+        if self.__dispatch_task:
+            task_mgr.remove(self.__dispatch_task)
 
-        if self.__read_task:
-            task_mgr.remove(self.__read_task)
+        if self.__sweep_task:
+            task_mgr.remove(self.__sweep_task)
 
-        if self.__disconnect_task:
-            task_mgr.remove(self.__disconnect_task)
+        self.__dispatch_task = None
+        self.__sweep_task = None
 
-        self.__listen_task = None
-        self.__read_task = None
-        self.__disconnect_task = None
+        self._ready_handlers.clear()
 
-        self.__listener.remove_connection(self.__socket)
+        self.__counters.shutdown()
+        self.__transport.shutdown()
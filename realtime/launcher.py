@@ -0,0 +1,239 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+from realtime.notifier import notify
+
+class LauncherProcess(object):
+    """
+    A single component running in it's own OS process, the output of the
+    process is read on a separate thread and handed to the launcher...
+    """
+
+    notify = notify.new_category('LauncherProcess')
+
+    def __init__(self, launcher, name, args):
+        self._launcher = launcher
+        self._name = name
+        self._args = args
+
+        self._process = None
+        self._reader = None
+        self._restarts = 0
+        self._restart_time = 0
+        self._start_time = 0
+        self._failures = 0
+        self._abandoned = False
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def args(self):
+        return self._args
+
+    @property
+    def process(self):
+        return self._process
+
+    @property
+    def restarts(self):
+        return self._restarts
+
+    @property
+    def abandoned(self):
+        return self._abandoned
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        self.notify.info('Starting process: %s...' % self._name)
+
+        self._start_time = time.time()
+
+        self._process = subprocess.Popen([sys.executable, '-u', '-m', 'realtime.main'] + self._args,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1)
+
+        self._reader = threading.Thread(target=self.__read_output,
+            args=(self._process.stdout,), name='%s-output' % self._name)
+
+        self._reader.daemon = True
+        self._reader.start()
+
+    def __read_output(self, output):
+        for line in iter(output.readline, ''):
+            self._launcher.handle_output(self, line.rstrip())
+
+        output.close()
+
+    def poll(self, now):
+        """
+        Restarts the process once it has exited and the restart delay has passed,
+        the delay doubles every time the process exits again before it has run for
+        the maximum delay, returns False if the process is not running...
+        """
+
+        if self.running:
+            return True
+
+        if self._abandoned:
+            return False
+
+        if not self._restart_time:
+            self.notify.warning('Process: %s exited with code: %r!' % (
+                self._name, self._process.returncode))
+
+            if now - self._start_time >= self._launcher.restart_max_delay:
+                self._failures = 0
+
+            self._failures += 1
+            max_restarts = self._launcher.max_restarts
+            if max_restarts and self._failures > max_restarts:
+                self.notify.warning('Process: %s exited %d times in a row, '
+                    'it will not be restarted!' % (self._name, self._failures))
+
+                self._abandoned = True
+                return False
+
+            self._restart_time = now + min(self._launcher.restart_delay * (
+                2 ** (self._failures - 1)), self._launcher.restart_max_delay)
+
+            return False
+
+        if now < self._restart_time:
+            return False
+
+        self._restart_time = 0
+        self._restarts += 1
+        self.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.notify.info('Stopping process: %s...' % self._name)
+        self._process.terminate()
+
+    def wait(self):
+        if self._process is not None:
+            self._process.wait()
+
+        if self._reader is not None:
+            self._reader.join(1.0)
+
+class Launcher(object):
+    """
+    Runs each component in a separate OS process, so that a component
+    blocking on I/O or the GIL cannot stall the others, the processes
+    are restarted when they exit and their logs are aggregated...
+    """
+
+    notify = notify.new_category('Launcher')
+
+    def __init__(self):
+        self._processes = []
+        self._output = Queue.Queue()
+
+        self._start_delay = config.GetFloat('launcher-start-delay', 1.0)
+        self._restart_delay = config.GetFloat('launcher-restart-delay', 2.0)
+        self._restart_max_delay = max(config.GetFloat('launcher-restart-max-delay', 60.0),
+            self._restart_delay)
+
+        self._max_restarts = config.GetInt('launcher-max-restarts', 10)
+        self._poll_interval = config.GetFloat('launcher-poll-interval', 0.1)
+
+        log_filename = config.GetString('launcher-log-file', '')
+        self._log_file = open(log_filename, 'a') if log_filename else None
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @property
+    def restart_delay(self):
+        return self._restart_delay
+
+    @property
+    def restart_max_delay(self):
+        return self._restart_max_delay
+
+    @property
+    def max_restarts(self):
+        return self._max_restarts
+
+    def add_process(self, name, args):
+        process = LauncherProcess(self, name, args)
+        self._processes.append(process)
+        return process
+
+    def handle_output(self, process, line):
+        """
+        Called from the output reader threads, the lines are
+        written out by the launcher's own thread...
+        """
+
+        self._output.put('[%s] %s' % (process.name, line))
+
+    def __flush_output(self):
+        while True:
+            try:
+                line = self._output.get_nowait()
+            except Queue.Empty:
+                break
+
+            print line
+            if self._log_file:
+                self._log_file.write(line + '\n')
+
+        sys.stdout.flush()
+        if self._log_file:
+            self._log_file.flush()
+
+    def run(self, first_count=0):
+        """
+        Starts every process and supervises them until interrupted, the first
+        processes are given a head start so the others can connect to them...
+        """
+
+        for index, process in enumerate(self._processes):
+            if index and index == first_count:
+                time.sleep(self._start_delay)
+
+            process.start()
+
+        try:
+            while True:
+                now = time.time()
+                for process in self._processes:
+                    process.poll(now)
+
+                self.__flush_output()
+                time.sleep(self._poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+        self.shutdown()
+
+    def shutdown(self):
+        for process in self._processes:
+            process.stop()
+
+        for process in self._processes:
+            process.wait()
+
+        self.__flush_output()
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
@@ -5,7 +5,9 @@
 """
 
 import __builtin__
+import argparse
 import os
+import time
 
 from panda3d.core import loadPrcFile, VirtualFileSystem
 
@@ -22,17 +24,21 @@ __builtin__.task_mgr = task_mgr
 __builtin__.vfs = VirtualFileSystem.get_global_ptr()
 
 from realtime import io, types, clientagent, messagedirector, \
-    stateserver, database
+    stateserver, database, launcher
 
 notify = notify.new_category('Main')
 
+COMPONENTS = ('messagedirector', 'clientagent', 'stateserver', 'database')
+
 def setup_component(cls, *args, **kwargs):
     notify.info('Starting component: %s...' % (
         cls.__name__))
 
+    start_time = time.time()
     component = cls(*args, **kwargs)
     component.setup()
 
+    io.startup_timer.record('%s setup' % cls.__name__, start_time)
     return component
 
 def shutdown_component(component):
@@ -41,46 +47,145 @@ def shutdown_component(component):
 
     component.shutdown()
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description='Runs the OTP server components.')
+    parser.add_argument('--launch', action='store_true',
+        help='run every component in a separate, supervised process')
+    parser.add_argument('--component', choices=COMPONENTS, default=None,
+        help='only run this component')
+    parser.add_argument('--md-node', type=int, default=None,
+        help='only run the message director node with this id, '
+            'as listed in the messagedirector-nodes config variable')
+
+    return parser.parse_args()
+
+def load_dc_files():
+    start_time = time.time()
     dc_loader = io.NetworkDCLoader()
     dc_loader.read_dc_files(['../ToontownOnline/etc/otp.dc', '../ToontownOnline/etc/toon.dc'])
 
+    io.startup_timer.record('dc cache load' if dc_loader.cache_loaded else 'dc parse',
+        start_time)
+
+    return dc_loader
+
+def create_message_director(node_id=None):
     message_director_address = config.GetString('messagedirector-address', '0.0.0.0')
     message_director_port = config.GetInt('messagedirector-port', 7100)
 
+    if node_id is not None:
+        nodes = messagedirector.get_node_addresses()
+        if node_id < 0 or node_id >= len(nodes):
+            notify.error('Cannot run message director node: %d, only %d nodes '
+                'are configured!' % (node_id, len(nodes)))
+
+            return None
+
+        message_director_port = nodes[node_id][1]
+
+    return setup_component(messagedirector.MessageDirector, message_director_address,
+        message_director_port, node_id)
+
+def create_client_agent(dc_loader):
+    message_director_port = config.GetInt('messagedirector-port', 7100)
+
     client_agent_address = config.GetString('clientagent-address', '0.0.0.0')
     client_agent_port = config.GetInt('clientagent-port', 6667)
     client_agent_connect_address = config.GetString('database-connect-address', '127.0.0.1')
     client_agent_connect_port = config.GetInt('database-connect-port', message_director_port)
     client_agent_channel = config.GetInt('clientagent-channel', types.CLIENTAGENT_CHANNEL)
 
+    return setup_component(clientagent.ClientAgent, dc_loader, client_agent_address,
+        client_agent_port, client_agent_connect_address, client_agent_connect_port,
+        client_agent_channel)
+
+def create_state_server(dc_loader):
+    message_director_port = config.GetInt('messagedirector-port', 7100)
+
     state_server_connect_address = config.GetString('stateserver-connect-address', '127.0.0.1')
     state_server_connect_port = config.GetInt('stateserver-connect-port', message_director_port)
     state_server_channel = config.GetInt('stateserver-channel', types.STATESERVER_CHANNEL)
 
+    return setup_component(stateserver.StateServer, dc_loader, state_server_connect_address,
+        state_server_connect_port, state_server_channel)
+
+def create_database_server(dc_loader):
+    message_director_port = config.GetInt('messagedirector-port', 7100)
+
     database_connect_address = config.GetString('database-connect-address', '127.0.0.1')
     database_connect_port = config.GetInt('database-connect-port', message_director_port)
     database_channel = config.GetInt('database-channel', types.DATABASE_CHANNEL)
 
-    message_director = setup_component(messagedirector.MessageDirector, message_director_address,
-        message_director_port)
+    return setup_component(database.DatabaseServer, dc_loader, database_connect_address,
+        database_connect_port, database_channel)
 
-    client_agent = setup_component(clientagent.ClientAgent, dc_loader, client_agent_address,
-        client_agent_port, client_agent_connect_address, client_agent_connect_port,
-        client_agent_channel)
+def create_component(name, node_id=None):
+    if name == 'messagedirector':
+        return create_message_director(node_id)
 
-    state_server = setup_component(stateserver.StateServer, dc_loader, state_server_connect_address,
-        state_server_connect_port, state_server_channel)
+    if name == 'clientagent':
+        return create_client_agent(load_dc_files())
 
-    database_server = setup_component(database.DatabaseServer, dc_loader, database_connect_address,
-        database_connect_port, database_channel)
+    if name == 'stateserver':
+        return create_state_server(load_dc_files())
+
+    if name == 'database':
+        return create_database_server(load_dc_files())
+
+def run_components(components):
+    components = [component for component in components if component is not None]
+    if components:
+        io.startup_timer.report()
+        io.run()
+
+    for component in components:
+        shutdown_component(component)
+
+def run_launcher():
+    """
+    Runs every component in it's own process, the message director
+    processes are started first so that the other components can connect...
+    """
+
+    process_launcher = launcher.Launcher()
+
+    nodes = messagedirector.get_node_addresses()
+    if nodes:
+        for node_id in xrange(len(nodes)):
+            process_launcher.add_process('messagedirector-%d' % node_id,
+                ['--md-node', str(node_id)])
+    else:
+        process_launcher.add_process('messagedirector', ['--component', 'messagedirector'])
+
+    first_count = len(process_launcher.processes)
+    process_launcher.add_process('clientagent', ['--component', 'clientagent'])
+
+    process_launcher.add_process('stateserver', ['--component', 'stateserver'])
+    process_launcher.add_process('database', ['--component', 'database'])
+    process_launcher.run(first_count)
+
+def main():
+    args = parse_args()
+    if args.launch:
+        run_launcher()
+        return
+
+    if args.md_node is not None:
+        run_components([create_component('messagedirector', node_id=args.md_node)])
+        return
+
+    if args.component:
+        run_components([create_component(args.component)])
+        return
+
+    dc_loader = load_dc_files()
 
-    task_mgr.run()
+    message_director = create_message_director()
+    client_agent = create_client_agent(dc_loader)
+    state_server = create_state_server(dc_loader)
+    database_server = create_database_server(dc_loader)
 
-    shutdown_component(message_director)
-    shutdown_component(client_agent)
-    shutdown_component(state_server)
-    shutdown_component(database_server)
+    run_components([message_director, client_agent, state_server, database_server])
 
 
 main()
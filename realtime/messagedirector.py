@@ -5,7 +5,9 @@
  * Licensing information can found in 'LICENSE', which is part of this source code package.
 """
 
+import bisect
 import collections
+import math
 import time
 
 from panda3d.core import *
@@ -27,6 +29,11 @@ class Participant(io.NetworkHandler):
 
         self._lo_channel = 0
         self._hi_channel = 0
+        self._node_link = None
+
+    @property
+    def node_link(self):
+        return self._node_link
 
     @property
     def lo_channel(self):
@@ -48,6 +55,8 @@ class Participant(io.NetworkHandler):
         channels = di.get_uint8()
         if channels == 1:
             self.handle_control_message(di)
+        elif channels > 1:
+            self.handle_multi_message(channels, di)
 
     def handle_control_message(self, di):
         channel = di.get_uint64()
@@ -55,80 +64,290 @@ class Participant(io.NetworkHandler):
             message_type = di.get_uint16()
             sender = di.get_uint64()
 
+            # control messages from another message director node update
+            # that node's subscriptions rather than our participant's...
+            if self._node_link is not None:
+                self.network.node_interface.handle_node_control_message(
+                    self._node_link, message_type, sender, di)
+
+                return
+
             if message_type == types.CONTROL_SET_CHANNEL:
                 if not self.channel:
                     self.channel = sender
 
                 self.network.interface.add_participant(sender, self)
+            elif message_type == types.CONTROL_SET_CHANNELS:
+                for _ in xrange(di.get_uint16()):
+                    self.network.interface.add_participant(di.get_uint64(), self)
             elif message_type == types.CONTROL_REMOVE_CHANNEL:
-                self.network.message_interface.flush_post_handles(sender)
-                self.network.interface.remove_participant(sender)
+                self.network.message_interface.flush_post_handles(sender, self)
+                self.network.interface.remove_participant(sender, self)
             elif message_type == types.CONTROL_SET_CON_NAME:
                 pass
             elif message_type == types.CONTROL_SET_CON_URL:
                 pass
             elif message_type == types.CONTROL_ADD_RANGE:
-                pass
+                self.network.interface.add_range(sender, di.get_uint64(), self)
             elif message_type == types.CONTROL_REMOVE_RANGE:
-                pass
+                self.network.interface.remove_range(sender, di.get_uint64(), self)
             elif message_type == types.CONTROL_ADD_POST_REMOVE:
                 self.network.message_interface.append_post_handle(sender, io.NetworkDatagram(
                     Datagram(di.get_remaining_bytes())))
             elif message_type == types.CONTROL_CLEAR_POST_REMOVE:
                 self.network.message_interface.clear_post_handles(sender)
+            elif message_type == types.CONTROL_LINK_NODE:
+                self._node_link = self.network.node_interface.get_link(sender)
+                if self._node_link is None:
+                    self.notify.warning('Failed to link unknown message '
+                        'director node: %d!' % sender)
             else:
                 self.notify.warning('Failed to handle unknown datagram with '
                     'message type: %d!' % message_type)
         else:
+            # the header we are routing with is exactly the header the participant
+            # sent us, so route the original datagram rather than a copy of it...
             self.network.message_interface.append_handle(channel, di.get_uint64(), di.get_uint16(),
-                io.NetworkDatagram(Datagram(di.get_remaining_bytes())))
+                di.get_source_datagram(), self._node_link)
+
+    def handle_multi_message(self, channels, di):
+        channels = [di.get_uint64() for _ in xrange(channels)]
+        if types.CONTROL_MESSAGE in channels:
+            self.notify.warning('Failed to handle control message '
+                'addressed to multiple channels!')
+
+            return
+
+        self.network.message_interface.append_multi_handle(channels, di.get_uint64(),
+            di.get_uint16(), di, self._node_link)
 
     def handle_disconnected(self):
-        self.network.message_interface.flush_post_handles(self.channel)
-        self.network.interface.remove_participant(self.channel)
-        io.NetworkHandler.handle_disconnected(self)
+        if self._node_link is not None:
+            self.network.node_interface.remove_node_subscriptions(self._node_link)
+        else:
+            self.network.message_interface.flush_post_handles(self.channel, self)
+            self.network.interface.remove_subscriptions(self)
+
+        # we are the message director, so there is no one to send our channel
+        # unregistration to, just remove the participant's handler...
+        self.network.handle_disconnected(self)
 
     def shutdown(self):
         self.allocated_channel = 0
         self.channel = 0
         io.NetworkHandler.shutdown(self)
 
+class ChannelRangeIndex(object):
+    """
+    An index of channel ranges split up into elementary segments, every
+    segment starts at one of the sorted bounds and runs up to the next one,
+    so the participants subscribed to a channel are found with a single bisect...
+    """
+
+    def __init__(self):
+        self._bounds = []
+        self._segments = []
+
+    @property
+    def bounds(self):
+        return self._bounds
+
+    @property
+    def segments(self):
+        return self._segments
+
+    def __split(self, channel):
+        """
+        Makes sure a segment starts at the channel, and
+        returns the index of that segment...
+        """
+
+        index = bisect.bisect_left(self._bounds, channel)
+        if index < len(self._bounds) and self._bounds[index] == channel:
+            return index
+
+        # the new segment starts out covered by the same
+        # participants as the segment it was split from...
+        segment = dict(self._segments[index - 1]) if index else {}
+        self._bounds.insert(index, channel)
+        self._segments.insert(index, segment)
+        return index
+
+    def __coalesce(self):
+        """
+        Merges neighbouring segments that are covered by
+        the same participants back together...
+        """
+
+        bounds, segments = [], []
+        for bound, segment in zip(self._bounds, self._segments):
+            if segment == (segments[-1] if segments else {}):
+                continue
+
+            bounds.append(bound)
+            segments.append(segment)
+
+        self._bounds = bounds
+        self._segments = segments
+
+    def add_range(self, lo, hi, participant):
+        start = self.__split(lo)
+        end = self.__split(hi + 1)
+        for segment in self._segments[start:end]:
+            segment[participant] = segment.get(participant, 0) + 1
+
+    def remove_range(self, lo, hi, participant):
+        # the bounds of the range may have been coalesced away since
+        # it was added, so they are split off again just like when adding...
+        start = self.__split(lo)
+        end = self.__split(hi + 1)
+        for segment in self._segments[start:end]:
+            count = segment.get(participant, 0)
+            if count > 1:
+                segment[participant] = count - 1
+            elif count:
+                del segment[participant]
+
+        self.__coalesce()
+
+    def remove_participant(self, participant):
+        for segment in self._segments:
+            segment.pop(participant, None)
+
+        self.__coalesce()
+
+    def get_participants(self, channel):
+        index = bisect.bisect_right(self._bounds, channel) - 1
+        if index < 0:
+            return None
+
+        return self._segments[index]
+
 class ParticipantInterface(object):
     notify = notify.new_category('ParticipantInterface')
 
     def __init__(self, network):
         self._network = network
         self._participants = {}
+        self._participant_channels = {}
+        self._participant_ranges = {}
+        self._ranges = ChannelRangeIndex()
 
     @property
     def participants(self):
         return self._participants
 
+    @property
+    def ranges(self):
+        return self._ranges
+
     def has_participant(self, channel):
-        return channel in self._participants
+        return bool(self.get_participants(channel))
 
     def add_participant(self, channel, participant):
-        if self.has_participant(channel):
+        participants = self._participants.setdefault(channel, set())
+        if participant in participants:
             self.notify.debug('Failed to add participant with channel: %d, '
                 'participant already exists!' % channel)
 
             return
 
-        self._participants[channel] = participant
+        participants.add(participant)
+        self._participant_channels.setdefault(participant, set()).add(channel)
+
+        # the first participant of a channel subscribes this node
+        # to the channel on the node that owns it...
+        if len(participants) == 1:
+            self._network.node_interface.handle_subscribe(channel)
 
-    def remove_participant(self, channel):
-        if not self.has_participant(channel):
+        # now that the channel exists, any messages that were waiting
+        # for it can be routed to the participant...
+        self._network.message_interface.flush_handles(channel)
+
+    def remove_participant(self, channel, participant):
+        participants = self._participants.get(channel)
+        if not participants or participant not in participants:
             self.notify.debug('Failed to remove participant with channel: %d, '
                 'participant does not exist!' % channel)
 
             return
 
-        del self._participants[channel]
+        participants.remove(participant)
+        if not participants:
+            del self._participants[channel]
+            self._network.node_interface.handle_unsubscribe(channel)
+
+        channels = self._participant_channels[participant]
+        channels.discard(channel)
+        if not channels:
+            del self._participant_channels[participant]
+
+    def add_range(self, lo, hi, participant):
+        if lo > hi:
+            self.notify.warning('Failed to add range: %d-%d, '
+                'invalid channel range!' % (lo, hi))
+
+            return
+
+        self._ranges.add_range(lo, hi, participant)
+        self._participant_ranges.setdefault(participant, []).append((lo, hi))
+        self._network.node_interface.handle_add_range(lo, hi)
+        self._network.message_interface.flush_range_handles(lo, hi)
+
+    def remove_range(self, lo, hi, participant):
+        ranges = self._participant_ranges.get(participant)
+        if not ranges or (lo, hi) not in ranges:
+            self.notify.debug('Failed to remove range: %d-%d, '
+                'participant does not have that range!' % (lo, hi))
+
+            return
+
+        ranges.remove((lo, hi))
+        if not ranges:
+            del self._participant_ranges[participant]
+
+        self._ranges.remove_range(lo, hi, participant)
+        self._network.node_interface.handle_remove_range(lo, hi)
 
-    def get_participant(self, channel):
-        return self._participants.get(channel)
+    def remove_subscriptions(self, participant):
+        """
+        Removes every channel and range the participant subscribed to
+        """
+
+        for channel in list(self._participant_channels.get(participant, ())):
+            self.remove_participant(channel, participant)
+
+        for lo, hi in list(self._participant_ranges.get(participant, ())):
+            self.remove_range(lo, hi, participant)
+
+    def get_ranges(self):
+        """
+        Returns every range subscribed to by our participants
+        """
+
+        return [channel_range for ranges in self._participant_ranges.values()
+            for channel_range in ranges]
+
+    def get_participants(self, channel):
+        """
+        Returns every participant subscribed to the channel, either
+        directly or through a range, each participant only once...
+        """
+
+        participants = self._participants.get(channel)
+        ranged = self._ranges.get_participants(channel)
+        if not ranged:
+            return participants or ()
+
+        if not participants:
+            return ranged.keys()
+
+        participants = set(participants)
+        participants.update(ranged)
+        return participants
 
 class MessageHandle(object):
+    __slots__ = ('_channel', '_sender', '_message_type', '_datagram', '_timestamp')
 
     def __init__(self, channel, sender, message_type, datagram, timestamp):
         self._channel = channel
@@ -165,6 +384,7 @@ class MessageHandle(object):
         self._timestamp = None
 
 class PostMessageHandle(object):
+    __slots__ = ('_channel', '_datagram')
 
     def __init__(self, channel, datagram):
         self._channel = channel
@@ -182,6 +402,49 @@ class PostMessageHandle(object):
         self._channel = None
         self._datagram = None
 
+class MessageTimerWheel(object):
+    """
+    A hashed timer wheel holding message handles, every slot covers a
+    resolution's worth of time and the wheel is sized so that a slot comes
+    back around only after the message timeout has passed...
+    """
+
+    def __init__(self, timeout, resolution):
+        self._resolution = resolution
+        self._slots = [[] for _ in xrange(int(math.ceil(timeout / resolution)) + 1)]
+        self._tick = self.get_tick()
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def get_tick(self):
+        return int(time.time() / self._resolution)
+
+    def schedule(self, message_handle):
+        self._slots[self._tick % len(self._slots)].append(message_handle)
+
+    def advance(self):
+        """
+        Moves the wheel up to the current tick and returns
+        the message handles in each of the slots it passed...
+        """
+
+        expired = []
+        tick = self.get_tick()
+        while self._tick < tick:
+            self._tick += 1
+
+            index = self._tick % len(self._slots)
+            expired.extend(self._slots[index])
+            self._slots[index] = []
+
+        return expired
+
+    def clear(self):
+        for index in xrange(len(self._slots)):
+            self._slots[index] = []
+
 class MessageInterface(object):
     notify = notify.new_category('MessageInterface')
 
@@ -190,13 +453,23 @@ class MessageInterface(object):
         self._message_timeout = config.GetFloat(
             'messagedirector-message-timeout', 15.0)
 
-        self._messages = collections.deque()
+        # messages for channels without a participant wait in a queue
+        # for their channel, until it is registered or they expire...
+        self._messages = {}
+        self._timer_wheel = MessageTimerWheel(self._message_timeout, config.GetFloat(
+            'messagedirector-timer-resolution', 0.5))
+
         self._post_messages = {}
+        self._counters = io.NetworkCounters(self._network.get_unique_name('messages'))
 
     @property
     def messages(self):
         return self._messages
 
+    @property
+    def counters(self):
+        return self._counters
+
     @property
     def post_messages(self):
         return self._post_messages
@@ -204,24 +477,140 @@ class MessageInterface(object):
     def get_timestamp(self):
         return round(time.time(), 2)
 
-    def append_handle(self, channel, sender, message_type, datagram):
+    def get_targets(self, channel, origin=None):
+        """
+        Returns the local participants and the node links
+        a message for the channel has to be sent to...
+        """
+
+        participants = self._network.interface.get_participants(channel)
+        links = self._network.node_interface.get_links(channel, origin)
+        if not links:
+            return participants
+
+        if not participants:
+            return links
+
+        return list(participants) + list(links)
+
+    def append_handle(self, channel, sender, message_type, datagram, origin=None):
         #if not datagram.get_length():
         #    self.notify.warning('Failed to append messenger handle from sender: '
         #        '%d to channel: %d, invalid datagram!' % (sender, channel))
         #
         #    return
 
+        # pending messages are flushed as soon as their channel is registered,
+        # so when a participant exists there is no ordering to preserve and the
+        # message is routed straight away...
+        targets = self.get_targets(channel, origin)
+        if targets:
+            for target in targets:
+                self.route_datagram(target, datagram)
+
+            return
+
+        if not self._network.node_interface.should_hold(channel, origin):
+            self._counters.increment('dropped')
+            return
+
         message_handle = MessageHandle(channel, sender, message_type,
             datagram, self.get_timestamp())
 
-        self._messages.append(message_handle)
+        messages = self._messages.setdefault(channel, collections.deque())
+        messages.append(message_handle)
+        self._timer_wheel.schedule(message_handle)
+        self._counters.increment('pending')
+
+    def append_multi_handle(self, channels, sender, message_type, di, origin=None):
+        """
+        Routes a message addressed to several channels, every participant
+        receives the message once with only the channels it subscribed to...
+        """
+
+        targets = collections.OrderedDict()
+        for channel in channels:
+            participants = self.get_targets(channel, origin)
+            if not participants:
+                if self._network.node_interface.should_hold(channel, origin):
+                    targets.setdefault(None, []).append(channel)
+
+                continue
+
+            for participant in participants:
+                target_channels = targets.setdefault(participant, [])
+                if channel not in target_channels:
+                    target_channels.append(channel)
+
+        datagram = di.get_source_datagram()
+        payload = None
+        for participant, target_channels in targets.items():
+            # a participant subscribed to every channel the message was
+            # addressed to can be sent the original datagram as-is...
+            if participant is not None and target_channels == channels:
+                self.route_datagram(participant, datagram)
+                continue
+
+            if payload is None:
+                payload = di.get_remaining_bytes()
+
+            self._counters.increment('rewritten')
+            if participant is None:
+                # channels nobody subscribed to yet are queued individually,
+                # until their participant shows up or they expire...
+                for channel in target_channels:
+                    pending_datagram = io.NetworkDatagram()
+                    pending_datagram.add_header(channel, sender, message_type)
+                    pending_datagram.append_data(payload)
+                    self.append_handle(channel, sender, message_type, pending_datagram)
+
+                continue
+
+            target_datagram = io.NetworkDatagram()
+            target_datagram.add_multi_header(target_channels, sender, message_type)
+            target_datagram.append_data(payload)
+            self.route_datagram(participant, target_datagram)
 
     def remove_handle(self, message_handle):
         if not isinstance(message_handle, MessageHandle):
             raise MessageError('Failed to remove message handle of '
                 'invalid type: %r!' % message_handle)
 
-        self._messages.remove(message_handle)
+        messages = self._messages.get(message_handle.channel)
+        if not messages:
+            self.notify.debug('Failed to remove message handle, '
+                'unknown channel: %d!' % message_handle.channel)
+
+            return
+
+        messages.remove(message_handle)
+        if not messages:
+            del self._messages[message_handle.channel]
+
+        self._counters.increment('pending', -1)
+        message_handle.destroy()
+
+    def flush_handles(self, channel):
+        messages = self._messages.pop(channel, None)
+        if not messages:
+            return
+
+        participants = self.get_targets(channel)
+        if not participants:
+            self.notify.debug('Failed to flush message handles, '
+                'unknown participant with channel: %d!' % channel)
+
+            self._messages[channel] = messages
+            return
+
+        self._counters.increment('pending', -len(messages))
+        for message_handle in messages:
+            for participant in participants:
+                self.route_datagram(participant, message_handle.datagram)
+
+            # the handle will still be referenced by the timer wheel
+            # until it's slot comes around, so destroy it now...
+            message_handle.destroy()
 
     def append_post_handle(self, channel, datagram):
         message_handle = PostMessageHandle(channel, datagram)
@@ -252,65 +641,52 @@ class MessageInterface(object):
 
         del self._post_messages[channel]
 
-    def setup(self):
-        self.__flush_task = task_mgr.add(self.__flush,
-            self._network.get_unique_name('flush-queue'))
-
-    def __flush(self, task):
-        # check to see if we have any available messages in the
-        # queue to route...
-        if not len(self._messages):
-            return task.cont
-
-        for _ in range(len(self._messages)):
-            # pull a message handle object off the top of the queue,
-            # then attempt to route it to its appropiate channel...
-            message_handle = self._messages.popleft()
-
-            # before we can attempt to route this message, we need to check and
-            # see if the channel exists on the participant interface...
-            if not self._network.interface.has_participant(message_handle.channel):
-                # each message has a delay as to when it will be automatically removed.
-                # let's just check to make sure we can "re-queue" it again...
-                if self.get_timestamp() - message_handle.timestamp > self._message_timeout:
-                    continue
-
-                # even though this message's channel couldn't be found,
-                # this message is still valid because it is within the message
-                # timeout time frame, we will "re-queue" it until it expires...
-                self._messages.append(message_handle)
-                continue
+    def flush_range_handles(self, lo, hi):
+        """
+        Releases any messages that were waiting on a
+        channel that is now covered by a range...
+        """
 
-            # we've successfully found the channel in which this message will be routed to,
-            # and have a valid message, now reconstruct the message and send it off...
-            participant = self._network.interface.get_participant(
-                message_handle.channel)
+        for channel in [channel for channel in self._messages if lo <= channel <= hi]:
+            self.flush_handles(channel)
 
-            if not participant:
-                continue
-
-            datagram = io.NetworkDatagram()
-            datagram.add_header(message_handle.channel, message_handle.sender,
-                message_handle.message_type)
+    def route_datagram(self, participant, datagram):
+        """
+        Sends a received datagram on to the participant, the datagram
+        already carries it's routing header so it is not rebuilt...
+        """
 
-            other_datagram = message_handle.datagram
-            datagram.append_data(other_datagram.get_message())
-            participant.handle_send_datagram(datagram)
+        participant.handle_send_datagram(datagram)
+        self._counters.increment('routed')
+        self._counters.increment('routed-bytes', datagram.get_length())
 
-            # destroy the datagram and message handle objects since they are
-            # no longer needed in this scope...
-            other_datagram.clear()
-            datagram.clear()
+    def setup(self):
+        self._counters.setup()
+        self.__expire_task = task_mgr.doMethodLater(self._timer_wheel.resolution,
+            self.__expire, self._network.get_unique_name('expire-queue'))
+
+    def __expire(self, task):
+        for message_handle in self._timer_wheel.advance():
+            # handles which have already been routed are destroyed,
+            # and no longer belong to any channel...
+            channel = message_handle.channel
+            if channel is None:
+                continue
 
-            del other_datagram
-            del datagram
+            # every message shares the same timeout, so the handle expiring
+            # is always the oldest one left in it's channel's queue...
+            messages = self._messages[channel]
+            messages.popleft()
+            if not messages:
+                del self._messages[channel]
 
             message_handle.destroy()
-            del message_handle
+            self._counters.increment('pending', -1)
+            self._counters.increment('expired')
 
-        return task.cont
+        return task.again
 
-    def flush_post_handles(self, channel):
+    def flush_post_handles(self, channel, participant):
         messages = self._post_messages.get(channel)
         if not messages:
             self.notify.debug('Failed to flush post message handles, '
@@ -318,26 +694,18 @@ class MessageInterface(object):
 
             return
 
-        participant = self._network.interface.get_participant(channel)
-        if not participant:
-            self.notify.debug('Failed to flush post message handles, '
-                'unknown participant with channel: %d!' % channel)
-
-            return
-
         for _ in range(len(messages)):
             message_handle = messages.popleft()
 
             # in order for us to properly handle post remove messages,
             # we need to unpack and process them like we would normally...
-            datagram = message_handle.datagram
-            participant.handle_datagram(io.NetworkDatagramIterator(datagram))
+            # the datagram is not cleared afterwards, since it may have been
+            # queued to be routed as-is once it's channel becomes available...
+            participant.handle_datagram(io.NetworkDatagramIterator(
+                message_handle.datagram))
 
-            # destroy the datagram and message handle objects since they are
+            # destroy the message handle object since it is
             # no longer needed in this scope...
-            datagram.clear()
-            del datagram
-
             message_handle.destroy()
             del message_handle
 
@@ -346,18 +714,366 @@ class MessageInterface(object):
         self.clear_post_handles(channel)
 
     def shutdown(self):
-        if self.__flush_task:
-            task_mgr.remove(self.__flush_task)
-            self.__flush_task = None
+        if self.__expire_task:
+            task_mgr.remove(self.__expire_task)
+            self.__expire_task = None
+
+        self._timer_wheel.clear()
+        self._messages = {}
+        self._counters.shutdown()
+
+class MessageNodeConnector(io.NetworkConnector):
+    notify = notify.new_category('MessageNodeConnector')
+
+    def __init__(self, link, address, port):
+        io.NetworkConnector.__init__(self, None, address, port, 0)
+
+        self._link = link
+
+    @property
+    def link(self):
+        return self._link
+
+    def handle_disconnected(self):
+        io.NetworkConnector.handle_disconnected(self)
+        self._link.handle_disconnected()
+
+class MessageNodeLink(object):
+    """
+    The upstream link from this message director node to another node,
+    messages and subscription updates for the other node are sent over it...
+    """
+
+    notify = notify.new_category('MessageNodeLink')
+
+    def __init__(self, network, node_id, address, port):
+        self._network = network
+        self._node_id = node_id
+        self._address = address
+        self._port = port
+
+        self._retry_delay = config.GetFloat('messagedirector-link-retry-delay', 1.0)
+        self._max_queue = config.GetInt('messagedirector-link-max-queue', 10000)
+
+        self._connector = None
+        self._queue = collections.deque()
+        self.__retry_task = None
+
+    @property
+    def node_id(self):
+        return self._node_id
+
+    @property
+    def connected(self):
+        return self._connector is not None
+
+    def setup(self):
+        self.__connect()
+
+    def __connect(self):
+        connector = MessageNodeConnector(self, self._address, self._port)
+        try:
+            connector.setup()
+        except io.NetworkError:
+            self.notify.debug('Failed to link to node: %d on address: <%s:%d>, '
+                'retrying in %.1f seconds...' % (self._node_id, self._address,
+                    self._port, self._retry_delay))
+
+            self.__retry_task = task_mgr.doMethodLater(self._retry_delay, self.__retry,
+                self._network.get_unique_name('link-retry-%d' % self._node_id))
+
+            return
+
+        self.notify.info('Linked to node: %d on address: <%s:%d>.' % (
+            self._node_id, self._address, self._port))
+
+        self._connector = connector
+
+        # identify ourselves to the other node, so that it treats this
+        # connection as a node rather than an ordinary participant...
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(self._network.node_interface.node_id,
+            types.CONTROL_LINK_NODE)
+
+        self.handle_send_datagram(datagram)
+        self._network.node_interface.handle_link_connected(self)
+
+        while self._queue:
+            self.handle_send_datagram(self._queue.popleft())
+
+    def __retry(self, task):
+        self.__retry_task = None
+        self.__connect()
+        return task.done
+
+    def handle_send_datagram(self, datagram):
+        if self._connector is not None:
+            self._connector.handle_send_connection_datagram(datagram)
+            return
+
+        # hold on to messages until the link is up, the subscriptions are
+        # sent again once it connects so only messages need to be kept...
+        if len(self._queue) >= self._max_queue:
+            self.notify.debug('Dropping message for node: %d, '
+                'link queue is full!' % self._node_id)
+
+            return
+
+        self._queue.append(datagram)
+
+    def handle_disconnected(self):
+        self.notify.warning('Lost link to node: %d on address: <%s:%d>!' % (
+            self._node_id, self._address, self._port))
+
+        self._connector.shutdown()
+        self._connector = None
+
+        self.__retry_task = task_mgr.doMethodLater(self._retry_delay, self.__retry,
+            self._network.get_unique_name('link-retry-%d' % self._node_id))
+
+    def shutdown(self):
+        if self.__retry_task:
+            task_mgr.remove(self.__retry_task)
+            self.__retry_task = None
+
+        if self._connector is not None:
+            self._connector.shutdown()
+            self._connector = None
+
+        self._queue.clear()
+
+class MessageNodeInterface(object):
+    """
+    Splits the channel space between the message director nodes, every
+    node owns the channels that hash to it and knows which other nodes
+    subscribed to them, ranges are known by every node...
+    """
+
+    notify = notify.new_category('MessageNodeInterface')
+
+    def __init__(self, network, node_id=None):
+        self._network = network
+        self._node_id = node_id if node_id is not None else config.GetInt(
+            'messagedirector-node-id', 0)
+
+        self._nodes = get_node_addresses()
+        self._links = {}
+
+        self._channels = {}
+        self._link_channels = {}
+        self._ranges = ChannelRangeIndex()
+
+    @property
+    def node_id(self):
+        return self._node_id
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    @property
+    def links(self):
+        return self._links
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def ranges(self):
+        return self._ranges
+
+    def get_node_count(self):
+        return max(len(self._nodes), 1)
+
+    def get_owner(self, channel):
+        return channel % self.get_node_count()
+
+    def is_owner(self, channel):
+        return not self._links or self.get_owner(channel) == self._node_id
+
+    def get_link(self, node_id):
+        return self._links.get(node_id)
+
+    def get_links(self, channel, origin=None):
+        """
+        Returns the links to the nodes a message for the channel has to be sent to,
+        messages from another node are only passed on by the channel's owner...
+        """
+
+        if not self._links:
+            return ()
+
+        ranged = self._ranges.get_participants(channel)
+        if origin is None:
+            if self.is_owner(channel):
+                links = set(self._channels.get(channel, ()))
+            else:
+                links = set([self._links[self.get_owner(channel)]])
+
+            if ranged:
+                links.update(ranged)
+
+            return links
+
+        # the node the message came from has already sent it to every node
+        # with a matching range, and to us if we own the channel...
+        if not self.is_owner(channel):
+            return ()
+
+        links = self._channels.get(channel)
+        if not links:
+            return ()
+
+        links = set(links)
+        links.discard(origin)
+        if ranged:
+            links.difference_update(ranged)
+
+        return links
+
+    def should_hold(self, channel, origin=None):
+        """
+        Returns True if an undeliverable message for the channel should be held
+        until it's channel is subscribed to, only the owner holds on to messages
+        and only when no other node could have been sent the message...
+        """
+
+        if not self.is_owner(channel):
+            return False
+
+        if origin is None:
+            return True
+
+        return not self._channels.get(channel) and not self._ranges.get_participants(channel)
+
+    def setup(self):
+        if self._nodes and self._node_id not in range(len(self._nodes)):
+            raise MessageError('Invalid message director node: %d, only %d nodes '
+                'are configured!' % (self._node_id, len(self._nodes)))
+
+        for node_id, (address, port) in enumerate(self._nodes):
+            if node_id == self._node_id:
+                continue
+
+            self._links[node_id] = MessageNodeLink(self._network, node_id, address, port)
+
+        for link in self._links.values():
+            link.setup()
+
+    def send_control_message(self, link, channel, message_type, hi_channel=None):
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(channel, message_type)
+        if hi_channel is not None:
+            datagram.add_uint64(hi_channel)
+
+        link.handle_send_datagram(datagram)
+
+    def handle_subscribe(self, channel):
+        if self.is_owner(channel):
+            return
+
+        self.send_control_message(self._links[self.get_owner(channel)],
+            channel, types.CONTROL_SET_CHANNEL)
+
+    def handle_unsubscribe(self, channel):
+        if self.is_owner(channel):
+            return
+
+        self.send_control_message(self._links[self.get_owner(channel)],
+            channel, types.CONTROL_REMOVE_CHANNEL)
+
+    def handle_add_range(self, lo, hi):
+        for link in self._links.values():
+            self.send_control_message(link, lo, types.CONTROL_ADD_RANGE, hi)
+
+    def handle_remove_range(self, lo, hi):
+        for link in self._links.values():
+            self.send_control_message(link, lo, types.CONTROL_REMOVE_RANGE, hi)
+
+    def handle_link_connected(self, link):
+        """
+        Sends the other node every subscription of ours that it needs to know
+        about, this also restores them after the other node was restarted...
+        """
+
+        for channel in self._network.interface.participants:
+            if self.get_owner(channel) == link.node_id:
+                self.send_control_message(link, channel, types.CONTROL_SET_CHANNEL)
+
+        for lo, hi in self._network.interface.get_ranges():
+            self.send_control_message(link, lo, types.CONTROL_ADD_RANGE, hi)
+
+    def handle_node_control_message(self, link, message_type, channel, di):
+        if message_type == types.CONTROL_SET_CHANNEL:
+            self._channels.setdefault(channel, set()).add(link)
+            self._link_channels.setdefault(link, set()).add(channel)
+            self._network.message_interface.flush_handles(channel)
+        elif message_type == types.CONTROL_REMOVE_CHANNEL:
+            self.remove_node_channel(channel, link)
+        elif message_type == types.CONTROL_ADD_RANGE:
+            hi_channel = di.get_uint64()
+            self._ranges.add_range(channel, hi_channel, link)
+            self._network.message_interface.flush_range_handles(channel, hi_channel)
+        elif message_type == types.CONTROL_REMOVE_RANGE:
+            self._ranges.remove_range(channel, di.get_uint64(), link)
+        else:
+            self.notify.warning('Failed to handle unknown node control message '
+                'type: %d from node: %d!' % (message_type, link.node_id))
+
+    def remove_node_channel(self, channel, link):
+        links = self._channels.get(channel)
+        if not links or link not in links:
+            return
+
+        links.remove(link)
+        if not links:
+            del self._channels[channel]
+
+        channels = self._link_channels[link]
+        channels.discard(channel)
+        if not channels:
+            del self._link_channels[link]
+
+    def remove_node_subscriptions(self, link):
+        """
+        Removes every subscription the node held, it sends them
+        all over again once it's link has been restored...
+        """
+
+        for channel in list(self._link_channels.get(link, ())):
+            self.remove_node_channel(channel, link)
+
+        self._ranges.remove_participant(link)
+
+    def shutdown(self):
+        for link in self._links.values():
+            link.shutdown()
+
+        self._links = {}
+
+def get_node_addresses():
+    """
+    Returns the (address, port) of every message director node, as listed
+    in the messagedirector-nodes config variable by node id...
+    """
+
+    nodes = []
+    for node in config.GetString('messagedirector-nodes', '').split():
+        address, port = node.rsplit(':', 1)
+        nodes.append((address, int(port)))
+
+    return nodes
 
 class MessageDirector(io.NetworkListener):
     notify = notify.new_category('MessageDirector')
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, node_id=None):
         io.NetworkListener.__init__(self, address, port, Participant)
 
         self._interface = ParticipantInterface(self)
         self._message_interface = MessageInterface(self)
+        self._node_interface = MessageNodeInterface(self, node_id)
 
     @property
     def interface(self):
@@ -367,10 +1083,16 @@ class MessageDirector(io.NetworkListener):
     def message_interface(self):
         return self._message_interface
 
+    @property
+    def node_interface(self):
+        return self._node_interface
+
     def setup(self):
         self._message_interface.setup()
         io.NetworkListener.setup(self)
+        self._node_interface.setup()
 
     def shutdown(self):
+        self._node_interface.shutdown()
         self._message_interface.shutdown()
         io.NetworkListener.shutdown(self)
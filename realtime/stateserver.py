@@ -5,12 +5,18 @@
  * Licensing information can found in 'LICENSE', which is part of this source code package.
 """
 
+import Queue
 import collections
 import itertools
+import os
 import random
+import struct
+import threading
+import time
 
 from panda3d.direct import *
 
+from realtime import codec
 from realtime import io
 from realtime import types
 from realtime.notifier import notify
@@ -20,7 +26,51 @@ from game.OtpDoGlobals import *
 from game import ZoneUtil
 
 
+def create_multi_datagrams(channels, sender, message_type):
+    """
+    Returns a datagram for every 255 of the channels, each addressed to all
+    of it's channels so the message director only routes a single copy...
+    """
+
+    channels = list(channels)
+    datagrams = []
+    for index in xrange(0, len(channels), 0xFF):
+        datagram = io.NetworkDatagram()
+        datagram.add_multi_header(channels[index:index + 0xFF], sender, message_type)
+        datagrams.append(datagram)
+
+    return datagrams
+
+# every datagram is framed with a uint16 length, so a delete set is split into
+# as many do_ids as fit after it's header (one channel, the sender, the message
+# type) and the do_id count...
+DELETE_SET_HEADER_SIZE = 1 + 8 + 8 + 2 + 2
+MAX_DELETE_SET_SIZE = (0xFFFF - DELETE_SET_HEADER_SIZE) // 4
+
+def create_delete_set_datagrams(channel, sender, do_ids):
+    """
+    Returns the datagrams deleting all of the do_ids for a single channel,
+    each of them small enough to be sent over the connection
+    """
+
+    do_ids = list(do_ids)
+    datagrams = []
+    for index in xrange(0, len(do_ids), MAX_DELETE_SET_SIZE):
+        datagram = io.NetworkDatagram()
+        datagram.add_header(channel, sender, types.STATESERVER_OBJECT_DELETE_RAM_MULTIPLE)
+
+        chunk = do_ids[index:index + MAX_DELETE_SET_SIZE]
+        datagram.add_uint16(len(chunk))
+        for do_id in chunk:
+            datagram.add_uint32(do_id)
+
+        datagrams.append(datagram)
+
+    return datagrams
+
+
 class Shard(object):
+    __slots__ = ('channel', 'district_id', 'name', 'population')
 
     def __init__(self, channel, district_id, name, population):
         self.channel = channel
@@ -31,12 +81,21 @@ class Shard(object):
 
 class ShardManager(object):
 
-    def __init__(self):
+    def __init__(self, ud_channels=(types.UD_CHANNEL,)):
         self.shards = {}
+        self._ud_channels = frozenset(ud_channels)
 
     def has_shard(self, channel):
         return channel in self.shards
 
+    def is_ai_channel(self, channel):
+        """
+        Returns True if the channel is one of the AIs (a shard) or
+        UberDOGs, rather than a client's connection channel
+        """
+
+        return channel in self.shards or channel in self._ud_channels
+
     def add_shard(self, channel, district_id, name, population):
         if self.has_shard(channel):
             return
@@ -55,6 +114,21 @@ class ShardManager(object):
         return self.shards.get(channel)
 
 
+class ReadOnlyTable(dict):
+    """
+    An empty table shared by every object that has nothing to store in it,
+    the object replaces it with it's own table before the first write...
+    """
+
+    __slots__ = ()
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('Cannot modify a read only table!')
+
+    __setitem__ = __delitem__ = setdefault = update = clear = popitem = __readonly
+
+EMPTY_TABLE = ReadOnlyTable()
+
 class SimpleContextQueue:
     def __init__(self):
         self.ack_contexts = []
@@ -62,6 +136,12 @@ class SimpleContextQueue:
 class StateObject(object):
     notify = notify.new_category('StateObject')
 
+    __slots__ = ('_network', 'object_manager', '_do_id', '_old_ai_channel', '_ai_channel',
+        '_old_owner_id', '_owner_id', '_old_parent_id', '_parent_id', '_old_zone_id', '_zone_id',
+        '_dc_metadata', '_has_other', '_required_fields', '_other_fields', '_required_data',
+        '_required_broadcast_data', '_other_data', '_zone_objects', '_child_zones',
+        '_zone_observers', '_child_observers')
+
     def __init__(self, network, object_manager, do_id, parent_id, zone_id, dc_class, has_other, di):
         self._network = network
         self.object_manager = object_manager
@@ -80,52 +160,55 @@ class StateObject(object):
         self._old_zone_id = 0
         self._zone_id = zone_id
 
-        self._dc_class = dc_class
+        self._dc_metadata = network.dc_loader.get_class_metadata(dc_class)
         self._has_other = has_other
 
         self._required_fields = {}
-        self._other_fields = {}
-
-        self._zone_objects = {}
-        self._watch_list = {}
-
-        field_packer = DCPacker()
-        field_packer.set_unpack_data(di.get_remaining_bytes())
-
-        for field_index in range(self._dc_class.get_num_inherited_fields()):
-            field = self._dc_class.get_inherited_field(field_index)
-            if not field:
-                self.notify.error('Failed to unpack required field: %d '
-                    'dclass: %s, unknown field!' % (field_index, self._dc_class.get_name()))
-
-            if not field.is_required():
-                continue
-
-            field_packer.begin_unpack(field)
-            field_args = field.unpack_args(field_packer)
-            field_packer.end_unpack()
-
-            self._required_fields[field.get_number()] = field_args
+        self._other_fields = EMPTY_TABLE
+
+        # the packed field data sent in every generate, built when the object
+        # is first sent and rebuilt only after one of it's fields is written...
+        self._required_data = None
+        self._required_broadcast_data = None
+        self._other_data = None
+
+        # the children of this object, indexed both by zone and by
+        # the child's do_id so neither lookup has to scan the other,
+        # most objects never have children so the tables are shared
+        # until the first child arrives...
+        self._zone_objects = EMPTY_TABLE
+        self._child_zones = EMPTY_TABLE
+
+        # the channels observing each of this object's zones, the owners of the
+        # children in the zone and the watchers, counted by how many times
+        # they observe the zone so a broadcast only has to look up it's zone...
+        self._zone_observers = EMPTY_TABLE
+        self._child_observers = EMPTY_TABLE
+
+        field_data = di.get_remaining_bytes()
+        required_fields = self._dc_metadata.required_fields
+        required_args, offset = codec.unpack_fields(required_fields, field_data)
+        for field, field_args in zip(required_fields, required_args):
+            self._required_fields[field.number] = field_args
 
         if self._has_other:
-            num_fields = field_packer.raw_unpack_uint16()
+            num_fields, offset = codec.unpack_uint16(field_data, offset)
             for _ in range(num_fields):
-                field_id = field_packer.raw_unpack_uint16()
-                field = self._dc_class.get_field_by_index(field_id)
+                field_id, offset = codec.unpack_uint16(field_data, offset)
+                field = self._dc_metadata.get_field_by_index(field_id)
                 if not field:
                     self.notify.error('Failed to unpack other field: %d '
-                        'dclass: %s, unknown field!' % (field_id, self._dc_class.get_name()))
+                        'dclass: %s, unknown field!' % (field_id, self._dc_metadata.name))
 
+                # the field still has to be unpacked to skip over it...
+                field_args, offset = field.codec.unpack_args(field_data, offset)
                 if not field.is_ram():
                     continue
 
-                field_packer.begin_unpack(field)
-                field_args = field.unpack_args(field_packer)
-                field_packer.end_unpack()
+                if self._other_fields is EMPTY_TABLE:
+                    self._other_fields = {}
 
-                self._other_fields[field.get_number()] = field_args
-
-        self._network.register_for_channel(self._do_id)
+                self._other_fields[field.number] = field_args
 
     @property
     def do_id(self):
@@ -143,6 +226,7 @@ class StateObject(object):
     def ai_channel(self, ai_channel):
         self._old_ai_channel = self._ai_channel
         self._ai_channel = ai_channel
+        self.object_manager.handle_ai_channel_changed(self)
 
     @property
     def old_owner_id(self):
@@ -156,6 +240,14 @@ class StateObject(object):
     def owner_id(self, owner_id):
         self._old_owner_id = self._owner_id
         self._owner_id = owner_id
+        self.object_manager.handle_owner_changed(self)
+
+        # the parent observes it's zones through the owners of it's children,
+        # the child may not have been moved under the new parent yet...
+        for parent_id in set((self._parent_id, self._old_parent_id)):
+            parent_object = self._network.object_manager.get_object(parent_id)
+            if parent_object is not None:
+                parent_object.update_child_observer(self)
 
     @property
     def old_parent_id(self):
@@ -185,56 +277,63 @@ class StateObject(object):
 
     @property
     def dc_class(self):
-        return self._dc_class
+        return self._dc_metadata.dclass
+
+    @property
+    def dc_metadata(self):
+        return self._dc_metadata
 
     @property
     def has_other(self):
         return self._has_other
 
     def has_child(self, child_do_id):
-        return self.get_zone_from_child(child_do_id) is not None
+        return child_do_id in self._child_zones
 
     def has_child_in_zone(self, child_do_id, zone_id):
-        return self.get_zone_from_child(child_do_id) == zone_id
+        return self._child_zones.get(child_do_id) == zone_id
+
+    def add_child_in_zone(self, child_object, zone_id):
+        if self._zone_objects is EMPTY_TABLE:
+            self._zone_objects = {}
+            self._child_zones = {}
 
-    def add_child_in_zone(self, child_do_id, zone_id):
-        zone_objects = self._zone_objects.setdefault(zone_id, [])
-        zone_objects.append(child_do_id)
+        zone_objects = self._zone_objects.get(zone_id)
+        if zone_objects is None:
+            zone_objects = self._zone_objects[zone_id] = collections.OrderedDict()
+
+        zone_objects[child_object.do_id] = child_object
+        self._child_zones[child_object.do_id] = zone_id
+        self.update_child_observer(child_object)
 
     def remove_child_from_zone(self, child_do_id, zone_id):
         zone_objects = self._zone_objects.get(zone_id, None)
         assert(zone_objects != None)
-        if child_do_id in zone_objects:
-            zone_objects.remove(child_do_id)
+        zone_objects.pop(child_do_id, None)
+        if self._child_zones.get(child_do_id) == zone_id:
+            del self._child_zones[child_do_id]
+
+            observer = self._child_observers.pop(child_do_id, 0)
+            if observer:
+                self.remove_zone_observer(zone_id, observer)
 
         if not len(zone_objects):
             del self._zone_objects[zone_id]
 
     def get_zone_from_child(self, child_do_id):
-        for zone_id, zone_objects in list(self._zone_objects.items()):
-            if child_do_id in zone_objects:
-                return zone_id
-
-        return None
+        return self._child_zones.get(child_do_id)
 
     def get_zone_objects(self, zone_id):
-        if zone_id not in self._zone_objects:
+        zone_objects = self._zone_objects.get(zone_id)
+        if not zone_objects:
             return []
 
-        zone_objects = []
-        for do_id in list(self._zone_objects[zone_id]):
-            zone_object = self._network.object_manager.get_object(do_id)
-            if not zone_object:
-                continue
-
-            zone_objects.append(zone_object)
-
-        return zone_objects
+        return list(zone_objects.values())
 
     def get_all_zone_objects(self):
         zone_objects = []
-        for zone_id in list(self._zone_objects):
-            zone_objects.extend(self.get_zone_objects(zone_id))
+        for objects in self._zone_objects.values():
+            zone_objects.extend(objects.values())
 
         return zone_objects
 
@@ -245,43 +344,128 @@ class StateObject(object):
 
         return zone_objects
 
-    def append_required_data(self, datagram, broadcast_only=True):
+    def add_zone_observer(self, zone_id, channel):
+        if self._zone_observers is EMPTY_TABLE:
+            self._zone_observers = {}
+
+        observers = self._zone_observers.setdefault(zone_id, {})
+        observers[channel] = observers.get(channel, 0) + 1
+
+    def remove_zone_observer(self, zone_id, channel):
+        observers = self._zone_observers.get(zone_id)
+        if not observers or channel not in observers:
+            return
+
+        observers[channel] -= 1
+        if not observers[channel]:
+            del observers[channel]
+
+        if not observers:
+            del self._zone_observers[zone_id]
+
+    def get_zone_observers(self, zone_ids):
+        channels = set()
+        for zone_id in zone_ids:
+            observers = self._zone_observers.get(zone_id)
+            if observers:
+                channels.update(observers)
+
+        return channels
+
+    def update_child_observer(self, child_object):
+        """
+        Observes the child's zone through the child's current owner,
+        replacing the owner the zone was observed through before...
+        """
+
+        zone_id = self._child_zones.get(child_object.do_id)
+        if zone_id is None:
+            return
+
+        observer = self._child_observers.pop(child_object.do_id, 0)
+        if observer:
+            self.remove_zone_observer(zone_id, observer)
+
+        if child_object.owner_id:
+            if self._child_observers is EMPTY_TABLE:
+                self._child_observers = {}
+
+            self._child_observers[child_object.do_id] = child_object.owner_id
+            self.add_zone_observer(zone_id, child_object.owner_id)
+
+    def set_field(self, field, field_args):
+        """
+        Stores the arguments of a ram field, the packed field
+        data is rebuilt the next time the object is sent...
+        """
+
+        if field.is_required():
+            self._required_fields[field.number] = field_args
+            self._required_data = None
+            self._required_broadcast_data = None
+        else:
+            if self._other_fields is EMPTY_TABLE:
+                self._other_fields = {}
+
+            self._other_fields[field.number] = field_args
+            self._other_data = None
+
+        self.object_manager.handle_object_changed(self)
+
+    def pack_required_data(self, broadcast_only=True):
         sorted_fields = collections.OrderedDict(sorted(
             self._required_fields.items()))
 
-        field_packer = DCPacker()
+        fields, values = [], []
         for field_index, field_args in list(sorted_fields.items()):
-            field = self._dc_class.get_field_by_index(field_index)
+            field = self._dc_metadata.get_field_by_index(field_index)
             if not field:
                 self.notify.error('Failed to append required data for field: %d '
-                    'dclass: %s, unknown field!' % (field_index, self._dc_class.get_name()))
+                    'dclass: %s, unknown field!' % (field_index, self._dc_metadata.name))
 
             if broadcast_only and not field.is_broadcast():
                 continue
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
+            values.append(field_args)
 
-        datagram.append_data(field_packer.get_string())
+        return codec.pack_fields(fields, values)
 
-    def append_other_data(self, datagram):
-        field_packer = DCPacker()
+    def pack_other_data(self):
+        fields, values = [], []
         for field_index, field_args in list(self._other_fields.items()):
-            field = self._dc_class.get_field_by_index(field_index)
+            field = self._dc_metadata.get_field_by_index(field_index)
             if not field:
                 self.notify.error('Failed to append other data for field: %d '
-                    'dclass: %s, unknown field!' % (field_index, self._dc_class.get_name()))
+                    'dclass: %s, unknown field!' % (field_index, self._dc_metadata.name))
 
-            field_packer.raw_pack_uint16(field.get_number())
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, field_args)
-            field_packer.end_pack()
+            fields.append(field)
+            values.append(field_args)
 
-        datagram.add_uint16(len(self._other_fields))
-        datagram.append_data(field_packer.get_string())
+        return codec.UINT16.pack(len(fields)) + codec.pack_numbered_fields(fields, values)
+
+    def append_required_data(self, datagram, broadcast_only=True):
+        if broadcast_only:
+            if self._required_broadcast_data is None:
+                self._required_broadcast_data = self.pack_required_data(True)
+
+            datagram.append_data(self._required_broadcast_data)
+        else:
+            if self._required_data is None:
+                self._required_data = self.pack_required_data(False)
+
+            datagram.append_data(self._required_data)
+
+    def append_other_data(self, datagram):
+        if self._other_data is None:
+            self._other_data = self.pack_other_data()
+
+        datagram.append_data(self._other_data)
+
+    def setup(self, register=True):
+        if register:
+            self._network.register_for_channel(self._do_id)
 
-    def setup(self):
         self.object_manager.handle_changing_location(self)
 
     def handle_internal_datagram(self, sender, message_type, di):
@@ -329,7 +513,7 @@ class StateObject(object):
         datagram.add_uint64(self._do_id)
         datagram.add_uint64(self._parent_id)
         datagram.add_uint32(self._zone_id)
-        datagram.add_uint16(self._dc_class.get_number())
+        datagram.add_uint16(self._dc_metadata.number)
 
         self.append_required_data(datagram, broadcast_only=False)
         if self._has_other:
@@ -368,7 +552,7 @@ class StateObject(object):
         datagram.add_uint64(self._do_id)
         datagram.add_uint64(self._parent_id)
         datagram.add_uint32(self._zone_id)
-        datagram.add_uint16(self._dc_class.get_number())
+        datagram.add_uint16(self._dc_metadata.number)
 
         self.append_required_data(datagram, broadcast_only=not self._owner_id)
         if self._has_other:
@@ -405,14 +589,15 @@ class StateObject(object):
         self.object_manager.handle_changing_location(self)
 
     def handle_send_changing_location(self, channel):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(channel, self._do_id,
-            types.STATESERVER_OBJECT_CHANGING_LOCATION)
+        self.handle_send_changing_locations([channel])
 
-        datagram.add_uint32(self._do_id)
-        datagram.add_uint32(self._parent_id)
-        datagram.add_uint32(self._zone_id)
-        self._network.handle_send_connection_datagram(datagram)
+    def handle_send_changing_locations(self, channels):
+        for datagram in create_multi_datagrams(channels, self._do_id,
+                types.STATESERVER_OBJECT_CHANGING_LOCATION):
+            datagram.add_uint32(self._do_id)
+            datagram.add_uint32(self._parent_id)
+            datagram.add_uint32(self._zone_id)
+            self._network.handle_send_connection_datagram(datagram)
 
     def handle_set_zone(self, sender, di):
         new_zone_id = di.get_uint32()
@@ -421,32 +606,34 @@ class StateObject(object):
         self.object_manager.handle_changing_location(self)
 
     def handle_send_location_entry(self, channel):
-        datagram = io.NetworkDatagram()
+        self.handle_send_location_entries([channel])
+
+    def handle_send_location_entries(self, channels):
         if not self._has_other:
-            datagram.add_header(channel, self._do_id,
-                types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED)
+            message_type = types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED
         else:
-            datagram.add_header(channel, self._do_id,
-                types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER)
+            message_type = types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER
 
-        datagram.add_uint64(self._do_id)
-        datagram.add_uint64(self._parent_id)
-        datagram.add_uint32(self._zone_id)
-        datagram.add_uint16(self._dc_class.get_number())
+        for datagram in create_multi_datagrams(channels, self._do_id, message_type):
+            datagram.add_uint64(self._do_id)
+            datagram.add_uint64(self._parent_id)
+            datagram.add_uint32(self._zone_id)
+            datagram.add_uint16(self._dc_metadata.number)
 
-        self.append_required_data(datagram)
-        if self._has_other:
-            self.append_other_data(datagram)
+            self.append_required_data(datagram)
+            if self._has_other:
+                self.append_other_data(datagram)
 
-        self._network.handle_send_connection_datagram(datagram)
+            self._network.handle_send_connection_datagram(datagram)
 
     def handle_send_departure(self, channel):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(channel, self._do_id,
-            types.STATESERVER_OBJECT_DELETE_RAM)
+        self.handle_send_departures([channel])
 
-        datagram.add_uint32(self._do_id)
-        self._network.handle_send_connection_datagram(datagram)
+    def handle_send_departures(self, channels):
+        for datagram in create_multi_datagrams(channels, self._do_id,
+                types.STATESERVER_OBJECT_DELETE_RAM):
+            datagram.add_uint32(self._do_id)
+            self._network.handle_send_connection_datagram(datagram)
 
     def handle_send_object_location_ack(self, channel):
         datagram = io.NetworkDatagram()
@@ -465,12 +652,8 @@ class StateObject(object):
             datagram.add_uint32(0)
         self._network.handle_send_connection_datagram(datagram)
         
-    def has_zone_watcher(self, zone_id):
-        for sender in self._watch_list.keys():
-            if zone_id in self._watch_list[sender]:
-                return (True, sender)
-                
-        return (False, None)
+    def get_zone_watchers(self, zone_id):
+        return self._network.visibility_service.get_zone_watchers(self._do_id, zone_id)
 
     def handle_changing_location(self, child_do_id, new_parent_id, new_zone_id):
         # retrieve this object from it's do_id, if we cannot find this object in the do_id to do
@@ -479,51 +662,21 @@ class StateObject(object):
         if not child_object:
             return
 
-        send_location_entry = False
-        send_location_departure = False
-        if self.has_child(child_object.do_id):
-            child_zone_id = self.get_zone_from_child(child_object.do_id)
+        # remember who observed the child where it was before it moves, the
+        # generates and deletes are sent once the frame's moves are done...
+        self.object_manager.handle_location_change(self, child_object)
+
+        child_zone_id = self.get_zone_from_child(child_object.do_id)
+        if child_zone_id is not None:
             if new_parent_id != self._do_id:
                 self.remove_child_from_zone(child_object.do_id, child_zone_id)
-                send_location_departure = True
             elif new_zone_id != child_zone_id:
                 self.remove_child_from_zone(child_object.do_id, child_zone_id)
-                self.add_child_in_zone(child_object.do_id, new_zone_id)
-                send_location_entry = True
-                send_location_departure = True
+                self.add_child_in_zone(child_object, new_zone_id)
         else:
-            self.add_child_in_zone(child_object.do_id, new_zone_id)
-            send_location_entry = True
-            
-        #if self.object_manager.tracking == child_object.do_id:
-        #    print "yEEEEEEEEEEEEEs ", child_zone_id, new_zone_id
+            self.add_child_in_zone(child_object, new_zone_id)
 
-        # if this object is entering the new zone, then relay a location
-        # generate to everyone in the new zone.
-        if send_location_entry:
-            zone_objects = self.get_zone_objects(new_zone_id) 
-            
-            for zone_object in itertools.ifilter(lambda x: x.owner_id > 0, zone_objects):
-                child_object.handle_send_location_entry(zone_object.owner_id)
-
-            has_watcher, watcher = self.has_zone_watcher(new_zone_id)
-            if has_watcher:
-                child_object.handle_send_location_entry(watcher)
-                
-
-        # also send a departure to everyone in the object's old zone...
-        if send_location_departure:
-            zone_objects = self.get_zone_objects(child_zone_id)
-                
-            has_watcher_at_new, watcher = self.has_zone_watcher(new_zone_id)
-            
-            for zone_object in itertools.ifilter(lambda x: x.owner_id > 0, zone_objects):
-                if child_object.do_id != self._do_id:
-                    if (has_watcher_at_new and zone_object.owner_id != watcher) or not has_watcher_at_new:
-                        child_object.handle_send_departure(zone_object.owner_id)
-            
-            if has_watcher_at_new:
-                child_object.handle_send_changing_location(watcher)
+        self.object_manager.handle_location_changed(child_object)
 
         # acknowledge the object's location change was successful.
         if child_object.owner_id:
@@ -537,6 +690,7 @@ class StateObject(object):
 
         self.parent_id = new_parent_id
         self.zone_id = new_zone_id
+        self.object_manager.handle_object_changed(self)
 
         self.handle_changing_location(self._zone_id, new_parent_id, new_zone_id)
         if self.parent_id:
@@ -593,6 +747,12 @@ class StateObject(object):
                 if p.do_id != self._do_id and p.do_id != parent_object.do_id:
                     zone_objects.append(p)
 
+        # the objects that moved into the zones this frame are sent to their
+        # observers now, otherwise the sender would get a second generate once
+        # the frame is flushed, as it was not observing the zone before the move...
+        for zone_object in zone_objects:
+            self.object_manager.flush_location_change(zone_object.do_id)
+
         s = sender
         if self._owner_id:
             s = self._owner_id
@@ -606,7 +766,7 @@ class StateObject(object):
         datagram.add_uint32(contextId)
         datagram.add_uint16(len(zone_objects))
         for zone_object in zone_objects:
-            if zone_object.dc_class.get_name() == "DistributedSuit" and not self.object_manager.tracking:
+            if zone_object.dc_metadata.name == "DistributedSuit" and not self.object_manager.tracking:
                 print "will be keeping track of suit %d at %d" %(zone_object.do_id, zone_object.zone_id) 
                 self.object_manager.tracking = zone_object.do_id
             datagram.add_uint64(zone_object.do_id)
@@ -619,17 +779,15 @@ class StateObject(object):
             zone_object.handle_send_location_entry(sender)
             
         # now add the zone ids to the sender's watch list
-        if not self._watch_list.has_key(sender):
-            self._watch_list[sender] = []
         for zone_id in zone_ids:
-            if zone_id not in self._watch_list[sender]:
-                self._watch_list[sender].append(zone_id)
+            if self._network.visibility_service.add_watch(sender, self._do_id, zone_id):
+                self.add_zone_observer(zone_id, sender)
             
     def handle_clear_watch(self, sender, di):
-        if self._watch_list.has_key(sender):
+        if self._network.visibility_service.get_channel_zones(sender):
             zone_id = di.get_uint32()
-            if zone_id in self._watch_list[sender]:
-                self._watch_list[sender].remove(zone_id)
+            if self._network.visibility_service.remove_watch(sender, self._do_id, zone_id):
+                self.remove_zone_observer(zone_id, sender)
         else:
             self.notify.warning("Sender %d tried to clear watch zone but has no watch list!" %sender)
 
@@ -639,40 +797,42 @@ class StateObject(object):
             types.STATESERVER_OBJECT_UPDATE_FIELD)
 
         datagram.add_uint32(self._do_id)
-        datagram.add_uint16(field.get_number())
-
-        field_packer = DCPacker()
-        field_packer.begin_pack(field)
+        datagram.add_uint16(field.number)
         if field_args is not None:
-            field.pack_args(field_packer, field_args)
-
-        field_packer.end_pack()
+            datagram.append_data(field.codec.pack_args(field_args))
 
-        datagram.append_data(field_packer.get_string())
         self._network.handle_send_connection_datagram(datagram)
 
+    def handle_send_update_field_multiple(self, channels, sender, field, field_args):
+        """
+        Sends a field update to several channels at once, the message
+        director delivers a single datagram to every participant...
+        """
+
+        field_data = field.codec.pack_args(field_args) if field_args is not None else ''
+        for datagram in create_multi_datagrams(channels, sender,
+                types.STATESERVER_OBJECT_UPDATE_FIELD):
+            datagram.add_uint32(self._do_id)
+            datagram.add_uint16(field.number)
+            datagram.append_data(field_data)
+            self._network.handle_send_connection_datagram(datagram)
+
     def handle_send_save_field(self, field, field_args):
         datagram = io.NetworkDatagram()
         datagram.add_header(types.DATABASE_CHANNEL, self._do_id,
             types.DBSERVER_OBJECT_SET_FIELD)
 
         datagram.add_uint32(self._do_id)
-
-        field_packer = DCPacker()
-        field_packer.raw_pack_uint16(field.get_number())
-        field_packer.begin_pack(field)
-        field.pack_args(field_packer, field_args)
-        field_packer.end_pack()
-
-        datagram.append_data(field_packer.get_string())
+        datagram.add_uint16(field.number)
+        datagram.append_data(field.codec.pack_args(field_args))
         self._network.handle_send_connection_datagram(datagram)
 
     def handle_update_field(self, channel, sender, di):
         field_id = di.get_uint16()
-        field = self._dc_class.get_field_by_index(field_id)
+        field = self._dc_metadata.get_field_by_index(field_id)
         if not field:
             self.notify.warning('Failed to update field: %d dclass: %s, '
-                'unknown field!' % (field_id, self._dc_class.get_name()))
+                'unknown field!' % (field_id, self._dc_metadata.name))
 
             return
 
@@ -683,13 +843,8 @@ class StateObject(object):
         # if the iterator is empty, this means that the field
         # has no arguents and that we should not attempt to update it...
         if di.get_remaining_size():
-            field_packer = DCPacker()
-            field_packer.set_unpack_data(di.get_remaining_bytes())
-
             try:
-                field_packer.begin_unpack(field)
-                field_args = field.unpack_args(field_packer)
-                field_packer.end_unpack()
+                field_args, _ = field.codec.unpack_args(di.get_remaining_bytes())
             except RuntimeError:
                 # apparently we failed to unpack the arguments for
                 # this field we recieved, ignore the update...
@@ -704,11 +859,11 @@ class StateObject(object):
         #
         #    return
 
-        if not self._network.shard_manager.has_shard(sender) and sender != types.UD_CHANNEL:
+        if not self._network.shard_manager.is_ai_channel(sender):
             avatar_id = self._network.get_avatar_id_from_connection_channel(sender)
             if not avatar_id:
                 self.notify.warning('Cannot handle field update for field: %s dclass: %s, '
-                    'unknown avatar: %d!' % (field.get_name(), self._dc_class.get_name(), avatar_id))
+                    'unknown avatar: %d!' % (field.name, self._dc_metadata.name, avatar_id))
 
                 return
 
@@ -720,13 +875,13 @@ class StateObject(object):
             if field.is_ownsend():
                 if sender != self._owner_id:
                     self.notify.warning('Cannot handle field update for field: %s '
-                        'dclass: %s, field not sendable!' % (field.get_name(), self._dc_class.get_name()))
+                        'dclass: %s, field not sendable!' % (field.name, self._dc_metadata.name))
 
                     return
             else:
                 if not field.is_clsend():
                     self.notify.warning('Cannot handle field update for field: %s '
-                        'dclass: %s, field not sendable!' % (field.get_name(), self._dc_class.get_name()))
+                        'dclass: %s, field not sendable!' % (field.name, self._dc_metadata.name))
 
                     return
 
@@ -749,12 +904,9 @@ class StateObject(object):
                     if not self._has_other:
                         return
 
-                    # check to see if this field is a required field, if it is then
-                    # this means it should be stored as a required field....
-                    if field.is_required():
-                        self._required_fields[field.get_number()] = field_args
-                    else:
-                        self._other_fields[field.get_number()] = field_args
+                    # store the field, required fields are stored separately from the
+                    # other fields and the cached generate data is invalidated...
+                    self.set_field(field, field_args)
         else:
             # we must always send this update to the other receiver,
             # so that they get the field update always even if the field
@@ -770,12 +922,9 @@ class StateObject(object):
                 # if the AI object sends specifically other (ram) fields for this object,
                 # this means the object now has other fields...
                 if field.is_ram():
-                    # check to see if this field is a required field, if it is then
-                    # this means it should be stored as a required field....
-                    if field.is_required():
-                        self._required_fields[field.get_number()] = field_args
-                    else:
-                        self._other_fields[field.get_number()] = field_args
+                    # store the field, required fields are stored separately from the
+                    # other fields and the cached generate data is invalidated...
+                    self.set_field(field, field_args)
 
                     # the object now has other fields, let's update the object's has_other
                     # value so that generates will be sent including the other fields...
@@ -798,11 +947,194 @@ class StateObject(object):
         if parent_object is not None:
             parent_object.handle_changing_location(self._do_id, self._parent_id, self._zone_id)
 
+        self.clear()
+
+    def clear(self):
+        """
+        Drops the object's fields, children and watches without telling anyone
+        """
+
         self._required_fields = {}
-        self._other_fields = {}
+        self._other_fields = EMPTY_TABLE
+
+        self._required_data = None
+        self._required_broadcast_data = None
+        self._other_data = None
+
+        self._zone_objects = EMPTY_TABLE
+        self._child_zones = EMPTY_TABLE
+        self._zone_observers = EMPTY_TABLE
+        self._child_observers = EMPTY_TABLE
+        self._network.visibility_service.remove_parent(self._do_id)
+
+
+class VisibilityService(object):
+    """
+    Keeps track of which channels watch which zones of which parent, indexed
+    both ways so that "who sees this zone" and "what does this channel see"
+    are single lookups. The client agent already opens watches on the zones
+    visible from a client's zone, so the watches alone cover visibility...
+    """
+
+    notify = notify.new_category('VisibilityService')
+
+    def __init__(self):
+        self._zone_watchers = {}
+        self._channel_zones = {}
+        self._parent_zones = {}
+
+        # the watches added or removed since the last snapshot, only
+        # tracked while the state server keeps a snapshot...
+        self._track_changes = False
+        self._added_watches = set()
+        self._removed_watches = set()
+
+    @property
+    def track_changes(self):
+        return self._track_changes
 
-        self._zone_objects = {}
+    @track_changes.setter
+    def track_changes(self, track_changes):
+        self._track_changes = track_changes
+        self._added_watches.clear()
+        self._removed_watches.clear()
 
+    def get_watches(self):
+        """
+        Returns every watch as a channel, parent_id and zone_id
+        """
+
+        return [(channel, parent_id, zone_id) for (parent_id, zone_id), watchers in
+            self._zone_watchers.items() for channel in watchers]
+
+    def pop_changes(self):
+        """
+        Returns the watches added and removed since this was last called
+        """
+
+        added_watches = sorted(self._added_watches)
+        removed_watches = sorted(self._removed_watches)
+
+        self._added_watches.clear()
+        self._removed_watches.clear()
+        return added_watches, removed_watches
+
+    def __handle_watch_changed(self, watch, added):
+        if not self._track_changes:
+            return
+
+        # a watch added and removed again since the last
+        # snapshot does not have to be written at all...
+        if added:
+            if watch in self._removed_watches:
+                self._removed_watches.remove(watch)
+            else:
+                self._added_watches.add(watch)
+        elif watch in self._added_watches:
+            self._added_watches.remove(watch)
+        else:
+            self._removed_watches.add(watch)
+
+    def get_zone_watchers(self, parent_id, zone_id):
+        return self._zone_watchers.get((parent_id, zone_id), frozenset())
+
+    def get_channel_zones(self, channel):
+        return self._channel_zones.get(channel, frozenset())
+
+    def is_watching(self, channel, parent_id, zone_id):
+        return channel in self._zone_watchers.get((parent_id, zone_id), ())
+
+    def add_watch(self, channel, parent_id, zone_id):
+        """
+        Adds a zone to the channel's watch list, returns
+        False if the channel was already watching it...
+        """
+
+        location = (parent_id, zone_id)
+        watchers = self._zone_watchers.setdefault(location, set())
+        if channel in watchers:
+            return False
+
+        watchers.add(channel)
+        self._channel_zones.setdefault(channel, set()).add(location)
+        self._parent_zones.setdefault(parent_id, set()).add(zone_id)
+        self.__handle_watch_changed((channel, parent_id, zone_id), True)
+        return True
+
+    def remove_watch(self, channel, parent_id, zone_id):
+        location = (parent_id, zone_id)
+        watchers = self._zone_watchers.get(location)
+        if not watchers or channel not in watchers:
+            return False
+
+        watchers.remove(channel)
+        if not watchers:
+            del self._zone_watchers[location]
+            self.__discard(self._parent_zones, parent_id, zone_id)
+
+        self.__discard(self._channel_zones, channel, location)
+        self.__handle_watch_changed((channel, parent_id, zone_id), False)
+        return True
+
+    def remove_parent(self, parent_id):
+        """
+        Removes every watch on the zones of a parent that was deleted
+        """
+
+        for zone_id in self._parent_zones.pop(parent_id, ()):
+            location = (parent_id, zone_id)
+            for channel in self._zone_watchers.pop(location, ()):
+                self.__discard(self._channel_zones, channel, location)
+                self.__handle_watch_changed((channel, parent_id, zone_id), False)
+
+    def __discard(self, index, key, value):
+        values = index.get(key)
+        if values is None:
+            return
+
+        values.discard(value)
+        if not values:
+            del index[key]
+
+class LocationChange(object):
+    """
+    Where an object was and who observed it there when it first moved within
+    a frame, once the frame is done it is compared to where the object ended up...
+    """
+
+    __slots__ = ('state_object', 'locations', 'channels')
+
+    def __init__(self, state_object):
+        self.state_object = state_object
+        self.locations = {}
+        self.channels = set()
+
+    def add_parent(self, parent_object):
+        if parent_object.do_id in self.locations:
+            return
+
+        zone_id = parent_object.get_zone_from_child(self.state_object.do_id)
+        self.locations[parent_object.do_id] = (parent_object, zone_id)
+        if zone_id is not None:
+            self.channels.update(parent_object.get_zone_observers([zone_id]))
+
+    def get_current_channels(self):
+        """
+        Returns the channels observing the object now,
+        and whether the object moved at all...
+        """
+
+        channels = set()
+        moved = False
+        for parent_object, zone_id in self.locations.values():
+            current_zone_id = parent_object.get_zone_from_child(self.state_object.do_id)
+            if current_zone_id != zone_id:
+                moved = True
+
+            if current_zone_id is not None:
+                channels.update(parent_object.get_zone_observers([current_zone_id]))
+
+        return channels, moved
 
 class StateObjectManager(object):
     notify = notify.new_category('StateObjectManager')
@@ -812,15 +1144,65 @@ class StateObjectManager(object):
         self.context_queue = SimpleContextQueue()
         self.tracking = None
 
+        self._batch_locations = config.GetBool('stateserver-batch-locations', True)
+        self._location_changes = collections.OrderedDict()
+
+        # secondary indexes of the objects, so that the objects of a shard or
+        # the owned objects can be found without scanning every object...
+        self._ai_objects = {}
+        self._owned_objects = collections.OrderedDict()
+
+        # the objects changed or deleted since the last snapshot, only
+        # tracked while the state server keeps a snapshot...
+        self._track_changes = False
+        self._changed_objects = set()
+        self._deleted_objects = set()
+
+    @property
+    def track_changes(self):
+        return self._track_changes
+
+    @track_changes.setter
+    def track_changes(self, track_changes):
+        self._track_changes = track_changes
+        self._changed_objects.clear()
+        self._deleted_objects.clear()
+
     def has_object(self, do_id):
         return do_id in self.objects
 
-    def add_object(self, state_object):
+    def add_object(self, state_object, register=True):
         if self.has_object(state_object.do_id):
             return
 
         self.objects[state_object.do_id] = state_object
-        state_object.setup()
+        self.__index_ai_channel(state_object, state_object.ai_channel)
+        if state_object.owner_id:
+            self._owned_objects[state_object.do_id] = state_object
+
+        self.handle_object_changed(state_object)
+        state_object.setup(register)
+
+    def restore_objects(self, state_objects):
+        """
+        Adds objects loaded from a snapshot without sending anything, everyone
+        that knew about the objects before the restart still knows about them...
+        """
+
+        for state_object in state_objects:
+            if self.has_object(state_object.do_id):
+                continue
+
+            self.objects[state_object.do_id] = state_object
+            self.__index_ai_channel(state_object, state_object.ai_channel)
+            if state_object.owner_id:
+                self._owned_objects[state_object.do_id] = state_object
+
+        # the parents are only known once every object has been added...
+        for state_object in state_objects:
+            parent_object = self.get_object(state_object.parent_id)
+            if parent_object is not None and parent_object is not state_object:
+                parent_object.add_child_in_zone(state_object, state_object.zone_id)
 
     def remove_object(self, state_object):
         if not self.has_object(state_object.do_id):
@@ -828,12 +1210,134 @@ class StateObjectManager(object):
 
         state_object.destroy()
         del self.objects[state_object.do_id]
+        self.__unindex_ai_channel(state_object, state_object.ai_channel)
+        self._owned_objects.pop(state_object.do_id, None)
+        self.handle_object_deleted(state_object)
 
     def get_object(self, do_id):
         return self.objects.get(do_id)
 
+    def get_delete_sets(self, state_objects, excludes=()):
+        """
+        Returns the do_ids each channel has to delete once the objects are gone,
+        the channels observing the zone each object is in under it's parent...
+        """
+
+        delete_sets = {}
+        for state_object in state_objects:
+            parent_object = self.get_object(state_object.parent_id)
+            if parent_object is None:
+                continue
+
+            zone_id = parent_object.get_zone_from_child(state_object.do_id)
+            if zone_id is None:
+                continue
+
+            for channel in parent_object.get_zone_observers([zone_id]):
+                if channel not in excludes:
+                    delete_sets.setdefault(channel, []).append(state_object.do_id)
+
+        return delete_sets
+
+    def discard_objects(self, state_objects):
+        """
+        Removes several objects at once without sending anything, the objects
+        are only removed from the zones of the parents that are not removed...
+        """
+
+        do_ids = set(state_object.do_id for state_object in state_objects)
+        for state_object in state_objects:
+            if self.objects.get(state_object.do_id) is not state_object:
+                continue
+
+            parent_object = self.get_object(state_object.parent_id)
+            if parent_object is not None and parent_object.do_id not in do_ids:
+                zone_id = parent_object.get_zone_from_child(state_object.do_id)
+                if zone_id is not None:
+                    parent_object.remove_child_from_zone(state_object.do_id, zone_id)
+
+            state_object.clear()
+            del self.objects[state_object.do_id]
+            self.__unindex_ai_channel(state_object, state_object.ai_channel)
+            self._owned_objects.pop(state_object.do_id, None)
+            self._location_changes.pop(state_object.do_id, None)
+            self.handle_object_deleted(state_object)
+
+    def get_ai_objects(self, ai_channel):
+        ai_objects = self._ai_objects.get(ai_channel)
+        if not ai_objects:
+            return []
+
+        return list(ai_objects.values())
+
+    def get_owned_objects(self):
+        return list(self._owned_objects.values())
+
+    def handle_ai_channel_changed(self, state_object):
+        if self.objects.get(state_object.do_id) is not state_object:
+            return
+
+        self.__unindex_ai_channel(state_object, state_object.old_ai_channel)
+        self.__index_ai_channel(state_object, state_object.ai_channel)
+        self.handle_object_changed(state_object)
+
+    def handle_owner_changed(self, state_object):
+        if self.objects.get(state_object.do_id) is not state_object:
+            return
+
+        if state_object.owner_id:
+            self._owned_objects[state_object.do_id] = state_object
+        else:
+            self._owned_objects.pop(state_object.do_id, None)
+
+        self.handle_object_changed(state_object)
+
+    def handle_object_changed(self, state_object):
+        if not self._track_changes or self.objects.get(state_object.do_id) is not state_object:
+            return
+
+        self._changed_objects.add(state_object.do_id)
+        self._deleted_objects.discard(state_object.do_id)
+
+    def handle_object_deleted(self, state_object):
+        if not self._track_changes:
+            return
+
+        self._changed_objects.discard(state_object.do_id)
+        self._deleted_objects.add(state_object.do_id)
+
+    def pop_changes(self):
+        """
+        Returns the objects changed and the do_ids deleted since this was last called
+        """
+
+        changed_objects = [self.objects[do_id] for do_id in sorted(self._changed_objects)]
+        deleted_objects = sorted(self._deleted_objects)
+
+        self._changed_objects.clear()
+        self._deleted_objects.clear()
+        return changed_objects, deleted_objects
+
+    def __index_ai_channel(self, state_object, ai_channel):
+        ai_objects = self._ai_objects.get(ai_channel)
+        if ai_objects is None:
+            ai_objects = self._ai_objects[ai_channel] = collections.OrderedDict()
+
+        ai_objects[state_object.do_id] = state_object
+
+    def __unindex_ai_channel(self, state_object, ai_channel):
+        ai_objects = self._ai_objects.get(ai_channel)
+        if ai_objects is None:
+            return
+
+        ai_objects.pop(state_object.do_id, None)
+        if not ai_objects:
+            del self._ai_objects[ai_channel]
+
     def handle_changing_location(self, state_object):
         assert(state_object != None)
+        self.handle_object_changed(state_object)
+
         # tell the object's previous parent that we've moved away from under
         # them and are no longer in the previous location...
         if state_object.old_parent_id:
@@ -844,8 +1348,61 @@ class StateObjectManager(object):
         if state_object.parent_id:
             state_object.handle_send_changing_location(state_object.parent_id)
 
+    def handle_location_change(self, parent_object, state_object):
+        change = self._location_changes.get(state_object.do_id)
+        if change is None:
+            change = self._location_changes[state_object.do_id] = LocationChange(state_object)
+
+        change.add_parent(parent_object)
+
+    def handle_location_changed(self, state_object):
+        if not self._batch_locations:
+            self.flush_location_change(state_object.do_id)
+
+    def flush_location_change(self, do_id):
+        change = self._location_changes.pop(do_id, None)
+        if change is not None:
+            self.send_location_change(change)
+
+    def flush_location_changes(self):
+        """
+        Sends the net result of every move made this frame, an object
+        that moved back to where it started is not sent at all...
+        """
+
+        while self._location_changes:
+            _, change = self._location_changes.popitem(last=False)
+            self.send_location_change(change)
+
+    def send_location_change(self, change):
+        new_channels, moved = change.get_current_channels()
+        if not moved:
+            return
+
+        # the owner is sent a generate of it's own object in every zone it enters
+        state_object = change.state_object
+        old_channels = change.channels
+        old_channels.discard(state_object.owner_id)
+
+        departed = old_channels - new_channels
+        if departed:
+            state_object.handle_send_departures(sorted(departed))
+
+        entered = new_channels - old_channels
+        if entered:
+            state_object.handle_send_location_entries(sorted(entered))
+
+        # the channels observing both locations already have the object...
+        changed = old_channels & new_channels
+        if changed:
+            state_object.handle_send_changing_locations(sorted(changed))
+
     def handle_updating_field(self, state_object, sender, field, field_args, excludes=[]):
         assert(state_object != None)
+
+        # observers entering the object's zone this frame need the
+        # generate before they can handle the update...
+        self.flush_location_change(state_object.do_id)
         if not state_object.parent_id:
             self.notify.debug('Cannot handle updating field for object: %d, '
                 'object has no parent!' % state_object.do_id)
@@ -859,12 +1416,382 @@ class StateObjectManager(object):
 
             return
 
-        if not parent_object.has_child(state_object.do_id):
+        zone_id = parent_object.get_zone_from_child(state_object.do_id)
+        if zone_id is None:
+            return
+
+        # only the owners and watchers of the object's zone observe the update,
+        # the excluded objects are the ones the update came from...
+        channels = parent_object.get_zone_observers([zone_id])
+        for do_id in excludes:
+            exclude_object = self.get_object(do_id)
+            if exclude_object is not None:
+                channels.discard(exclude_object.owner_id)
+
+        if not channels:
             return
 
-        child_zone_id = parent_object.get_zone_from_child(state_object.do_id)
-        for zone_object in itertools.ifilter(lambda x: x.owner_id > 0 and x.do_id not in excludes, parent_object.get_all_zone_objects()):
-            state_object.handle_send_update_field(zone_object.owner_id, state_object.do_id, field, field_args)
+        state_object.handle_send_update_field_multiple(sorted(channels), state_object.do_id,
+            field, field_args)
+
+
+class PendingGenerate(object):
+    __slots__ = ('sender', 'has_other', 'do_id', 'parent_id', 'zone_id', 'dc_class', 'di')
+
+    def __init__(self, sender, has_other, do_id, parent_id, zone_id, dc_class, di):
+        self.sender = sender
+        self.has_other = has_other
+        self.do_id = do_id
+        self.parent_id = parent_id
+        self.zone_id = zone_id
+        self.dc_class = dc_class
+        self.di = di
+
+
+class GenerateQueue(object):
+    """
+    Holds generates until the state server has the budget to create the objects,
+    the generates of clients are always created before those of the AIs so that
+    an AI creating it's district does not hold up everyone else...
+    """
+
+    def __init__(self):
+        self._max_generates = config.GetInt('stateserver-generate-max-per-frame', 250)
+        self._max_usec = config.GetInt('stateserver-generate-max-usec', 0)
+
+        self._client_generates = collections.OrderedDict()
+        self._ai_generates = collections.OrderedDict()
+
+    @property
+    def enabled(self):
+        return bool(self._max_generates or self._max_usec)
+
+    def __len__(self):
+        return len(self._client_generates) + len(self._ai_generates)
+
+    def has_generate(self, do_id):
+        return do_id in self._client_generates or do_id in self._ai_generates
+
+    def add_generate(self, generate, ai_generate):
+        if ai_generate:
+            self._ai_generates[generate.do_id] = generate
+        else:
+            self._client_generates[generate.do_id] = generate
+
+    def remove_generate(self, do_id):
+        generate = self._client_generates.pop(do_id, None)
+        if generate is None:
+            generate = self._ai_generates.pop(do_id, None)
+
+        return generate
+
+    def remove_sender_generates(self, sender):
+        for generates in (self._client_generates, self._ai_generates):
+            for do_id, generate in list(generates.items()):
+                if generate.sender == sender:
+                    del generates[do_id]
+
+    def pop_generates(self):
+        """
+        Returns the generates to create this frame, until either
+        the count or the time budget runs out...
+        """
+
+        start_time = time.time()
+        generates = []
+        while self._client_generates or self._ai_generates:
+            if self._max_generates and len(generates) >= self._max_generates:
+                break
+
+            if self._max_usec and (time.time() - start_time) * 1000000 >= self._max_usec:
+                break
+
+            queue = self._client_generates or self._ai_generates
+            generates.append(queue.popitem(last=False)[1])
+
+        return generates
+
+
+class StateSnapshot(object):
+    """
+    A file of the state server's shards and objects, the objects changed since
+    the last write are appended to the end of the file as records and the whole
+    file is rewritten once the records far outnumber the live objects...
+
+    The records are packed on the calling thread, once started they are written
+    (and synced) to the file by a writer thread so a slow disk cannot stall routing.
+    """
+
+    notify = notify.new_category('StateSnapshot')
+
+    SNAPSHOT_MAGIC = 'OTPS'
+    SNAPSHOT_VERSION = 1
+
+    # the file is rewritten once it has this many records for every live object
+    COMPACTION_RATIO = 2
+    COMPACTION_MIN_RECORDS = 1024
+
+    RECORD_OBJECT = 1
+    RECORD_DELETE = 2
+    RECORD_SHARDS = 3
+    RECORD_WATCH = 4
+    RECORD_CLEAR_WATCH = 5
+
+    HEADER = struct.Struct('<4sHI')
+    RECORD = struct.Struct('<BI')
+    OBJECT = struct.Struct('<IIIHQQB')
+    SHARD = struct.Struct('<QIIH')
+    DO_ID = struct.Struct('<I')
+    WATCH = struct.Struct('<QII')
+
+    def __init__(self, filename, sync=True):
+        self._filename = filename
+        self._sync = sync
+        self._num_records = 0
+        self._shard_data = None
+        self._valid = False
+
+        self._writes = Queue.Queue()
+        self._writer = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def num_records(self):
+        return self._num_records
+
+    def start(self):
+        """
+        Starts writing to the file on the writer thread
+        """
+
+        if self._writer is not None:
+            return
+
+        self._writer = threading.Thread(target=self.__write_files, name='snapshot-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def stop(self):
+        """
+        Waits for the writes already handed to the writer thread
+        to finish, later writes are made on the calling thread
+        """
+
+        if self._writer is None:
+            return
+
+        self._writes.put(None)
+        self._writer.join()
+        self._writer = None
+
+    def __write_files(self):
+        while True:
+            write = self._writes.get()
+            if write is None:
+                break
+
+            method, data = write
+            method(data)
+
+    def __submit(self, method, data):
+        if self._writer is None:
+            method(data)
+        else:
+            self._writes.put((method, data))
+
+    def needs_compaction(self, num_objects):
+        if not self._valid:
+            return True
+
+        return self._num_records > max(num_objects * self.COMPACTION_RATIO,
+            self.COMPACTION_MIN_RECORDS)
+
+    def pack_record(self, kind, data):
+        return self.RECORD.pack(kind, len(data)) + data
+
+    def pack_object(self, state_object):
+        datagram = io.NetworkDatagram()
+        state_object.append_required_data(datagram, False)
+        if state_object.has_other:
+            state_object.append_other_data(datagram)
+
+        return self.pack_record(self.RECORD_OBJECT, self.OBJECT.pack(state_object.do_id,
+            state_object.parent_id, state_object.zone_id, state_object.dc_metadata.number,
+            state_object.ai_channel, state_object.owner_id, state_object.has_other) +
+            datagram.get_message())
+
+    def unpack_object(self, data):
+        """
+        Returns the do_id, parent_id, zone_id, dclass number, ai channel, owner,
+        has_other and the packed field data of an object record...
+        """
+
+        return self.OBJECT.unpack_from(data) + (data[self.OBJECT.size:],)
+
+    def pack_watch(self, kind, watch):
+        return self.pack_record(kind, self.WATCH.pack(*watch))
+
+    def get_shard_data(self, shards):
+        return tuple(sorted((shard.channel, shard.district_id, shard.name, shard.population)
+            for shard in shards))
+
+    def pack_shards(self, shard_data):
+        data = [codec.UINT16.pack(len(shard_data))]
+        for channel, district_id, name, population in shard_data:
+            data.append(self.SHARD.pack(channel, district_id, population, len(name)) + name)
+
+        return self.pack_record(self.RECORD_SHARDS, ''.join(data))
+
+    def unpack_shards(self, data):
+        num_shards, offset = codec.unpack_uint16(data)
+        shard_data = []
+        for _ in xrange(num_shards):
+            channel, district_id, population, name_length = self.SHARD.unpack_from(data, offset)
+            offset += self.SHARD.size
+            shard_data.append((channel, district_id, data[offset:offset + name_length], population))
+            offset += name_length
+
+        return shard_data
+
+    def load(self, hash_value):
+        """
+        Reads the snapshot, returns the shards, the object records and the watches
+        or None if there is no snapshot usable with the currently loaded dc files...
+        """
+
+        try:
+            with open(self._filename, 'rb') as snapshot_file:
+                data = snapshot_file.read()
+        except IOError as e:
+            self.notify.info('Cannot load snapshot: %s, %s.' % (self._filename, e))
+            return None
+
+        if len(data) < self.HEADER.size:
+            self.notify.warning('Cannot load snapshot: %s, truncated header!' % self._filename)
+            return None
+
+        magic, version, snapshot_hash_value = self.HEADER.unpack_from(data)
+        if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+            self.notify.warning('Cannot load snapshot: %s, unknown version!' % self._filename)
+            return None
+
+        if snapshot_hash_value != hash_value:
+            self.notify.warning('Cannot load snapshot: %s, written with '
+                'different dc files!' % self._filename)
+
+            return None
+
+        shard_data = []
+        objects = collections.OrderedDict()
+        watches = set()
+
+        offset = self.HEADER.size
+        while offset + self.RECORD.size <= len(data):
+            kind, length = self.RECORD.unpack_from(data, offset)
+            if offset + self.RECORD.size + length > len(data):
+                break
+
+            offset += self.RECORD.size
+            record = data[offset:offset + length]
+            offset += length
+
+            if kind == self.RECORD_OBJECT:
+                do_id, = self.DO_ID.unpack_from(record)
+                objects.pop(do_id, None)
+                objects[do_id] = record
+            elif kind == self.RECORD_DELETE:
+                objects.pop(self.DO_ID.unpack_from(record)[0], None)
+            elif kind == self.RECORD_SHARDS:
+                shard_data = self.unpack_shards(record)
+            elif kind == self.RECORD_WATCH:
+                watches.add(self.WATCH.unpack(record))
+            elif kind == self.RECORD_CLEAR_WATCH:
+                watches.discard(self.WATCH.unpack(record))
+            else:
+                self.notify.warning('Cannot load snapshot: %s, unknown record '
+                    'type: %d!' % (self._filename, kind))
+
+                return None
+
+        # the last write may have been interrupted, the records
+        # before it are still a consistent snapshot...
+        if offset != len(data):
+            self.notify.warning('Ignoring truncated record at the end of snapshot: %s!' % (
+                self._filename))
+
+        return shard_data, list(objects.values()), sorted(watches)
+
+    def write(self, hash_value, shards, state_objects, watches):
+        """
+        Rewrites the whole snapshot, to a temporary file first
+        so a crash never leaves a partially written snapshot...
+        """
+
+        shard_data = self.get_shard_data(shards)
+        records = [self.pack_shards(shard_data)]
+        records.extend(self.pack_object(state_object) for state_object in state_objects)
+        records.extend(self.pack_watch(self.RECORD_WATCH, watch) for watch in watches)
+
+        self._num_records = len(records)
+        self._shard_data = shard_data
+        self._valid = True
+
+        self.__submit(self.__write_file, self.HEADER.pack(self.SNAPSHOT_MAGIC,
+            self.SNAPSHOT_VERSION, hash_value) + ''.join(records))
+
+    def __write_file(self, data):
+        temp_filename = '%s.%d.tmp' % (self._filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                if self._sync:
+                    os.fsync(snapshot_file.fileno())
+
+            os.rename(temp_filename, self._filename)
+        except (IOError, OSError) as e:
+            # the file is rewritten on the next update...
+            self.notify.warning('Failed to write snapshot: %s, %s!' % (self._filename, e))
+            self._valid = False
+
+    def append(self, shards, changed_objects, deleted_do_ids, added_watches, removed_watches):
+        """
+        Appends the objects and watches changed since the last write
+        """
+
+        records = []
+        shard_data = self.get_shard_data(shards)
+        if shard_data != self._shard_data:
+            records.append(self.pack_shards(shard_data))
+
+        records.extend(self.pack_object(state_object) for state_object in changed_objects)
+        records.extend(self.pack_record(self.RECORD_DELETE, self.DO_ID.pack(do_id))
+            for do_id in deleted_do_ids)
+        records.extend(self.pack_watch(self.RECORD_CLEAR_WATCH, watch)
+            for watch in removed_watches)
+        records.extend(self.pack_watch(self.RECORD_WATCH, watch) for watch in added_watches)
+
+        if not records:
+            return
+
+        self._num_records += len(records)
+        self._shard_data = shard_data
+        self.__submit(self.__append_file, ''.join(records))
+
+    def __append_file(self, data):
+        try:
+            with open(self._filename, 'ab') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                if self._sync:
+                    os.fsync(snapshot_file.fileno())
+        except (IOError, OSError) as e:
+            # the changes are lost from the file, so it is rewritten on the next update...
+            self.notify.warning('Failed to append to snapshot: %s, %s!' % (self._filename, e))
+            self._valid = False
 
 
 class StateServer(io.NetworkConnector):
@@ -875,6 +1802,164 @@ class StateServer(io.NetworkConnector):
 
         self.shard_manager = ShardManager()
         self.object_manager = StateObjectManager()
+        self.visibility_service = VisibilityService()
+
+        self.__location_task = None
+
+        self.generate_queue = GenerateQueue()
+        self.__generate_task = None
+
+        snapshot_filename = config.GetString('stateserver-snapshot-file', '')
+        self._snapshot = StateSnapshot(snapshot_filename, config.GetBool(
+            'stateserver-snapshot-sync', True)) if snapshot_filename else None
+        self.__snapshot_task = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def setup(self):
+        io.NetworkConnector.setup(self)
+
+        if self._snapshot is not None:
+            if config.GetBool('stateserver-warm-start', False):
+                self.restore_snapshot()
+
+            # start the snapshot over with the objects we have now, this drops
+            # whatever was left of the previous process' snapshot...
+            self.object_manager.track_changes = True
+            self.visibility_service.track_changes = True
+            self.write_snapshot()
+            self._snapshot.start()
+
+            self.__snapshot_task = task_mgr.doMethodLater(config.GetFloat(
+                'stateserver-snapshot-interval', 5.0), self.__update_snapshot,
+                self.get_unique_name('update-snapshot'))
+
+        # the queued generates are created before the frame's moves are
+        # flushed, so the new objects are sent within the same frame...
+        if self.generate_queue.enabled:
+            self.__generate_task = task_mgr.add(self.__create_generates,
+                self.get_unique_name('create-generates'),
+                sort=config.GetInt('stateserver-generate-sort', 30))
+
+        # the moves made while handling this frame's datagrams are sent
+        # before the connection's output is flushed at the end of the frame...
+        self.__location_task = task_mgr.add(self.__flush_location_changes,
+            self.get_unique_name('flush-location-changes'),
+            sort=config.GetInt('stateserver-location-flush-sort', 40))
+
+    def __flush_location_changes(self, task):
+        self.object_manager.flush_location_changes()
+        return task.cont
+
+    def __update_snapshot(self, task):
+        self.update_snapshot()
+        return task.again
+
+    def __create_generates(self, task):
+        self.create_generates()
+        return task.cont
+
+    def shutdown(self):
+        if self.__generate_task:
+            task_mgr.remove(self.__generate_task)
+            self.__generate_task = None
+
+        if self.__location_task:
+            task_mgr.remove(self.__location_task)
+            self.__location_task = None
+
+        self.object_manager.flush_location_changes()
+
+        if self.__snapshot_task:
+            task_mgr.remove(self.__snapshot_task)
+            self.__snapshot_task = None
+
+            self.update_snapshot()
+            self._snapshot.stop()
+
+        io.NetworkConnector.shutdown(self)
+
+    def write_snapshot(self):
+        self.object_manager.pop_changes()
+        self.visibility_service.pop_changes()
+        self._snapshot.write(self.dc_loader.hash_value, self.shard_manager.shards.values(),
+            self.object_manager.objects.values(), self.visibility_service.get_watches())
+
+    def update_snapshot(self):
+        """
+        Appends the objects changed since the last update to the
+        snapshot, or rewrites it once it has grown too large...
+        """
+
+        if self._snapshot.needs_compaction(len(self.object_manager.objects)):
+            self.write_snapshot()
+            return
+
+        changed_objects, deleted_do_ids = self.object_manager.pop_changes()
+        added_watches, removed_watches = self.visibility_service.pop_changes()
+        self._snapshot.append(self.shard_manager.shards.values(), changed_objects,
+            deleted_do_ids, added_watches, removed_watches)
+
+    def restore_snapshot(self):
+        """
+        Loads the shards and objects of the previous process from the snapshot,
+        nothing is sent for them as the AIs and clients still know about them...
+        """
+
+        start_time = time.time()
+        snapshot = self._snapshot.load(self.dc_loader.hash_value)
+        if snapshot is None:
+            return
+
+        shard_data, object_records, watches = snapshot
+        for channel, district_id, name, population in shard_data:
+            self.shard_manager.add_shard(channel, district_id, name, population)
+
+        state_objects = []
+        for object_record in object_records:
+            do_id, parent_id, zone_id, dc_id, ai_channel, owner_id, has_other, field_data = \
+                self._snapshot.unpack_object(object_record)
+
+            dc_class = self.dc_loader.class_metadata_by_number.get(dc_id)
+            if not dc_class:
+                self.notify.warning('Failed to restore object: %d, no dclass '
+                    'found for dc_id: %d!' % (do_id, dc_id))
+
+                continue
+
+            datagram = io.NetworkDatagram()
+            datagram.append_data(field_data)
+            try:
+                state_object = StateObject(self, self.object_manager, do_id, parent_id,
+                    zone_id, dc_class, bool(has_other), io.NetworkDatagramIterator(datagram))
+            except codec.DCCodecError as e:
+                self.notify.warning('Failed to restore object: %d, %s!' % (do_id, e))
+                continue
+
+            state_object.ai_channel = ai_channel
+            state_object.owner_id = owner_id
+            state_objects.append(state_object)
+
+        self.object_manager.restore_objects(state_objects)
+        self.register_for_channels(state_object.do_id for state_object in state_objects)
+
+        # the channels keep observing the zones they were watching, so broadcasts
+        # and objects entering those zones still reach them after the restart...
+        num_watches = 0
+        for channel, parent_id, zone_id in watches:
+            parent_object = self.object_manager.get_object(parent_id)
+            if parent_object is None:
+                continue
+
+            if self.visibility_service.add_watch(channel, parent_id, zone_id):
+                parent_object.add_zone_observer(zone_id, channel)
+                num_watches += 1
+
+        io.startup_timer.record('StateServer warm start', start_time)
+        self.notify.info('Restored %d shards, %d objects and %d watches from snapshot: %s.' % (
+            len(shard_data), len(state_objects), num_watches, self._snapshot.filename))
 
     def handle_datagram(self, channel, sender, message_type, di):
         if message_type == types.STATESERVER_ADD_SHARD:
@@ -930,37 +2015,46 @@ class StateServer(io.NetworkConnector):
         self.handle_delete_shard_objects(shard)
 
     def handle_send_update_shard(self, shard, only_children=False):
-        for state_object in list(self.object_manager.objects.values()):
-            if not state_object.owner_id:
-                continue
-
+        for state_object in self.object_manager.get_owned_objects():
             if state_object.ai_channel != shard.channel and only_children:
                 continue
 
             self.handle_get_shard_list(state_object.owner_id)
 
     def handle_delete_shard_objects(self, shard):
-        for state_object in list(self.object_manager.objects.values()):
-            if state_object.ai_channel != shard.channel:
-                continue
+        # the shard's objects that were never created are simply forgotten...
+        self.generate_queue.remove_sender_generates(shard.channel)
+        state_objects = self.object_manager.get_ai_objects(shard.channel)
 
-            # if this object is owned and since this shard is closed,
-            # send a disconnect to the client agent to be bounced back to the client.
-            if state_object.owner_id:
-                self.handle_send_disconnect(state_object.owner_id, shard)
+        # if an object is owned and since this shard is closed, send a disconnect
+        # to the client agent to be bounced back to the client, the owners
+        # are disconnected so they are not sent the deletes...
+        owners = set(state_object.owner_id for state_object in state_objects
+            if state_object.owner_id)
+
+        if owners:
+            self.handle_send_disconnects(sorted(owners), shard)
 
-            self.object_manager.remove_object(state_object)
+        delete_sets = self.object_manager.get_delete_sets(state_objects, owners)
+        for channel, do_ids in delete_sets.items():
+            self.handle_send_delete_set(channel, do_ids)
 
+        self.object_manager.discard_objects(state_objects)
         self.shard_manager.remove_shard(shard)
 
     def handle_send_disconnect(self, channel, shard):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(channel, self.channel,
-            types.CLIENT_AGENT_DISCONNECT)
+        self.handle_send_disconnects([channel], shard)
 
-        datagram.add_uint16(types.CLIENT_DISCONNECT_SHARD_CLOSED)
-        datagram.add_string('Shard with channel: %d has been terminated!' % shard.channel)
-        self.handle_send_connection_datagram(datagram)
+    def handle_send_disconnects(self, channels, shard):
+        for datagram in create_multi_datagrams(channels, self.channel,
+                types.CLIENT_AGENT_DISCONNECT):
+            datagram.add_uint16(types.CLIENT_DISCONNECT_SHARD_CLOSED)
+            datagram.add_string('Shard with channel: %d has been terminated!' % shard.channel)
+            self.handle_send_connection_datagram(datagram)
+
+    def handle_send_delete_set(self, channel, do_ids):
+        for datagram in create_delete_set_datagrams(channel, self.channel, do_ids):
+            self.handle_send_connection_datagram(datagram)
 
     def handle_get_shard_list(self, sender):
         datagram = io.NetworkDatagram()
@@ -981,30 +2075,64 @@ class StateServer(io.NetworkConnector):
         zone_id = di.get_uint32()
         dc_id = di.get_uint16()
 
-        if self.object_manager.has_object(do_id):
+        if self.object_manager.has_object(do_id) or self.generate_queue.has_generate(do_id):
             self.notify.info('Failed to generate an already existing '
                 'object with do_id: %d!' % do_id)
 
             return
 
-        dc_class = self.dc_loader.dclasses_by_number.get(dc_id)
+        dc_class = self.dc_loader.class_metadata_by_number.get(dc_id)
         if not dc_class:
             self.notify.warning('Failed to generate an object with do_id: %d, '
                 'no dclass found for dc_id: %d!' % (do_id, dc_id))
 
             return
 
-        state_object = StateObject(self, self.object_manager, do_id, parent_id,
-            zone_id, dc_class, has_other, di)
+        generate = PendingGenerate(sender, has_other, do_id, parent_id, zone_id, dc_class, di)
+        if not self.generate_queue.enabled:
+            self.create_generate(generate)
+            return
+
+        self.generate_queue.add_generate(generate, self.shard_manager.is_ai_channel(sender))
+
+    def create_generate(self, generate, register=True):
+        state_object = StateObject(self, self.object_manager, generate.do_id, generate.parent_id,
+            generate.zone_id, generate.dc_class, generate.has_other, generate.di)
+
+        if self.shard_manager.is_ai_channel(generate.sender):
+            state_object.ai_channel = generate.sender
 
-        # TODO FIXME: find a better way to do this...
-        if self.shard_manager.has_shard(sender) or sender == types.UD_CHANNEL:
-            state_object.ai_channel = sender
+        self.object_manager.add_object(state_object, register)
+        return state_object
 
-        self.object_manager.add_object(state_object)
+    def create_generates(self):
+        """
+        Creates the objects of this frame's queued generates, their
+        channels are registered with a single control message...
+        """
+
+        generates = self.generate_queue.pop_generates()
+        if not generates:
+            return
+
+        for generate in generates:
+            self.create_generate(generate, register=False)
+
+        self.register_for_channels([generate.do_id for generate in generates])
+
+    def flush_generate(self, do_id):
+        """
+        Creates an object that is still queued right away, a message
+        for the object must never be handled before it's generate...
+        """
+
+        generate = self.generate_queue.remove_generate(do_id)
+        if generate is not None:
+            self.create_generate(generate)
 
     def handle_object_update_field(self, channel, sender, di):
         do_id = di.get_uint32()
+        self.flush_generate(do_id)
         if not di.get_remaining_size():
             self.notify.warning('Cannot handle an field update for object: %d, '
                 'truncated datagram!' % do_id)
@@ -1022,6 +2150,11 @@ class StateServer(io.NetworkConnector):
 
     def handle_delete_object(self, sender, di):
         do_id = di.get_uint32()
+
+        # an object deleted before it was created never has to be created...
+        if self.generate_queue.remove_generate(do_id) is not None:
+            return
+
         state_object = self.object_manager.get_object(do_id)
         if not state_object:
             self.notify.debug('Failed to delete object: %d, object does not exist!' % do_id)
@@ -26,6 +26,8 @@ CONTROL_ADD_RANGE = 2006
 CONTROL_REMOVE_RANGE = 2007
 CONTROL_ADD_POST_REMOVE = 2008
 CONTROL_CLEAR_POST_REMOVE = 2009
+CONTROL_LINK_NODE = 2010
+CONTROL_SET_CHANNELS = 2011
 
 CLIENT_LOGIN = 1
 CLIENT_LOGIN_RESP = 2
@@ -120,6 +122,7 @@ CLIENT_DISCONNECT_INVALID_PLAY_TOKEN_TYPE = 284
 CLIENT_DISCONNECT_TRUNCATED_DATAGRAM = 109
 CLIENT_DISCONNECT_ANONYMOUS_VIOLATION = 113
 CLIENT_DISCONNECT_SHARD_CLOSED = 114
+CLIENT_DISCONNECT_SLOW_CONNECTION = 347
 
 # Debug Stuff
 CLIENT_DEBUG_SET_NAME = 201
@@ -209,6 +212,7 @@ STATESERVER_REMOVE_SHARD = 2110
 STATESERVER_UPDATE_SHARD = 2111
 STATESERVER_GET_SHARD_ALL = 2112
 STATESERVER_GET_SHARD_ALL_RESP = 2113
+STATESERVER_OBJECT_DELETE_RAM_MULTIPLE = 2114
 
 DBSERVER_CREATE_STORED_OBJECT = 1003
 DBSERVER_CREATE_STORED_OBJECT_RESP = 1004
@@ -1,10 +1,15 @@
 from panda3d.core import *
 from panda3d.direct import *
 
+from realtime import codec
 from realtime import io
 from realtime import types
 from realtime.notifier import notify
 
+from game import ZoneUtil
+from game import genDNAFileName, extractGroupName
+from game.dna.DNAParser import loadDNAFileAI, DNAStorage
+
 
 class DatabaseInterface(object):
     notify = notify.new_category('NetworkDatabaseInterface')
@@ -21,6 +26,9 @@ class DatabaseInterface(object):
         self._context = (self._context + 1) & 0xFFFFFFFF
         return self._context
 
+    def get_metadata(self, dclass):
+        return self._network.dc_loader.get_class_metadata(dclass)
+
     def create_object(self, channel_id, database_id, dclass, fields={}, callback=None):
         """
         Create an object in the specified database.
@@ -35,27 +43,25 @@ class DatabaseInterface(object):
         self._callbacks[ctx] = callback
 
         # Pack up/count valid fields.
-        field_packer = DCPacker()
+        metadata = self.get_metadata(dclass)
+        field_data = []
         field_count = 0
         for k,v in fields.items():
-            field = dclass.get_field_by_name(k)
+            field = metadata.get_field_by_name(k)
             if not field:
                 self.notify.error('Creation request for %s object contains an invalid field named %s' % (
-                    dclass.get_name(), k))
+                    metadata.name, k))
 
-            field_packer.raw_pack_uint16(field.get_number())
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, v)
-            field_packer.end_pack()
+            field_data.append(codec.pack_numbered_fields([field], [v]))
             field_count += 1
 
         # Now generate and send the datagram:
         dg = io.NetworkDatagram()
         dg.add_header(database_id, channel_id, types.DBSERVER_CREATE_OBJECT)
         dg.add_uint32(ctx)
-        dg.add_uint16(dclass.get_number())
+        dg.add_uint16(metadata.number)
         dg.add_uint16(field_count)
-        dg.append_data(field_packer.get_bytes())
+        dg.append_data(''.join(field_data))
         self._network.handle_send_connection_datagram(dg)
 
     def handle_create_object_resp(self, di):
@@ -77,7 +83,7 @@ class DatabaseInterface(object):
         """
         Query object `do_id` out of the database.
         On success, the callback will be invoked as callback(dclass, fields)
-        where dclass is a DCClass instance and fields is a dict.
+        where dclass is a DCClassMetadata instance and fields is a dict.
         On failure, the callback will be invoked as callback(None, None).
         """
 
@@ -105,13 +111,14 @@ class DatabaseInterface(object):
         if len(field_names) > 1:
             dg.add_uint16(len(field_names))
 
+        metadata = self.get_metadata(dclass)
         for field_name in field_names:
-            field = dclass.get_field_by_name(field_name)
+            field = metadata.get_field_by_name(field_name)
             if field is None:
                 self.notify.error('Bad field named %s in query for %s object' % (
-                    field_name, dclass.get_name()))
+                    field_name, metadata.name))
 
-            dg.add_uint16(field.get_number())
+            dg.add_uint16(field.number)
 
         self._network.handle_send_connection_datagram(dg)
 
@@ -134,9 +141,9 @@ class DatabaseInterface(object):
 
             if message_type == types.DBSERVER_OBJECT_GET_ALL_RESP:
                 dclass_id = di.get_uint16()
-                dclass = self._network.dc_loader.dclasses_by_number.get(dclass_id)
+                dclass = self._network.dc_loader.class_metadata_by_number.get(dclass_id)
             else:
-                dclass = self._dclasses[ctx]
+                dclass = self.get_metadata(self._dclasses[ctx])
 
             if not dclass:
                 self.notify.error('Received bad dclass %d in DBSERVER_OBJECT_GET_ALL_RESP' % (
@@ -147,20 +154,18 @@ class DatabaseInterface(object):
             else:
                 field_count = di.get_uint16()
 
-            field_packer = DCPacker()
-            field_packer.set_unpack_data(di.get_remaining_bytes())
+            field_data = di.get_remaining_bytes()
+            offset = 0
             fields = {}
             for x in range(field_count):
-                field_id = field_packer.raw_unpack_uint16()
+                field_id, offset = codec.unpack_uint16(field_data, offset)
                 field = dclass.get_field_by_index(field_id)
 
                 if not field:
                     self.notify.error('Received bad field %d in query for %s object' % (
-                        field_id, dclass.get_name()))
+                        field_id, dclass.name))
 
-                field_packer.begin_unpack(field)
-                fields[field.get_name()] = field.unpack_args(field_packer)
-                field_packer.end_unpack()
+                fields[field.name], offset = field.codec.unpack_args(field_data, offset)
 
             if self._callbacks[ctx]:
                 self._callbacks[ctx](dclass, fields)
@@ -194,25 +199,22 @@ class DatabaseInterface(object):
                 self.notify.error('new_fields and old_fields must contain the same keys!')
                 return
 
-        field_packer = DCPacker()
+        metadata = self.get_metadata(dclass)
+        field_data = []
         field_count = 0
         for k,v in new_fields.items():
-            field = dclass.get_field_by_name(k)
+            field = metadata.get_field_by_name(k)
             if not field:
                 self.notify.error('Update for %s(%d) object contains invalid field named %s' % (
-                    dclass.get_name(), do_id, k))
-
-            field_packer.raw_pack_uint16(field.get_number())
+                    metadata.name, do_id, k))
 
             if old_fields is not None:
                 # Pack the old values:
-                field_packer.begin_pack(field)
-                field.pack_args(field_packer, old_fields[k])
-                field_packer.end_pack()
+                field_data.append(codec.pack_numbered_fields([field], [old_fields[k]]))
+                field_data.append(field.codec.pack_args(v))
+            else:
+                field_data.append(codec.pack_numbered_fields([field], [v]))
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, v)
-            field_packer.end_pack()
             field_count += 1
 
         # Generate and send the datagram:
@@ -236,7 +238,7 @@ class DatabaseInterface(object):
         if field_count != 1:
             dg.add_uint16(field_count)
 
-        dg.append_data(field_packer.getString())
+        dg.append_data(''.join(field_data))
         self._network.handle_send_connection_datagram(dg)
 
         if old_fields is None and callback is not None:
@@ -271,20 +273,18 @@ class DatabaseInterface(object):
             else:
                 field_count = 1
 
-            field_packer = DCPacker()
-            field_packer.set_unpack_data(di.get_remaining_bytes())
+            field_data = di.get_remaining_bytes()
+            offset = 0
             fields = {}
             for x in range(field_count):
-                fieldId = field_packer.raw_pack_uint16()
-                field = self._network.dc_loader.dc_file.get_field_by_index(fieldId)
+                fieldId, offset = codec.unpack_uint16(field_data, offset)
+                field = self._network.dc_loader.get_field_metadata(fieldId)
 
                 if not field:
                     self.notify.error('Received bad field %d in update failure response message' % (
                         fieldId))
 
-                field_packer.begin_unpack(field)
-                fields[field.get_name()] = field.unpack_args(field_packer)
-                field_packer.end_unpack()
+                fields[field.name], offset = field.codec.unpack_args(field_data, offset)
 
             if self._callbacks[ctx]:
                 self._callbacks[ctx](fields)
@@ -304,6 +304,59 @@ class DatabaseInterface(object):
         elif message_type == types.DBSERVER_OBJECT_SET_FIELDS_IF_EQUALS_RESP:
             self.handle_update_object_resp(di, True)
 
+class VisibilityGraph(object):
+    """
+    The zones visible from each zone of a street branch, the vis groups
+    of a branch are read from it's DNA file the first time they are needed
+    and kept for every later lookup...
+    """
+
+    notify = notify.new_category('VisibilityGraph')
+
+    def __init__(self):
+        self._branch_graphs = {}
+
+    @property
+    def branch_graphs(self):
+        return self._branch_graphs
+
+    def get_branch_graph(self, zone_id):
+        branch_zone_id = ZoneUtil.getBranchZone(zone_id)
+        branch_graph = self._branch_graphs.get(branch_zone_id)
+        if branch_graph is None:
+            branch_graph = self._branch_graphs[branch_zone_id] = self.load_branch_graph(
+                branch_zone_id)
+
+        return branch_graph
+
+    def load_branch_graph(self, branch_zone_id):
+        dna_store = DNAStorage()
+        loadDNAFileAI(dna_store, genDNAFileName(branch_zone_id), None)
+
+        branch_graph = {}
+        for index in xrange(dna_store.getNumDNAVisGroupsAI()):
+            vis_group = dna_store.getDNAVisGroupAI(index)
+            vis_zone_id = int(extractGroupName(dna_store.getDNAVisGroupName(index)))
+            vis_zone_id = ZoneUtil.getTrueZoneId(vis_zone_id, branch_zone_id)
+
+            visibles = [int(vis_group.visibles[visible_index]) for visible_index in xrange(
+                vis_group.getNumVisibles())]
+
+            visibles.append(ZoneUtil.getBranchZone(vis_zone_id))
+            branch_graph[vis_zone_id] = tuple(visibles)
+
+        self.notify.debug('Loaded %d vis groups for branch: %d.' % (
+            len(branch_graph), branch_zone_id))
+
+        return branch_graph
+
+    def get_visible_zones(self, zone_id):
+        """
+        Returns the zones visible from a zone within a street branch
+        """
+
+        return self.get_branch_graph(zone_id).get(zone_id, ())
+
 class DeferredCallback(object):
     """
     A class that represents a pending callback event when called
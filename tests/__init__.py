@@ -0,0 +1,20 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import __builtin__
+import os
+
+from panda3d.core import loadPrcFile
+
+if os.path.exists('config/general.prc'):
+    loadPrcFile('config/general.prc')
+
+from pandac.PandaModules import *
+from direct.task.TaskManagerGlobal import taskMgr as task_mgr
+
+# the realtime modules expect the same builtins as when run through realtime.main
+__builtin__.config = get_config_showbase()
+__builtin__.task_mgr = task_mgr
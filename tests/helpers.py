@@ -0,0 +1,52 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import random
+import struct
+
+from realtime import codec
+
+def generate_args(field_codec):
+    """
+    Generates random arguments for a compiled codec
+    """
+
+    args = []
+    for kind, fmt, divisor in field_codec.elements:
+        if kind == codec.ELEMENT_STRING:
+            args.append(''.join(chr(random.randint(0, 255)) for _ in range(random.randint(0, 16))))
+        elif kind == codec.ELEMENT_ARRAY:
+            args.append([generate_number(fmt, 1) for _ in range(random.randint(0, 8))])
+        else:
+            args.append(generate_number(fmt, divisor))
+
+    return tuple(args)
+
+def generate_number(fmt, divisor):
+    """
+    Generates a random value of a numeric element
+    """
+
+    if fmt == 'c':
+        return chr(random.randint(0, 255))
+
+    if fmt == 'd':
+        return random.uniform(-1000.0, 1000.0)
+
+    bits = struct.calcsize(fmt) * 8
+    if fmt.isupper():
+        value = random.randint(0, (1 << bits) - 1)
+    else:
+        value = random.randint(-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+
+    # the DCPacker only accepts 64-bit values above 32-bits as longs
+    if bits == 64:
+        value = long(value)
+
+    if divisor != 1:
+        return value / float(divisor)
+
+    return value
@@ -0,0 +1,206 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from panda3d.core import Filename
+from panda3d.direct import DCFile, DCPacker
+
+from realtime import codec
+from tests.helpers import generate_args
+
+# the game's dc files, set REALTIME_DC_FILES to check others (separated by os.pathsep)
+DC_FILE_NAMES = os.environ.get('REALTIME_DC_FILES', os.pathsep.join([
+    '../ToontownOnline/etc/otp.dc', '../ToontownOnline/etc/toon.dc'])).split(os.pathsep)
+
+# every kind of parameter the plans compile, and a few that fall back to the DCPacker
+SAMPLE_DC = '''
+typedef uint8 bool;
+typedef uint8(0-1) rbool;
+typedef uint32 DoId;
+
+struct Point {
+    int16 x;
+    int16 y;
+};
+
+dclass DistributedObject {
+    setBool(bool) broadcast ram;
+    setRBool(rbool) broadcast;
+};
+
+dclass DistributedNode : DistributedObject {
+    setX(int16 / 10) broadcast ram ownsend airecv;
+    setXY(int16 / 10, int16 / 10) broadcast ram;
+    setH(int16 % 360 / 10) broadcast ram;
+    setName(string = "hello") required broadcast db;
+    setBlob(blob) ram;
+    setBlob32(blob32) ram;
+    setChar(char) ram;
+    setIds(DoId []) ram;
+    setBytes(uint8 []) ram;
+    setChars(char []) ram;
+    setFixed(uint8 [3]) ram;
+    setArray(uint16array) ram;
+    setArray8(int8array) ram;
+    setNumbers(uint64, int64, float64, uint32, int32) required broadcast db;
+    setFloat(float64 / 100) ram;
+    setRange(uint8(0-10)) ram;
+    setPoint(Point) ram;
+    setPoints(Point []) ram;
+    setXYH : setXY, setH;
+    setNothing() broadcast;
+    setDefault(uint32 = 7, int16 / 10 = 5.5) db;
+};
+'''
+
+# bytes placed around the packed data, so that unpacking at an offset is checked too
+PREFIX = '\xde\xad'
+SUFFIX = '\xbe\xef'
+
+
+def pack_expected(field, args):
+    field_packer = DCPacker()
+    field_packer.begin_pack(field)
+    field.pack_args(field_packer, args)
+    if not field_packer.end_pack():
+        return None
+
+    return field_packer.get_string()
+
+def unpack_expected(field, data):
+    field_packer = DCPacker()
+    field_packer.set_unpack_data(data)
+    field_packer.begin_unpack(field)
+    args = field.unpack_args(field_packer)
+    if not field_packer.end_unpack():
+        return None
+
+    return args
+
+
+class DCParityTest(object):
+    """
+    Packs and unpacks every field of the dc files with both the field's
+    codec and a DCPacker, any difference fails the test...
+    """
+
+    dc_file_names = ()
+    iterations = 16
+
+    def setUp(self):
+        for dc_file_name in self.dc_file_names:
+            if not os.path.exists(dc_file_name):
+                self.skipTest('The dc file %s is missing.' % dc_file_name)
+
+        self.dc_file = DCFile()
+        for dc_file_name in self.dc_file_names:
+            if not self.dc_file.read(Filename.from_os_specific(dc_file_name)):
+                self.fail('Could not read dc file: %s' % dc_file_name)
+
+    def get_fields(self):
+        for class_index in xrange(self.dc_file.get_num_classes()):
+            dclass = self.dc_file.get_class(class_index)
+            for field_index in xrange(dclass.get_num_fields()):
+                field = dclass.get_field(field_index)
+                yield '%s.%s' % (dclass.get_name(), field.get_name()), field
+
+    def check_field(self, field, field_codec, args):
+        """
+        Returns why the codec differs from the DCPacker for these
+        arguments, or None when they match
+        """
+
+        expected_data = pack_expected(field, args)
+        if expected_data is None:
+            return 'the DCPacker failed to pack %r' % (args,)
+
+        expected_args = unpack_expected(field, expected_data)
+        if expected_args is None:
+            return 'the DCPacker failed to unpack %r' % (expected_data,)
+
+        try:
+            data = field_codec.pack_args(args)
+            unpacked_args, offset = field_codec.unpack_args(PREFIX + expected_data + SUFFIX, len(PREFIX))
+        except (codec.DCCodecError, TypeError, ValueError) as e:
+            return 'the codec raised %r for %r' % (e, args)
+
+        if data != expected_data:
+            return 'packed %r as %r, expected %r' % (args, data, expected_data)
+
+        if offset != len(PREFIX) + len(expected_data):
+            return 'unpacked %r up to %d, expected %d' % (expected_data, offset,
+                len(PREFIX) + len(expected_data))
+
+        if unpacked_args != expected_args:
+            return 'unpacked %r as %r, expected %r' % (expected_data, unpacked_args, expected_args)
+
+        return None
+
+    def get_samples(self, field, field_codec):
+        # the default value is the one sample of a fallback field, it is the
+        # field's zero value when the dc file does not give one...
+        samples = [unpack_expected(field, field.get_default_value())]
+        if field_codec.compiled:
+            samples.extend(generate_args(field_codec) for _ in xrange(self.iterations))
+
+        return samples
+
+    def check_fields(self, compiled):
+        failures = []
+        checked = 0
+        for name, field in self.get_fields():
+            field_codec = codec.compile_field(field)
+            if field_codec.compiled != compiled:
+                continue
+
+            checked += 1
+            for args in self.get_samples(field, field_codec):
+                failure = self.check_field(field, field_codec, args)
+                if failure is not None:
+                    failures.append('%s: %s' % (name, failure))
+                    break
+
+        self.assertFalse(failures, 'The codec does not match the DCPacker for %d fields:\n%s' % (
+            len(failures), '\n'.join(failures)))
+
+        return checked
+
+    def test_compiled_fields(self):
+        self.check_fields(True)
+
+    def test_fallback_fields(self):
+        self.check_fields(False)
+
+
+class SampleDCParityTest(DCParityTest, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dc_file_name = os.path.join(self.directory, 'sample.dc')
+        with open(self.dc_file_name, 'w') as dc_file:
+            dc_file.write(SAMPLE_DC)
+
+        self.dc_file_names = [self.dc_file_name]
+        DCParityTest.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fields_are_checked(self):
+        self.assertEqual(self.check_fields(True), 16)
+        self.assertEqual(self.check_fields(False), 9)
+
+
+class GameDCParityTest(DCParityTest, unittest.TestCase):
+    dc_file_names = DC_FILE_NAMES
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import marshal
+import os
+import shutil
+import tempfile
+import unittest
+
+from realtime import codec, io
+
+SAMPLE_DC = '''
+dclass DistributedObject {
+    setName(string = "hello") required broadcast db;
+    setXY(int16 / 10, int16 / 10) broadcast ram;
+    setIds(uint32 []) ram;
+};
+'''
+
+
+class DCCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dc_file_name = os.path.join(self.directory, 'sample.dc')
+        self.cache_filename = os.path.join(self.directory, 'dc.cache')
+        self.write_dc_file(SAMPLE_DC)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_dc_file(self, data):
+        with open(self.dc_file_name, 'w') as dc_file:
+            dc_file.write(data)
+
+    def read_dc_files(self):
+        dc_loader = io.NetworkDCLoader()
+        dc_loader._cache_filename = self.cache_filename
+        dc_loader.read_dc_files([self.dc_file_name])
+        return dc_loader
+
+    def test_cache_is_loaded(self):
+        parsed_loader = self.read_dc_files()
+        self.assertFalse(parsed_loader.cache_loaded)
+
+        cached_loader = self.read_dc_files()
+        self.assertTrue(cached_loader.cache_loaded)
+        self.assertEqual(cached_loader.hash_value, parsed_loader.hash_value)
+
+        metadata = cached_loader.get_class_metadata('DistributedObject')
+        field = metadata.get_field_by_name('setXY')
+        self.assertTrue(field.codec.compiled)
+        self.assertEqual(field.codec.unpack_args(field.codec.pack_args((1.5, -2.5)))[0], (1.5, -2.5))
+
+    def test_changed_dc_file_is_parsed(self):
+        self.read_dc_files()
+        self.write_dc_file(SAMPLE_DC.replace('setIds', 'setDoIds'))
+
+        dc_loader = self.read_dc_files()
+        self.assertFalse(dc_loader.cache_loaded)
+        self.assertTrue(dc_loader.get_class_metadata('DistributedObject').get_field_by_name('setDoIds'))
+
+    def test_invalid_plan_is_ignored(self):
+        self.read_dc_files()
+        with open(self.cache_filename, 'rb') as cache_file:
+            cache = marshal.load(cache_file)
+
+        # a format is put into the generated source, so it must never be trusted...
+        cache['fields'] = [(number, name, flags, default_value, elements and
+            ((codec.ELEMENT_NUMERIC, 'h") or __import__("os").getpid() or ("', 1),))
+            for number, name, flags, default_value, elements in cache['fields']]
+
+        with open(self.cache_filename, 'wb') as cache_file:
+            marshal.dump(cache, cache_file, 2)
+
+        dc_loader = self.read_dc_files()
+        self.assertFalse(dc_loader.cache_loaded)
+        self.assertTrue(dc_loader.get_class_metadata('DistributedObject'))
+
+    def test_corrupt_cache_is_ignored(self):
+        with open(self.cache_filename, 'wb') as cache_file:
+            cache_file.write('\x00garbage')
+
+        self.assertFalse(self.read_dc_files().cache_loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import unittest
+
+from realtime.messagedirector import ChannelRangeIndex
+
+
+class ChannelRangeIndexTest(unittest.TestCase):
+
+    def test_add_and_remove_range(self):
+        index = ChannelRangeIndex()
+        index.add_range(0, 10, 'P')
+        self.assertEqual(index.get_participants(5), {'P': 1})
+
+        index.remove_range(0, 10, 'P')
+        self.assertFalse(index.get_participants(5))
+
+    def test_remove_range_after_coalesce(self):
+        index = ChannelRangeIndex()
+        index.add_range(0, 10, 'P')
+        index.add_range(11, 20, 'P')
+
+        # removing another range coalesces 0-10 and 11-20 into a single segment...
+        index.add_range(100, 200, 'Q')
+        index.remove_range(100, 200, 'Q')
+
+        index.remove_range(11, 20, 'P')
+        self.assertFalse(index.get_participants(15))
+        self.assertEqual(index.get_participants(5), {'P': 1})
+        self.assertFalse(index.get_participants(150))
+
+    def test_remove_participant(self):
+        index = ChannelRangeIndex()
+        index.add_range(0, 10, 'P')
+        index.add_range(5, 15, 'Q')
+        index.remove_participant('P')
+
+        self.assertFalse(index.get_participants(2))
+        self.assertEqual(index.get_participants(7), {'Q': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import unittest
+
+from realtime import io, types
+from realtime.stateserver import MAX_DELETE_SET_SIZE, ShardManager, create_delete_set_datagrams
+
+
+class DeleteSetTest(unittest.TestCase):
+
+    def unpack_delete_set(self, datagram):
+        di = io.NetworkDatagramIterator(datagram)
+        self.assertEqual(di.get_uint8(), 1)
+        self.assertEqual(di.get_uint64(), 4000)
+        self.assertEqual(di.get_uint64(), 1001)
+        self.assertEqual(di.get_uint16(), types.STATESERVER_OBJECT_DELETE_RAM_MULTIPLE)
+
+        do_ids = [di.get_uint32() for _ in xrange(di.get_uint16())]
+        self.assertFalse(di.get_remaining_size())
+        return do_ids
+
+    def test_delete_set_is_split(self):
+        do_ids = range(100000000, 100000000 + MAX_DELETE_SET_SIZE * 2 + 10)
+        datagrams = create_delete_set_datagrams(4000, 1001, do_ids)
+        self.assertEqual(len(datagrams), 3)
+
+        unpacked_do_ids = []
+        for datagram in datagrams:
+            self.assertTrue(datagram.get_length() <= 0xFFFF)
+            unpacked_do_ids.extend(self.unpack_delete_set(datagram))
+
+        self.assertEqual(unpacked_do_ids, do_ids)
+
+    def test_full_delete_set_fits(self):
+        datagram, = create_delete_set_datagrams(4000, 1001, range(MAX_DELETE_SET_SIZE))
+        self.assertTrue(MAX_DELETE_SET_SIZE * 4 < datagram.get_length() <= 0xFFFF)
+
+
+
+class ShardManagerTest(unittest.TestCase):
+
+    def test_ai_channels(self):
+        shard_manager = ShardManager()
+        self.assertTrue(shard_manager.is_ai_channel(types.UD_CHANNEL))
+        self.assertFalse(shard_manager.is_ai_channel(500))
+
+        shard = shard_manager.add_shard(500, 7, 'Toon Valley', 0)
+        self.assertTrue(shard_manager.is_ai_channel(500))
+        self.assertFalse(shard_manager.is_ai_channel(1000000001))
+
+        shard_manager.remove_shard(shard)
+        self.assertFalse(shard_manager.is_ai_channel(500))
+
+
+if __name__ == '__main__':
+    unittest.main()